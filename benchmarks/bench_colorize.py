@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Benchmarks for colorizing plain text log files
+
+Writes a plain text log file (with a formatter using colorize=False), then times
+colorizing it serially, and with worker pools of increasing size, reporting the
+MB/s and the speedup over the serial run.
+
+Run from a source checkout::
+
+    python benchmarks/bench_colorize.py
+    python benchmarks/bench_colorize.py --lines 1000000 --jobs 2 4 8 --json results.json
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# So the benchmarks run against the checkout they are in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import color_bucket_logger  # noqa: E402
+from color_bucket_logger import colorize  # noqa: E402
+
+FORMAT = ('%(asctime)s %(levelname)-8s %(processName)s pid=%(process)d %(threadName)s'
+          ' %(name)s %(funcName)s %(filename)s:%(lineno)d - %(message)s')
+
+
+def write_log(path, lines):
+    formatter = color_bucket_logger.ColorFormatter(fmt=FORMAT, colorize=False)
+    with io.open(path, 'w', encoding='utf-8') as log_fd:
+        for index in range(lines):
+            record = logging.LogRecord('myapp.module%d' % (index % 50),
+                                       (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR)[index % 4],
+                                       __file__, index % 300, 'Handled request %s in %sms', (index, index % 97), None,
+                                       func='handler')
+            record.threadName = 'Thread-%d' % (index % 8)
+            record.thread = index % 8
+            log_fd.write(formatter.format(record) + u'\n')
+            if index % 1000 == 999:
+                log_fd.write(u'Traceback (most recent call last):\n  File "app.py", line 1, in <module>\nValueError\n')
+
+
+def time_serial(path, out_path):
+    colorizer = colorize.LineColorizer(fmt=FORMAT)
+    start = time.time()
+    with colorize.open_text(path) as in_stream:
+        with io.open(out_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as out_stream:
+            colorizer.colorize_stream(in_stream, out_stream)
+    return time.time() - start
+
+
+def time_parallel(path, out_path, jobs, chunk_size):
+    start = time.time()
+    with io.open(out_path, 'wb') as out_stream:
+        colorize.colorize_parallel(colorize.file_chunks(path, chunk_size), out_stream, jobs, {'fmt': FORMAT})
+    return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=500000, help='lines in the log file')
+    parser.add_argument('--jobs', type=int, nargs='+', default=None,
+                        help='the worker pool sizes to time (default 2, 4, ... up to the number of cpus)')
+    parser.add_argument('--chunk-size', type=int, default=colorize.DEFAULT_CHUNK_SIZE, help='bytes per chunk')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results as JSON to JSON_FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    cpus = multiprocessing.cpu_count()
+    jobs_list = args.jobs or sorted(set([2] + [jobs for jobs in [2 ** power for power in range(2, 8)] + [cpus] if 2 < jobs <= cpus]))
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_colorize')
+    try:
+        log_path = os.path.join(tmp_dir, 'plain.log')
+        out_path = os.path.join(tmp_dir, 'colored.log')
+        write_log(log_path, args.lines)
+        size_mb = os.path.getsize(log_path) / 1e6
+
+        serial_seconds = time_serial(log_path, out_path)
+        with io.open(out_path, 'rb') as out_fd:
+            expected = out_fd.read()
+
+        results = [{'jobs': 1, 'seconds': serial_seconds, 'mb_per_s': size_mb / serial_seconds, 'speedup': 1.0}]
+        for jobs in jobs_list:
+            seconds = time_parallel(log_path, out_path, jobs, args.chunk_size)
+            with io.open(out_path, 'rb') as out_fd:
+                if out_fd.read() != expected:
+                    raise AssertionError('jobs=%d output differs from the serial output' % jobs)
+            results.append({'jobs': jobs, 'seconds': seconds, 'mb_per_s': size_mb / seconds,
+                            'speedup': serial_seconds / seconds})
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.json_file != '-':
+        print('%.1f MB, %d cpus' % (size_mb, cpus))
+        print('%6s %10s %10s %8s' % ('jobs', 'seconds', 'MB/s', 'speedup'))
+        for result in results:
+            print('%6d %10.2f %10.1f %7.2fx' % (result['jobs'], result['seconds'], result['mb_per_s'], result['speedup']))
+
+    if args.json_file:
+        report = {'meta': {'color_bucket_logger_version': color_bucket_logger.__version__,
+                           'python': platform.python_version(),
+                           'implementation': platform.python_implementation(),
+                           'platform': platform.platform(),
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                           'cpus': cpus,
+                           'lines': args.lines,
+                           'megabytes': size_mb,
+                           'chunk_size': args.chunk_size},
+                  'results': results}
+        if args.json_file == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json_file, 'w') as json_fd:
+                json.dump(report, json_fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Benchmarks for the color_bucket_logger formatters
+
+Each case formats one LogRecord over and over with ColorFormatter, TermFormatter,
+ColorFormatter(compile_format=True) and ColorFormatter(compile_format=False), and
+with a plain logging.Formatter using the same format string as the baseline.
+
+The cases start from one base config (verbose '%' format, no auto_color, no
+color_groups, colored by logger name, a simple record) and vary one thing at a
+time: the format style, auto_color, the number of color_groups, the
+default_color_by_attr, and the kind of record (exception, large 'extra', large
+args).
+
+Run from a source checkout::
+
+    python benchmarks/bench_formatters.py
+    python benchmarks/bench_formatters.py --filter record= --json results.json
+
+For each formatter it reports records/s, ns/record, the time relative to the
+logging.Formatter baseline, the peak bytes of temporary memory allocated while
+formatting one record (from tracemalloc, Python 3.9+), the bytes per record still
+allocated after formatting a batch of records whose results are discarded (what
+the formatter holds on to, like cache entries), and how many times the record's
+getMessage() was called.
+
+The peak is a high-water mark, not a total: a single large temporary allocation
+hides smaller ones. time.strftime() allocates a 4 KiB buffer, for example, so the
+cases whose format has %(asctime)s all peak at about 4.5 KB.
+
+The 'style=' cases also report the time of each formatter with the '{' format
+relative to the same formatter with the '%' format.
+
+Results are printed as a table. --json writes them as JSON as well, so runs
+from different releases can be compared.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# So the benchmarks run against the checkout they are in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import color_bucket_logger  # noqa: E402
+
+FORMATS = {
+    '%': ('%(asctime)s %(levelname)-8s %(processName)s pid=%(process)d %(threadName)s'
+          ' %(name)s %(funcName)s %(filename)s:%(lineno)d - %(message)s'),
+    '{': ('{asctime} {levelname:<8} {processName} pid={process:d} {threadName}'
+          ' {name} {funcName} {filename}:{lineno:d} - {message}'),
+}
+
+COLOR_GROUPS = {
+    0: [],
+    1: [('name', ['levelname'])],
+    4: [('name', ['levelname', 'funcName']),
+        ('process', ['processName']),
+        ('thread', ['threadName']),
+        ('levelname', ['lineno'])],
+    8: [('name', ['levelname', 'funcName']),
+        ('process', ['processName']),
+        ('thread', ['threadName']),
+        ('levelname', ['lineno']),
+        ('filename', ['filename']),
+        ('funcName', ['funcName']),
+        ('message', ['message']),
+        ('processName', ['default'])],
+}
+
+#: args that are expensive to render with msg % args
+LARGE_ARGS = (list(range(2000)),
+              dict(('key%d' % i, 'value%d' % i) for i in range(500)))
+
+#: lots of 'extra' attributes on the record
+LARGE_EXTRA = dict(('extra_attr_%d' % i, 'extra value %d' % i) for i in range(200))
+
+Case = collections.namedtuple('Case', ['name', 'style', 'formatter_kwargs', 'record'])
+
+FORMATTERS = [
+    ('ColorFormatter', color_bucket_logger.ColorFormatter, {}),
+    ('TermFormatter', color_bucket_logger.TermFormatter, {}),
+    ('ColorFormatter(compile_format)', color_bucket_logger.ColorFormatter, {'compile_format': True}),
+    ('ColorFormatter(compile_format=False)', color_bucket_logger.ColorFormatter, {'compile_format': False}),
+]
+
+
+class CountingLogRecord(logging.LogRecord):
+    """A LogRecord that counts how many times getMessage() renders msg % args"""
+    get_message_calls = 0
+
+    def getMessage(self):
+        CountingLogRecord.get_message_calls += 1
+        return logging.LogRecord.getMessage(self)
+
+
+def make_record(name='bench.logger', level=logging.INFO, msg='A log message %s', args=('blip',),
+                exc_info=None, extra=None, record_class=CountingLogRecord):
+    record = record_class(name, level, __file__, 42, msg, args, exc_info, func='bench_func')
+    for key, value in (extra or {}).items():
+        setattr(record, key, value)
+    return record
+
+
+def make_exc_record():
+    def fail(depth):
+        if depth:
+            fail(depth - 1)
+        raise ValueError('An example exception')
+
+    try:
+        fail(10)
+    except ValueError:
+        return make_record(level=logging.ERROR, msg='It failed', args=(), exc_info=sys.exc_info())
+
+
+def build_cases():
+    records = collections.OrderedDict([
+        ('simple', make_record()),
+        ('exception', make_exc_record()),
+        ('large-extra', make_record(extra=LARGE_EXTRA)),
+        ('large-args', make_record(msg='payload: %s %s', args=LARGE_ARGS)),
+    ])
+
+    base = {'default_color_by_attr': 'name', 'auto_color': False, 'color_groups': []}
+
+    def case(name, style='%', record='simple', **kwargs):
+        formatter_kwargs = dict(base, **kwargs)
+        return Case(name=name, style=style, formatter_kwargs=formatter_kwargs, record=records[record])
+
+    cases = []
+    for style in sorted(FORMATS):
+        cases.append(case('style=%s' % style, style=style))
+    for auto_color in (False, True):
+        cases.append(case('auto_color=%s' % auto_color, auto_color=auto_color))
+    for number_of_groups in sorted(COLOR_GROUPS):
+        cases.append(case('color_groups=%s' % number_of_groups, color_groups=COLOR_GROUPS[number_of_groups]))
+    for attr in ('name', 'process', 'threadName', 'message'):
+        cases.append(case('default_color_by_attr=%s' % attr, default_color_by_attr=attr))
+    for record_name in records:
+        cases.append(case('record=%s' % record_name, record=record_name))
+    return cases
+
+
+def format_func(formatter, record):
+    if record.exc_info:
+        # logging.Formatter caches the traceback on the record, ColorFormatter doesn't,
+        # so make them both render it each time.
+        def _format():
+            record.exc_text = None
+            return formatter.format(record)
+        return _format
+    return lambda: formatter.format(record)
+
+
+def time_format(func, number, repeat):
+    """Return the best ns per call of func over repeat runs of number calls"""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def alloc_per_record(func, records=1000, warmup=10):
+    """Return the (peak bytes, kept bytes) per call of func
+
+    The peak is the median over records calls of how far traced memory rose above
+    its level at the start of the call, after tracemalloc.reset_peak(): the
+    temporary strings, dicts and tuples func builds on its way to the result. The
+    kept bytes are the traced memory still allocated after records calls whose
+    results are discarded, divided by records, so only what func holds on to
+    (cache entries for example) counts.
+    The peak is None before Python 3.9 (no reset_peak()) and both are None when
+    tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        return None, None
+
+    for _i in range(warmup):
+        func()
+    tracemalloc.start()
+    try:
+        peak_bytes = None
+        if hasattr(tracemalloc, 'reset_peak'):
+            peaks = []
+            for _i in range(records):
+                tracemalloc.reset_peak()
+                start = tracemalloc.get_traced_memory()[0]
+                func()
+                peaks.append(tracemalloc.get_traced_memory()[1] - start)
+            peaks.sort()
+            peak_bytes = float(peaks[len(peaks) // 2])
+
+        start = tracemalloc.get_traced_memory()[0]
+        for _i in range(records):
+            func()
+        kept_bytes = (tracemalloc.get_traced_memory()[0] - start) / float(records)
+    finally:
+        tracemalloc.stop()
+    return peak_bytes, kept_bytes
+
+
+def get_message_calls(func):
+    CountingLogRecord.get_message_calls = 0
+    func()
+    return CountingLogRecord.get_message_calls
+
+
+def measure(formatter_name, func, number, repeat):
+    ns_per_record = time_format(func, number, repeat)
+    peak_bytes, kept_bytes = alloc_per_record(func)
+    return {'formatter': formatter_name,
+            'ns_per_record': ns_per_record,
+            'records_per_sec': 1e9 / ns_per_record,
+            'peak_bytes_per_record': peak_bytes,
+            'kept_bytes_per_record': kept_bytes,
+            'get_message_calls_per_record': get_message_calls(func)}
+
+
+def run_case(case, number, repeat):
+    fmt = FORMATS[case.style]
+    kwargs = {'fmt': fmt}
+    if case.style != '%':
+        kwargs['style'] = case.style
+    baseline = measure('logging.Formatter', format_func(logging.Formatter(**kwargs), case.record), number, repeat)
+    baseline['relative_to_stdlib'] = 1.0
+
+    results = [baseline]
+    for formatter_name, formatter_class, formatter_kwargs in FORMATTERS:
+        if case.style != '%':
+            if formatter_class is color_bucket_logger.TermFormatter:
+                # TermFormatter only does '%' style
+                continue
+            formatter_kwargs = dict(formatter_kwargs, style=case.style)
+        formatter = formatter_class(fmt=fmt, **dict(case.formatter_kwargs, **formatter_kwargs))
+        result = measure(formatter_name, format_func(formatter, case.record), number, repeat)
+        result['relative_to_stdlib'] = result['ns_per_record'] / baseline['ns_per_record']
+        results.append(result)
+
+    for result in results:
+        result['case'] = case.name
+        result['style'] = case.style
+    return results
+
+
+def style_parity(results):
+    """Return the '{' style ns/record relative to the '%' style ns/record for each formatter"""
+    style_ns = collections.defaultdict(dict)
+    for result in results:
+        if result['case'].startswith('style='):
+            style_ns[result['formatter']][result['style']] = result['ns_per_record']
+    return dict((formatter_name, ns['{'] / ns['%']) for formatter_name, ns in style_ns.items()
+                if '{' in ns and '%' in ns)
+
+
+def print_results(results):
+    columns = '%-28s %-38s %12s %12s %10s %12s %10s %12s'
+    print(columns % ('case', 'formatter', 'records/s', 'ns/record', 'x stdlib', 'peak B/rec', 'kept B/rec', 'getMessage'))
+    for result in results:
+        peak_bytes = result['peak_bytes_per_record']
+        kept_bytes = result['kept_bytes_per_record']
+        print(columns % (result['case'], result['formatter'],
+                         '%.0f' % result['records_per_sec'],
+                         '%.0f' % result['ns_per_record'],
+                         '%.2f' % result['relative_to_stdlib'],
+                         '-' if peak_bytes is None else '%.0f' % peak_bytes,
+                         '-' if kept_bytes is None else '%.0f' % kept_bytes,
+                         result['get_message_calls_per_record']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help='records formatted per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best is reported')
+    parser.add_argument('--filter', default=None, help='only run cases whose name contains FILTER')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results as JSON to JSON_FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for case in build_cases():
+        if args.filter and args.filter not in case.name:
+            continue
+        results.extend(run_case(case, args.number, args.repeat))
+
+    parity = style_parity(results)
+
+    if args.json_file != '-':
+        print_results(results)
+        if parity:
+            print()
+            print("'{' style vs '%' style")
+            for formatter_name in sorted(parity):
+                print('%-38s %7.2fx' % (formatter_name, parity[formatter_name]))
+
+    if args.json_file:
+        report = {'meta': {'color_bucket_logger_version': color_bucket_logger.__version__,
+                           'python': platform.python_version(),
+                           'implementation': platform.python_implementation(),
+                           'platform': platform.platform(),
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                           'number': args.number,
+                           'repeat': args.repeat},
+                  'results': results,
+                  'style_parity': parity}
+        if args.json_file == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json_file, 'w') as json_fd:
+                json.dump(report, json_fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Benchmarks for the color_bucket_logger color hash functions
+
+Times each hash function in color_bucket_logger.hashing over strings of
+increasing length, then reports how each one spreads typical sets of values
+(sequential thread names, logger names, pids, anagrams) over the colors of a
+palette (the default xterm256 one, or any of color_bucket_logger.palettes).
+
+Run from a source checkout::
+
+    python benchmarks/bench_hash.py
+    python benchmarks/bench_hash.py --json results.json
+    python benchmarks/bench_hash.py --palette truecolor-dark
+
+For the distribution of each set of values it reports:
+
+    buckets
+        How many different colors the values got
+    max load
+        The most values that got the same color
+    chi2
+        The chi-squared statistic of the color counts against a uniform spread
+        (about the number of colors for a good hash, much higher for a bad one)
+    adjacent
+        The fraction of consecutive values (Thread-1, Thread-2) whose colors are the
+        same or next to each other in the palette
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+# So the benchmarks run against the checkout they are in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import color_bucket_logger  # noqa: E402
+from color_bucket_logger import hashing, palettes  # noqa: E402
+
+LENGTHS = [4, 16, 64, 256, 1024]
+
+
+def value_sets():
+    return collections.OrderedDict([
+        ('threadName', ['Thread-%d' % i for i in range(1, 201)]),
+        ('processName', ['ForkPoolWorker-%d' % i for i in range(1, 201)]),
+        ('pid', [str(pid) for pid in range(31000, 31200)]),
+        ('logger name', ['myapp.%s.%s' % (package, module)
+                         for package in ('api', 'db', 'models', 'views', 'utils')
+                         for module in ('base', 'core', 'handlers', 'helpers', 'client', 'server',
+                                        'cache', 'config', 'events', 'tasks', 'auth', 'admin',
+                                        'forms', 'urls', 'signals', 'serializers', 'middleware',
+                                        'queries', 'schema', 'tests', 'errors', 'session',
+                                        'storage', 'worker', 'jobs', 'mail', 'metrics', 'search',
+                                        'static', 'templates', 'users', 'util', 'validators',
+                                        'versions', 'web', 'wsgi', 'xml', 'yaml', 'zip', 'zone')]),
+        ('anagrams', [''.join(chars) for chars in itertools.islice(itertools.permutations('listener'), 200)]),
+    ])
+
+
+def time_hash(hash_function, length, number, repeat):
+    """Return the best ns per call of hash_function on a str of length chars"""
+    value = ('color_bucket_logger' * (length // 19 + 1))[:length]
+    timer = timeit.Timer(lambda: hash_function(value))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def distribution(hash_function, values, palette):
+    number_of_colors = palette.number_of_colors
+    colors = [hash_function(value) % number_of_colors for value in values]
+    counts = collections.Counter(colors)
+
+    expected = len(values) / float(number_of_colors)
+    chi2 = sum((counts.get(color, 0) - expected) ** 2 / expected for color in range(number_of_colors))
+
+    adjacent = sum(1 for color, next_color in zip(colors, colors[1:]) if abs(color - next_color) <= 1)
+
+    return {'values': len(values),
+            'buckets': len(counts),
+            'max_load': max(counts.values()),
+            'chi2': chi2,
+            'adjacent_fraction': adjacent / float(len(values) - 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best is reported')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results as JSON to JSON_FILE ('-' for stdout)")
+    parser.add_argument('--palette', default=palettes.DEFAULT_PALETTE, choices=sorted(palettes.PALETTES),
+                        help='the palette to report the distribution over')
+    args = parser.parse_args(argv)
+
+    palette = palettes.get_palette(args.palette)
+    hash_names = sorted(hashing.HASH_FUNCTIONS)
+
+    speed = []
+    for hash_name in hash_names:
+        for length in LENGTHS:
+            speed.append({'hash_function': hash_name,
+                          'length': length,
+                          'ns_per_hash': time_hash(hashing.HASH_FUNCTIONS[hash_name], length, args.number, args.repeat)})
+
+    spread = []
+    for set_name, values in value_sets().items():
+        for hash_name in hash_names:
+            result = distribution(hashing.HASH_FUNCTIONS[hash_name], values, palette)
+            result.update({'hash_function': hash_name, 'values_set': set_name})
+            spread.append(result)
+
+    if args.json_file != '-':
+        print('%-12s %8s %12s' % ('hash', 'length', 'ns/hash'))
+        for result in speed:
+            print('%-12s %8d %12.0f' % (result['hash_function'], result['length'], result['ns_per_hash']))
+        print()
+        print('%s, %d colors' % (args.palette, palette.number_of_colors))
+        columns = '%-14s %-12s %8s %8s %10s %10s %10s'
+        print(columns % ('values', 'hash', 'count', 'buckets', 'max load', 'chi2', 'adjacent'))
+        for result in spread:
+            print(columns % (result['values_set'], result['hash_function'], result['values'], result['buckets'],
+                             result['max_load'], '%.1f' % result['chi2'], '%.2f' % result['adjacent_fraction']))
+
+    if args.json_file:
+        report = {'meta': {'color_bucket_logger_version': color_bucket_logger.__version__,
+                           'python': platform.python_version(),
+                           'implementation': platform.python_implementation(),
+                           'platform': platform.platform(),
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                           'number': args.number,
+                           'repeat': args.repeat,
+                           'palette': args.palette,
+                           'number_of_colors': palette.number_of_colors},
+                  'speed': speed,
+                  'distribution': spread}
+        if args.json_file == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json_file, 'w') as json_fd:
+                json.dump(report, json_fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
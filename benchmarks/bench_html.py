@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Benchmarks for the color_bucket_logger HTML formatter
+
+Formats a set of records (a mix of logger names, threads, levels, and messages
+with characters that need HTML escaping) with HtmlFormatter using CSS classes,
+HtmlFormatter with inline styles, HtmlFormatter without colors (just escaped),
+and TermFormatter for comparison.
+
+Run from a source checkout::
+
+    python benchmarks/bench_html.py
+    python benchmarks/bench_html.py --palette truecolor-dark --json results.json
+
+For each formatter it reports the bytes per formatted record (utf-8, including the
+newline a handler adds), the size relative to the plain escaped text, ns/record,
+and, for the CSS class version, the size of the stylesheet the page needs once.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import timeit
+
+# So the benchmarks run against the checkout they are in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import color_bucket_logger  # noqa: E402
+from color_bucket_logger import palettes  # noqa: E402
+
+FORMAT = '%(asctime)s %(levelname)-8s %(processName)s %(threadName)s %(name)s %(funcName)s:%(lineno)d - %(message)s'
+
+LEVELS = (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR)
+
+MESSAGES = [('GET %s -> %d', ('/api/users?id=1&page=2', 200)),
+            ('Loaded <%s> in %.2fms', ('config.yml', 12.5)),
+            ('Connection closed', ()),
+            ('Query returned %d rows', (42,))]
+
+
+def make_records(count):
+    records = []
+    for index in range(count):
+        msg, args = MESSAGES[index % len(MESSAGES)]
+        record = logging.LogRecord('myapp.%s' % ('api', 'db', 'models', 'views', 'worker')[index % 5],
+                                   LEVELS[index % len(LEVELS)], __file__, 10 + index % 7, msg, args, None,
+                                   func='handler')
+        record.threadName = 'Thread-%d' % (index % 8)
+        record.thread = 1000 + index % 8
+        records.append(record)
+    return records
+
+
+def formatters(palette):
+    kwargs = {'fmt': FORMAT, 'auto_color': True, 'palette': palette}
+    return [
+        ('html classes', color_bucket_logger.HtmlFormatter(**kwargs)),
+        ('html inline', color_bucket_logger.HtmlFormatter(inline_styles=True, **kwargs)),
+        ('html plain', color_bucket_logger.HtmlFormatter(colorize=False, **kwargs)),
+        ('term', color_bucket_logger.TermFormatter(colorize=True, **kwargs)),
+    ]
+
+
+def measure(formatter, records, repeat):
+    size = sum(len((formatter.format(record) + '\n').encode('utf-8')) for record in records)
+
+    def format_records():
+        for record in records:
+            formatter.format(record)
+
+    seconds = min(timeit.Timer(format_records).repeat(repeat=repeat, number=1))
+    return {'bytes_per_record': size / float(len(records)),
+            'ns_per_record': seconds / len(records) * 1e9}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=2000, help='records per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best is reported')
+    parser.add_argument('--palette', default=palettes.DEFAULT_PALETTE, choices=sorted(palettes.PALETTES),
+                        help='the palette the colors come from')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results as JSON to JSON_FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    records = make_records(args.records)
+
+    results = []
+    stylesheet_bytes = None
+    for formatter_name, formatter in formatters(args.palette):
+        result = measure(formatter, records, args.repeat)
+        result['formatter'] = formatter_name
+        results.append(result)
+        if formatter_name == 'html classes':
+            stylesheet_bytes = len(formatter.stylesheet().encode('utf-8'))
+
+    plain_size = [result['bytes_per_record'] for result in results if result['formatter'] == 'html plain'][0]
+    for result in results:
+        result['relative_size'] = result['bytes_per_record'] / plain_size
+
+    if args.json_file != '-':
+        print('%-14s %14s %10s %12s' % ('formatter', 'bytes/record', 'vs plain', 'ns/record'))
+        for result in results:
+            print('%-14s %14.1f %9.2fx %12.0f' % (result['formatter'], result['bytes_per_record'],
+                                                  result['relative_size'], result['ns_per_record']))
+        print()
+        print('stylesheet: %d bytes, once per page' % stylesheet_bytes)
+
+    if args.json_file:
+        report = {'meta': {'color_bucket_logger_version': color_bucket_logger.__version__,
+                           'python': platform.python_version(),
+                           'implementation': platform.python_implementation(),
+                           'platform': platform.platform(),
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                           'records': args.records,
+                           'repeat': args.repeat,
+                           'palette': args.palette,
+                           'stylesheet_bytes': stylesheet_bytes},
+                  'results': results}
+        if args.json_file == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json_file, 'w') as json_fd:
+                json.dump(report, json_fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
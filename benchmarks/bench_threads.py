@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""Benchmarks for formatting log records from many threads with one shared formatter
+
+Logs the records of examples/gen_log_entries.run_threaded (which starts two threads
+per thread_count, each logging a mix of records, some with tracebacks) to a handler
+whose formatter is shared by all of the threads, for increasing thread counts.
+
+The handler only formats the records, and does it without holding the handler lock
+(logging.Handler.handle() holds it around emit()), so the threads only share the
+formatter.
+
+Run from a source checkout::
+
+    python benchmarks/bench_threads.py
+    python benchmarks/bench_threads.py --thread-counts 1 2 4 8 16 --json results.json
+
+For each formatter it reports the records/s for each number of threads (2 to 16 by
+default), and the speedup over the first thread count. On a Python with the GIL the
+records/s can not go up with more threads, the benchmark is for checking the scaling
+on a free-threaded (no GIL) build, with and without free_threaded=True.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+# So the benchmarks run against the checkout they are in, and can use the examples
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples'))
+
+import color_bucket_logger  # noqa: E402
+from color_bucket_logger import formatter as cbl_formatter  # noqa: E402
+import gen_log_entries  # noqa: E402
+
+FORMAT = ('%(asctime)s %(levelname)-8s %(processName)s %(threadName)s %(name)s'
+          ' tsx_id=%(tsx_id)s %(funcName)s:%(lineno)d - %(message)s')
+
+FORMATTERS = [
+    ('TermFormatter', color_bucket_logger.TermFormatter, {'free_threaded': False}),
+    ('TermFormatter(free_threaded)', color_bucket_logger.TermFormatter, {'free_threaded': True}),
+]
+
+
+class FormatHandler(logging.Handler):
+    """Formats each record and throws the result away, without taking the handler lock"""
+
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level=level)
+        self.count = 0
+        self.counting = False
+
+    def handle(self, record):
+        if not self.filter(record):
+            return False
+        self.format(record)
+        if self.counting:
+            self.count += 1
+        return True
+
+
+def setup_logging(handler):
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+
+
+def count_records(handler, thread_count):
+    """Return the number of records one iteration of run_threaded(thread_count) logs"""
+    handler.count = 0
+    handler.counting = True
+    try:
+        gen_log_entries.run_threaded(thread_count=thread_count, iterations=1)
+    finally:
+        handler.counting = False
+    return handler.count
+
+
+def time_threads(thread_count, iterations, repeat):
+    """Return the best seconds to run run_threaded(thread_count, iterations=iterations)"""
+    best = None
+    for _run in range(repeat):
+        start = time.time()
+        gen_log_entries.run_threaded(thread_count=thread_count, iterations=iterations)
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--thread-counts', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='the run_threaded thread_counts to time, it starts 2 threads per thread_count')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='the times each thread logs the gen_log_entries records')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs, the best is reported')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help="write the results as JSON to JSON_FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    results = []
+    for formatter_name, formatter_class, formatter_kwargs in FORMATTERS:
+        handler = FormatHandler()
+        handler.setFormatter(formatter_class(fmt=FORMAT, auto_color=True, colorize=True, **formatter_kwargs))
+        setup_logging(handler)
+
+        base_records_per_sec = None
+        for thread_count in args.thread_counts:
+            records = count_records(handler, thread_count) * args.iterations
+            seconds = time_threads(thread_count, args.iterations, args.repeat)
+            records_per_sec = records / seconds
+            if base_records_per_sec is None:
+                base_records_per_sec = records_per_sec
+            results.append({'formatter': formatter_name,
+                            'threads': thread_count * 2,
+                            'records': records,
+                            'seconds': seconds,
+                            'records_per_sec': records_per_sec,
+                            'speedup': records_per_sec / base_records_per_sec})
+
+    if args.json_file != '-':
+        print('%d cpus, GIL %s' % (multiprocessing.cpu_count(), 'disabled' if cbl_formatter.GIL_DISABLED else 'enabled'))
+        print('%-30s %8s %10s %12s %8s' % ('formatter', 'threads', 'records', 'records/s', 'speedup'))
+        for result in results:
+            print('%-30s %8d %10d %12.0f %7.2fx' % (result['formatter'], result['threads'], result['records'],
+                                                    result['records_per_sec'], result['speedup']))
+
+    if args.json_file:
+        report = {'meta': {'color_bucket_logger_version': color_bucket_logger.__version__,
+                           'python': platform.python_version(),
+                           'implementation': platform.python_implementation(),
+                           'platform': platform.platform(),
+                           'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                           'cpus': multiprocessing.cpu_count(),
+                           'gil_disabled': cbl_formatter.GIL_DISABLED,
+                           'iterations': args.iterations,
+                           'repeat': args.repeat},
+                  'results': results}
+        if args.json_file == '-':
+            json.dump(report, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json_file, 'w') as json_fd:
+                json.dump(report, json_fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,9 @@ __author__ = """Adrian Likins"""
 __email__ = 'adrian@likins.com'
 __version__ = '0.2.0'
 
-from .formatter import ColorFormatter, TermFormatter, get_default_record_attrs
+from .formatter import ColorFormatter, HtmlFormatter, TermFormatter, get_default_record_attrs
 
 __all__ = ['ColorFormatter',
+           'HtmlFormatter',
            'TermFormatter',
            'get_default_record_attrs']
@@ -0,0 +1,30 @@
+"""Command line tools
+
+    python -m color_bucket_logger colorize --fmt FMT [FILE ...]
+
+See :py:mod:`color_bucket_logger.colorize`.
+"""
+
+import argparse
+import sys
+
+from . import colorize
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m color_bucket_logger')
+    subparsers = parser.add_subparsers(dest='command')
+
+    colorize_parser = subparsers.add_parser('colorize', help='colorize plain text log files written with a known format')
+    colorize.add_arguments(colorize_parser)
+    colorize_parser.set_defaults(run=colorize.run)
+
+    args = parser.parse_args(argv)
+    if not getattr(args, 'run', None):
+        parser.print_help()
+        return 2
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,359 @@
+"""Caches used by the color mappers
+
+The color for a value only depends on the value (and the mapper config),
+and the same values (logger names, thread names, etc) show up over and over,
+so the mappers memoize them.
+
+Since some record attributes can have very high cardinality (a transaction
+id passed in via 'extra' for example), the caches are bounded.
+
+The rendered traceback for a record with exc_info can also be shared by all
+the formatters that format it (see ExcTextCache).
+
+An LRUCache takes a lock (and reorders its items) on every lookup. That is
+cheap with the GIL, but on a free-threaded Python build, threads formatting
+with the same formatter would all contend on it. A ThreadLocalCache puts a
+small unlocked cache per thread in front of a shared LRUCache, so the shared
+cache is only used for values a thread has not seen yet.
+"""
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+# All of the cache instances, so they can be reset in a forked child
+_caches = weakref.WeakSet()
+
+_missing = object()
+
+if hasattr(OrderedDict, 'move_to_end'):
+    _LRUDict = OrderedDict
+else:
+    class _LRUDict(OrderedDict):
+        """A py2 OrderedDict with the py3 move_to_end() (last=True only)"""
+
+        def move_to_end(self, key):
+            self[key] = self.pop(key)
+
+
+def _reset_caches_after_fork():
+    for lru_cache in list(_caches):
+        lru_cache._reset_after_fork()
+
+
+class LRUCache(object):
+    """A thread safe, size bounded, least recently used cache
+
+    Parameters
+    ----------
+    maxsize : int
+        The max number of items to keep. When a new item would exceed
+        maxsize, the least recently used item is evicted.
+    clear_after_fork : boolean, optional
+        If true, a forked child process starts with an empty cache. For
+        caches of values that depend on the process, like the pid. Needs
+        os.register_at_fork (Python 3.7+); before that the child keeps the
+        parent's entries.
+    """
+
+    def __init__(self, maxsize, clear_after_fork=False):
+        self.maxsize = maxsize
+        self.clear_after_fork = clear_after_fork
+        self._data = _LRUDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        _caches.add(self)
+
+    def __repr__(self):
+        return '%s(maxsize=%s)' % (self.__class__.__name__, self.maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if it is not cached
+
+        Raises TypeError if key is not hashable."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache value for key, evicting the least recently used item if needed"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all items and reset the statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def reset_stats(self):
+        """Zero the hit, miss, and eviction counts, without clearing the cache"""
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def _reset_after_fork(self):
+        # Another thread could have been holding the lock when the process forked,
+        # in which case it would never be released in the child.
+        self._lock = threading.Lock()
+        if self.clear_after_fork:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return a dict of the cache 'hits', 'misses', 'evictions', 'size', and 'maxsize'"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+                'maxsize': self.maxsize}
+
+
+class _ThreadCache(object):
+    # One thread's items and counts, only ever modified by that thread
+    __slots__ = ('data', 'hits', 'clears')
+
+    def __init__(self):
+        self.data = {}
+        self.hits = 0
+        self.clears = 0
+
+
+class _ThreadAlive(object):
+    # Kept in a thread's threading.local with its _ThreadCache, and only weakly
+    # referenced anywhere else, so it goes away when the thread does
+    __slots__ = ('__weakref__',)
+
+
+class _ThreadCaches(object):
+    # The caches of the live threads, and the counts of the threads that are gone.
+    # A thread's cache is retired by a weakref callback on its _ThreadAlive instead
+    # of a __del__ on the cache: py2 clears an object's weakrefs before calling its
+    # __del__, which leaves a moment where the cache is in neither.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.live = {}
+        self.retired_hits = 0
+        self.retired_clears = 0
+
+    def add(self, alive, thread_cache):
+        with self.lock:
+            self.live[weakref.ref(alive, self._retire)] = thread_cache
+
+    def _retire(self, alive_ref):
+        with self.lock:
+            thread_cache = self.live.pop(alive_ref, None)
+            if thread_cache is not None:
+                self.retired_hits += thread_cache.hits
+                self.retired_clears += thread_cache.clears
+
+    def caches(self):
+        with self.lock:
+            return list(self.live.values())
+
+    def counts(self):
+        """Return the (hits, clears, live threads) of all the thread caches"""
+        with self.lock:
+            thread_caches = list(self.live.values())
+            return (self.retired_hits + sum(thread_cache.hits for thread_cache in thread_caches),
+                    self.retired_clears + sum(thread_cache.clears for thread_cache in thread_caches),
+                    len(thread_caches))
+
+    def reset_counts(self):
+        with self.lock:
+            self.retired_hits = 0
+            self.retired_clears = 0
+            for thread_cache in self.live.values():
+                thread_cache.hits = thread_cache.clears = 0
+
+
+class ThreadLocalCache(object):
+    """A per thread cache in front of a shared :py:class:`LRUCache`
+
+    Lookups check the calling thread's own cache first, without locking, and only
+    go to the shared cache on a miss. Items found in (or added to) the shared cache
+    are copied into the thread's cache. Has the same get() and set() as LRUCache,
+    so it can be used in place of one.
+
+    Each thread's cache holds up to maxsize items. When it is full, it is cleared
+    instead of tracking the least recently used item, since that would need
+    bookkeeping on every lookup. It refills from the shared cache.
+
+    Parameters
+    ----------
+    shared : :py:class:`LRUCache`
+        The cache shared by all the threads
+    maxsize : int, optional
+        The max number of items in each thread's cache. Defaults to shared.maxsize
+    """
+
+    def __init__(self, shared, maxsize=None):
+        self.shared = shared
+        self.maxsize = shared.maxsize if maxsize is None else maxsize
+        self._local = threading.local()
+
+        # The cache of each live thread, for stats() and clear()
+        self._thread_caches = _ThreadCaches()
+
+        _caches.add(self)
+
+    def __repr__(self):
+        return '%s(%r, maxsize=%s)' % (self.__class__.__name__, self.shared, self.maxsize)
+
+    def __len__(self):
+        return len(self.shared)
+
+    def _thread_cache(self):
+        try:
+            return self._local.cache
+        except AttributeError:
+            # Only once per thread
+            thread_cache = self._local.cache = _ThreadCache()
+            alive = self._local.alive = _ThreadAlive()
+            self._thread_caches.add(alive, thread_cache)
+            return thread_cache
+
+    def _store(self, thread_cache, key, value):
+        data = thread_cache.data
+        if len(data) >= self.maxsize:
+            data.clear()
+            thread_cache.clears += 1
+        data[key] = value
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if it is not cached
+
+        Raises TypeError if key is not hashable."""
+        thread_cache = self._thread_cache()
+        try:
+            value = thread_cache.data[key]
+        except KeyError:
+            pass
+        else:
+            thread_cache.hits += 1
+            return value
+
+        value = self.shared.get(key, _missing)
+        if value is _missing:
+            return default
+        self._store(thread_cache, key, value)
+        return value
+
+    def set(self, key, value):
+        """Cache value for key in the shared cache, and the calling thread's cache"""
+        self.shared.set(key, value)
+        self._store(self._thread_cache(), key, value)
+
+    def clear(self):
+        """Remove all items and reset the statistics, of the shared cache and every thread's cache"""
+        self.shared.clear()
+        for thread_cache in self._thread_caches.caches():
+            thread_cache.data.clear()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the hit, miss, and eviction counts, without clearing the cache"""
+        self.shared.reset_stats()
+        self._thread_caches.reset_counts()
+
+    def _reset_after_fork(self):
+        # Only the thread that forked is left
+        self._thread_caches.lock = threading.Lock()
+        if self.shared.clear_after_fork:
+            self._local = threading.local()
+            self._thread_caches = _ThreadCaches()
+
+    def stats(self):
+        """Return a dict of the cache stats
+
+        The 'hits' and 'misses' count lookups found in either the thread or the shared
+        cache, and found in neither. 'size', 'maxsize' and 'evictions' are those of the
+        shared cache. 'thread_hits' and 'thread_clears' are the totals of all the threads'
+        caches, and 'threads' the number of threads with a cache now."""
+        stats = self.shared.stats()
+        thread_hits, thread_clears, threads = self._thread_caches.counts()
+        stats['hits'] += thread_hits
+        stats['thread_hits'] = thread_hits
+        stats['thread_clears'] = thread_clears
+        stats['threads'] = threads
+        return stats
+
+
+class ExcTextCache(object):
+    """A thread safe cache of rendered exception text per LogRecord
+
+    A record is only weakly referenced, so an entry goes away with its record.
+    """
+
+    def __init__(self):
+        self._data = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, record):
+        """Return the exception text cached for record, or None"""
+        with self._lock:
+            exc_text = self._data.get(record)
+            if exc_text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return exc_text
+
+    def set(self, record, exc_text):
+        with self._lock:
+            self._data[record] = exc_text
+
+    def clear(self):
+        """Remove all items and reset the statistics"""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Return a dict of the cache 'hits', 'misses', and 'size'"""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data)}
+
+
+#: The exception text cache shared by all of the formatters created with share_exc_text=True
+EXC_TEXT_CACHE = ExcTextCache()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_caches_after_fork)
@@ -0,0 +1,525 @@
+"""Colorize plain text log files written with a known format string
+
+Logs written without colors (to a file, or with colorize=False) can be colored
+afterwards, with the same colors a ColorFormatter with the same arguments would
+have used::
+
+    python -m color_bucket_logger colorize --fmt '%(asctime)s %(levelname)s %(name)s %(message)s' app.log | less -R
+    tail -f app.log | python -m color_bucket_logger colorize --fmt '...' --line-buffered -
+
+The format string is turned into a regex with a named group per field (see
+:py:func:`format_regex`). A line that matches is split into the field values,
+the values go through the formatter's color mapper like a LogRecord would, and the
+line is put back together with the formatter's color format (so with the same
+color sequences around the same fields as live output). Lines that do not match
+(tracebacks, multi-line messages) are passed through as is.
+
+Lines are read from a large buffered reader and written one at a time, so memory
+use does not depend on the size of the file. The line with the colors filled in
+is cached as a '%' template per set of values the colors depend on, so lines that
+only differ in the message and time are one regex match and one '%' format.
+
+With --jobs N, the input is split into chunks of whole lines (byte ranges of a
+file, or blocks read from stdin) that a pool of N worker processes colorizes,
+and the colored chunks are written in order (see :py:func:`colorize_parallel`).
+Since the colors only depend on the values (and the formatter arguments), every
+worker picks the same colors. Only a few chunks per worker are in flight at once,
+so memory use still does not depend on the size of the input.
+
+The colors match live output for the attributes that are in the format. The
+color of an attribute that is not (the pid, when coloring processName for ex)
+depends on a placeholder value instead, and a '%(levelname)-0.1s' style field
+only has the truncated value to hash.
+"""
+
+import collections
+import errno
+import io
+import logging
+import multiprocessing
+import operator
+import os
+import re
+import sys
+
+from . import formatter as cbl_formatter
+from . import styles
+
+#: Read files with a buffer this big
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+#: The size in bytes of the chunks the --jobs workers colorize
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+#: Forget the cached colors when there are this many
+DEFAULT_COLORS_CACHE_SIZE = 4096
+
+# py3 decodes the lines as utf-8 with surrogateescape, which writes undecodable
+# bytes back out as they were. py2 has no surrogateescape, and colorizes the byte
+# str lines as they are instead.
+_BYTES_LINES = str is bytes
+
+#: The regex that finds the fields of a format string, by style
+FIELD_PATTERNS = {'%': re.compile(styles.PercentStyle.named_fields_pattern),
+                  '{': re.compile(styles.StrFormatStyle.uber_format_pattern)}
+
+_int_conversions = frozenset('diu')
+_float_conversions = frozenset('eEfFgG')
+
+#: The value regexes for attributes whose values are known not to have spaces
+ATTR_PATTERNS = {'levelname': r'\S+',
+                 'name': r'\S+',
+                 'module': r'\S+',
+                 'filename': r'\S+',
+                 'funcName': r'\S+',
+                 'pathname': r'\S+'}
+
+# strftime directives to the regex of what they produce
+_strftime_patterns = {'Y': r'\d{4}', 'y': r'\d\d', 'm': r'\d\d', 'd': r'\d\d', 'H': r'\d\d', 'I': r'\d\d',
+                      'M': r'\d\d', 'S': r'\d\d', 'f': r'\d{6}', 'j': r'\d{3}', 'U': r'\d\d', 'W': r'\d\d',
+                      'w': r'\d', 'a': r'\w+', 'A': r'\w+', 'b': r'\w+', 'B': r'\w+', 'p': r'\w+',
+                      'z': r'[+-]\d{4}', 'Z': r'\w*', '%': '%'}
+_strftime_directive = re.compile(r'%(.)')
+
+#: The values used for attributes a format does not have, but the color mapper needs
+PLACEHOLDER_VALUES = {'name': '',
+                      'levelname': 'NOTSET',
+                      'levelno': logging.NOTSET,
+                      'process': 0,
+                      'processName': 'MainProcess',
+                      'thread': 0,
+                      'threadName': 'MainThread',
+                      'exc_text': None}
+
+
+def datefmt_regex(datefmt=None):
+    """Return a regex that matches the asctime logging renders with datefmt"""
+    if datefmt is None:
+        # logging.Formatter.default_time_format, plus the msecs default_msec_format adds
+        return r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}'
+
+    regex = []
+    pos = 0
+    for match in _strftime_directive.finditer(datefmt):
+        regex.append(re.escape(datefmt[pos:match.start()]))
+        regex.append(_strftime_patterns.get(match.group(1), '.*?'))
+        pos = match.end()
+    regex.append(re.escape(datefmt[pos:]))
+    return ''.join(regex)
+
+
+def _unescape_literal(text, style):
+    if style == '%':
+        return text.replace('%%', '%')
+    return text.replace('{{', '{').replace('}}', '}')
+
+
+def _field_regex(attr_name, conversion_type, width, precision, datefmt):
+    if conversion_type in _int_conversions:
+        value_regex = r'-?\d+'
+    elif conversion_type in _float_conversions:
+        value_regex = r'-?(?:\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|inf|nan)'
+    elif precision:
+        value_regex = r'.{0,%s}' % precision
+    elif attr_name == 'asctime':
+        value_regex = datefmt_regex(datefmt)
+    else:
+        value_regex = ATTR_PATTERNS.get(attr_name, r'.*?')
+
+    if width:
+        # padded on either side, depending on the alignment
+        value_regex = r' *%s *' % value_regex
+    return value_regex
+
+
+def parse_format(fmt, style='%', datefmt=None):
+    """Split a format string into literal text and fields
+
+    Parameters
+    ----------
+    fmt : str
+    style : str, optional
+        '%' (the default) or '{'
+    datefmt : str, optional
+        The datefmt asctime is rendered with
+
+    Returns
+    -------
+    list
+        A (literal_text, None, None, None) tuple for literal text, and an
+        (full_attr, attr_name, value_regex, conversion_type) tuple for each field
+    """
+    parts = []
+    pos = 0
+    for match in FIELD_PATTERNS[style].finditer(fmt):
+        if match.start() > pos:
+            parts.append((_unescape_literal(fmt[pos:match.start()], style), None, None, None))
+        pos = match.end()
+
+        full_attr = match.group('full_attr')
+        attr_name = match.group('attr_name')
+        conversion_type = match.group('conversion_type') or 's'
+        if style == '%':
+            width = match.group('field_width')
+            precision = (match.group('precision') or '').lstrip('.')
+        else:
+            width = match.group('width')
+            precision_match = re.search(r'\.(\d+)', match.group('modifiers'))
+            precision = precision_match.group(1) if precision_match else None
+            if conversion_type == 'n':
+                conversion_type = 'd'
+
+        parts.append((full_attr, attr_name, _field_regex(attr_name, conversion_type, width, precision, datefmt), conversion_type))
+    if pos < len(fmt):
+        parts.append((_unescape_literal(fmt[pos:], style), None, None, None))
+    return parts
+
+
+def format_regex(fmt, style='%', datefmt=None):
+    """Return a compiled regex that matches a line logged with fmt
+
+    Each field is a group named 'f0', 'f1', ... in the order the fields are in fmt.
+    '_cdl_*' color slot fields match ''."""
+    regex = []
+    field_idx = 0
+    for text, attr_name, value_regex, _conversion_type in parse_format(fmt, style=style, datefmt=datefmt):
+        if attr_name is None:
+            regex.append(re.escape(text))
+        elif attr_name.startswith('_cdl_'):
+            # color slots are '' without color
+            continue
+        else:
+            regex.append('(?P<f%d>%s)' % (field_idx, value_regex))
+            field_idx += 1
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+
+def _convert(value, conversion_type):
+    if conversion_type in _int_conversions:
+        return int(value)
+    if conversion_type in _float_conversions:
+        return float(value)
+    return value.strip()
+
+
+class LineColorizer(object):
+    """Colorize lines logged with a format string
+
+    Parameters
+    ----------
+    fmt : str, optional
+        The format string the lines were logged with. Defaults to the
+        :py:class:`color_bucket_logger.ColorFormatter` default format
+    style : str, optional
+        '%' (the default) or '{'
+    datefmt : str, optional
+        The datefmt asctime was rendered with
+    formatter : :py:class:`color_bucket_logger.ColorFormatter`, optional
+        The formatter whose colors to use. If not given, one is created with fmt, style,
+        datefmt and formatter_kwargs (color_groups, auto_color, palette, etc).
+    colors_cache_size : int, optional
+        The number of sets of color field values to remember the colors of
+    """
+
+    def __init__(self, fmt=None, style='%', datefmt=None, formatter=None,
+                 colors_cache_size=DEFAULT_COLORS_CACHE_SIZE, **formatter_kwargs):
+        if formatter is None:
+            formatter = cbl_formatter.ColorFormatter(fmt=fmt, style=style, datefmt=datefmt,
+                                                     colorize=True, **formatter_kwargs)
+        self.formatter = formatter
+        fmt = formatter._base_fmt
+        style = '{' if isinstance(formatter._style, styles.StrFormatStyle) else '%'
+        datefmt = formatter.datefmt
+
+        self.regex = format_regex(fmt, style=style, datefmt=datefmt)
+
+        self._fields = [(attr_name, conversion_type)
+                        for _text, attr_name, _value_regex, conversion_type in parse_format(fmt, style=style, datefmt=datefmt)
+                        if attr_name is not None and not attr_name.startswith('_cdl_')]
+
+        # The line is put back together with the formatter's color format. Each item
+        # is (0, literal text), (1, color slot) or (2, None) for the next field.
+        self._template = []
+        for text, attr_name, _value_regex, _conversion_type in parse_format(formatter._style.color_fmt, style=style, datefmt=datefmt):
+            if attr_name is None:
+                self._template.append((0, text))
+            elif attr_name.startswith('_cdl_'):
+                self._template.append((1, attr_name))
+            else:
+                self._template.append((2, None))
+
+        color_mapper = formatter.color_mapper
+        input_attrs = set(color_mapper.plan.input_attrs)
+        if color_mapper.plan.uses_message:
+            input_attrs.add('message')
+        # The indexes of the fields whose values the colors depend on
+        color_fields = [field_idx for field_idx, (attr_name, _conversion_type) in enumerate(self._fields)
+                        if attr_name in input_attrs or (attr_name == 'levelno' and 'levelname' in input_attrs)]
+        self._color_key = operator.itemgetter(*color_fields) if color_fields else lambda groups: None
+
+        # The line templates for each set of color field values. A line template is the
+        # color format with the colors filled in and a '%s' for each field.
+        self.colors_cache_size = colors_cache_size
+        self._line_templates = {}
+
+    def colors_for_values(self, values):
+        """Return the formatter's color sequences for a dict of field values, by '_cdl_*' slot"""
+        record_context = dict(PLACEHOLDER_VALUES)
+        record_context.update(values)
+
+        if 'levelname' in values and 'levelno' not in values:
+            levelno = logging.getLevelName(values['levelname'])
+            record_context['levelno'] = levelno if isinstance(levelno, int) else logging.NOTSET
+        elif 'levelno' in values and 'levelname' not in values:
+            record_context['levelname'] = logging.getLevelName(values['levelno'])
+        if 'message' in values:
+            record_context['_cdl_xmessage'] = values['message']
+
+        return self.formatter.color_mapper.get_colors_for_record(record_context, self.formatter._style._format_attrs)
+
+    def line_template(self, groups):
+        """Return the '%' template that renders a line with the field values groups in color"""
+        values = {}
+        for (attr_name, conversion_type), value in zip(self._fields, groups):
+            try:
+                values[attr_name] = _convert(value, conversion_type)
+            except ValueError:
+                values[attr_name] = value
+        colors = self.colors_for_values(values)
+
+        return ''.join([value.replace('%', '%%') if kind == 0 else colors[value].replace('%', '%%') if kind == 1 else '%s'
+                        for kind, value in self._template])
+
+    def colorize_line(self, line):
+        """Return line with colors, or as is if it does not match the format"""
+        text = line.rstrip('\r\n')
+        match = self.regex.match(text)
+        if match is None:
+            return line
+
+        groups = match.groups()
+        key = self._color_key(groups)
+        line_template = self._line_templates.get(key)
+        if line_template is None:
+            line_template = self.line_template(groups)
+            if len(self._line_templates) >= self.colors_cache_size:
+                self._line_templates.clear()
+            self._line_templates[key] = line_template
+
+        return line_template % groups + line[len(text):]
+
+    def colorize_text(self, text):
+        """Return text, a str of whole lines, with each line colorized"""
+        # Split like reading from open_text() does, so the output is the same
+        colorize_line = self.colorize_line
+        lines = io.BytesIO(text) if isinstance(text, bytes) else io.StringIO(text, newline='')
+        return ''.join([colorize_line(line) for line in lines])
+
+    def colorize_stream(self, in_stream, out_stream, line_buffered=False):
+        """Colorize each line of the text stream in_stream, writing them to out_stream
+
+        If line_buffered, out_stream is flushed after every line."""
+        colorize_line = self.colorize_line
+        write = out_stream.write
+        for line in in_stream:
+            write(colorize_line(line))
+            if line_buffered:
+                out_stream.flush()
+        out_stream.flush()
+
+
+def open_text(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Open a log file (or stdin for '-') for reading text, passing undecodable bytes through"""
+    if _BYTES_LINES:
+        if path == '-':
+            return io.open(sys.stdin.fileno(), 'rb', buffering=buffer_size, closefd=False)
+        return io.open(path, 'rb', buffering=buffer_size)
+    if path == '-':
+        raw = getattr(sys.stdin, 'buffer', sys.stdin)
+        return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogateescape', newline='')
+    return io.open(path, 'r', buffering=buffer_size, encoding='utf-8', errors='surrogateescape', newline='')
+
+
+def open_output(line_buffered=False):
+    """Return a text stream writing to stdout, that writes back any bytes open_text() passed through"""
+    if _BYTES_LINES:
+        # colorize_stream() flushes after each line when line_buffered
+        sys.stdout.flush()
+        return io.open(sys.stdout.fileno(), 'wb', closefd=False)
+    raw = getattr(sys.stdout, 'buffer', sys.stdout)
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='surrogateescape', newline='',
+                            line_buffering=line_buffered)
+
+
+def file_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield (path, start, end) byte ranges of about chunk_size that cover the file at path, split after a newline"""
+    with io.open(path, 'rb') as chunk_fd:
+        size = os.fstat(chunk_fd.fileno()).st_size
+        start = 0
+        while start < size:
+            chunk_fd.seek(start + chunk_size)
+            chunk_fd.readline()
+            end = min(chunk_fd.tell(), size)
+            yield (path, start, end)
+            start = end
+
+
+def stream_chunks(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield blocks of about chunk_size bytes of whole lines read from the binary stream"""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith(b'\n'):
+            chunk += stream.readline()
+        yield chunk
+
+
+_worker_colorizer = None
+
+
+def _init_worker(colorizer_kwargs):
+    global _worker_colorizer
+    _worker_colorizer = LineColorizer(**colorizer_kwargs)
+
+
+def _colorize_chunk(chunk):
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with io.open(path, 'rb') as chunk_fd:
+            chunk_fd.seek(start)
+            chunk = chunk_fd.read(end - start)
+    if _BYTES_LINES:
+        return _worker_colorizer.colorize_text(chunk)
+    text = chunk.decode('utf-8', 'surrogateescape')
+    return _worker_colorizer.colorize_text(text).encode('utf-8', 'surrogateescape')
+
+
+def colorize_parallel(chunks, out_stream, jobs, colorizer_kwargs):
+    """Colorize chunks in a pool of jobs worker processes, writing the results to out_stream in order
+
+    Parameters
+    ----------
+    chunks : iterable
+        (path, start, end) byte ranges from :py:func:`file_chunks`, or bytes from
+        :py:func:`stream_chunks`
+    out_stream : binary file
+    jobs : int
+        The number of worker processes
+    colorizer_kwargs : dict
+        The arguments each worker creates its LineColorizer with
+    """
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(colorizer_kwargs,))
+    try:
+        # A bounded window of chunks instead of pool.imap(), so chunks are not read
+        # (or results kept) faster than out_stream takes them.
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_colorize_chunk, (chunk,)))
+            if len(pending) >= jobs * 2:
+                out_stream.write(pending.popleft().get())
+        while pending:
+            out_stream.write(pending.popleft().get())
+        out_stream.flush()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _color_group(value):
+    # 'leader:member1,member2'
+    leader, _sep, members = value.partition(':')
+    return (leader, [member for member in members.split(',') if member])
+
+
+def add_arguments(parser):
+    """Add the colorize command line arguments to an argparse parser"""
+    parser.add_argument('files', nargs='*', default=['-'], metavar='FILE',
+                        help="log files to colorize, '-' for stdin (the default)")
+    parser.add_argument('--fmt', default=None,
+                        help='the format string the logs were written with')
+    parser.add_argument('--style', default='%', choices=sorted(styles._STYLES),
+                        help='the style of the format string')
+    parser.add_argument('--datefmt', default=None,
+                        help='the datefmt asctime was written with')
+    parser.add_argument('--default-color-by-attr', default=None,
+                        help='the attribute whose color is the default color')
+    parser.add_argument('--color-group', dest='color_groups', action='append', type=_color_group, default=None,
+                        metavar='LEADER:MEMBER,...', help='a color group, can be given more than once')
+    parser.add_argument('--auto-color', action='store_true', default=False,
+                        help='give every attribute its own color')
+    parser.add_argument('--palette', default=None,
+                        help="the palette, 'xterm256' (the default), 'truecolor-dark' or 'truecolor-light'")
+    parser.add_argument('--hash-function', default=None,
+                        help="the color hash, 'crc32' (the default) or 'sum'")
+    parser.add_argument('--line-buffered', action='store_true', default=False,
+                        help='flush the output after every line (for tail -f)')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE,
+                        help='the read buffer size in bytes')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='colorize with this many worker processes (not with --line-buffered)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='the size in bytes of the chunks the --jobs workers colorize')
+
+
+def run(args):
+    """Colorize the files from parsed add_arguments() arguments to stdout"""
+    colorizer_kwargs = dict(fmt=args.fmt,
+                            style=args.style,
+                            datefmt=args.datefmt,
+                            default_color_by_attr=args.default_color_by_attr,
+                            color_groups=args.color_groups,
+                            auto_color=args.auto_color,
+                            palette=args.palette,
+                            hash_function=args.hash_function)
+
+    try:
+        if args.jobs > 1 and not args.line_buffered:
+            _run_parallel(args, colorizer_kwargs)
+        else:
+            _run(args, colorizer_kwargs)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # The pager quit. Point stdout at devnull so the interpreter's flush at exit does not fail too.
+        sys.stdout = open(os.devnull, 'w')
+    return 0
+
+
+def _run(args, colorizer_kwargs):
+    colorizer = LineColorizer(**colorizer_kwargs)
+
+    out_stream = open_output(line_buffered=args.line_buffered)
+    for path in args.files:
+        in_stream = open_text(path, buffer_size=args.buffer_size)
+        try:
+            colorizer.colorize_stream(in_stream, out_stream, line_buffered=args.line_buffered)
+        finally:
+            _close(in_stream, path)
+    _close(out_stream, '-')
+
+
+def _run_parallel(args, colorizer_kwargs):
+    # Fail early on a bad format, palette, etc, instead of in every worker
+    LineColorizer(**colorizer_kwargs)
+
+    def chunks():
+        for path in args.files:
+            if path == '-':
+                for chunk in stream_chunks(getattr(sys.stdin, 'buffer', sys.stdin), args.chunk_size):
+                    yield chunk
+            else:
+                for chunk in file_chunks(path, args.chunk_size):
+                    yield chunk
+
+    sys.stdout.flush()
+    colorize_parallel(chunks(), getattr(sys.stdout, 'buffer', sys.stdout), args.jobs, colorizer_kwargs)
+
+
+def _close(stream, path):
+    if path != '-':
+        stream.close()
+        return
+    # Leave stdin/stdout open
+    stream.flush()
+    stream.detach()
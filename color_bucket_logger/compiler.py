@@ -0,0 +1,161 @@
+"""Compile log format strings into specialized render functions
+
+The '%' and '{' styles normally format a record with the whole (colorized)
+format string, ie ``color_fmt % record_context``. That looks up every field by
+name in the record context and reparses the format for every record.
+
+compile_format() instead turns a format string into a small Python function
+that looks up each field directly and formats them all with a positional template
+that has the field names stripped out. For example::
+
+    '%(_cdl_levelname)s%(levelname)-8s%(_cdl_unset)s: %(message)s'
+
+becomes roughly::
+
+    def render(ctx, rd):
+        return '%s%-8s%s: %s' % (ctx['_cdl_levelname'],
+                                 rd['levelname'] if 'levelname' in rd else ctx['levelname'],
+                                 ctx['_cdl_unset'],
+                                 ctx['message'])
+
+where ctx is the :py:class:`color_bucket_logger.context.RecordContext` and rd is
+the record __dict__ it is a view of. The '_cdl_*' color slots and 'message' are
+looked up on the context, everything else on the record first.
+
+Format strings that can not be compiled (positional or '*' width fields, attribute
+or index lookups in '{' fields, nested '{' format specs) compile to None, and the
+styles fall back to normal formatting for them.
+
+The compiled functions are cached per (style, format string), for the
+COMPILED_FORMATS_CACHE_SIZE most recently used ones.
+"""
+
+import re
+import threading
+from string import Formatter as StrFormatter
+
+from . import cache
+
+_str_formatter = StrFormatter()
+
+#: The max number of compiled format strings kept for formatters to share
+COMPILED_FORMATS_CACHE_SIZE = 128
+
+# Bounded, since formats can come from anywhere. None is cached for the formats
+# that can't be compiled, so a miss is _MISSING.
+_compiled_formats = cache.LRUCache(maxsize=COMPILED_FORMATS_CACHE_SIZE)
+_compiled_formats_lock = threading.Lock()
+_MISSING = object()
+
+# A '%%', a named conversion specifier, or any other '%' (which can't be compiled)
+percent_field_pattern = re.compile(r'%(?:%|\((?P<attr_name>[^()]*)\)'
+                                   r'(?P<spec>[#0+ -]*\d*(?:\.\d*)?[hlL]?[diouxXeEfFgGcrsa]))?')
+
+identifier_pattern = re.compile(r'^[A-Za-z_]\w*$')
+
+#: The names that are stored on the RecordContext itself instead of the record
+context_attrs = frozenset(['message'])
+
+
+def _value_expr(attr_name):
+    if attr_name.startswith('_cdl_') or attr_name in context_attrs:
+        return 'ctx[%r]' % attr_name
+    return '(rd[%r] if %r in rd else ctx[%r])' % (attr_name, attr_name, attr_name)
+
+
+def _parse_percent_format(fmt):
+    """Return a positional '%' template and the field names for a '%(name)s' style fmt, or None"""
+    template = []
+    attr_names = []
+    pos = 0
+    for match in percent_field_pattern.finditer(fmt):
+        template.append(fmt[pos:match.start()])
+        pos = match.end()
+        if match.group(0) == '%%':
+            template.append('%%')
+            continue
+        if match.group('spec') is None:
+            # Not a named field ('%d', '%*d', etc)
+            return None
+        template.append('%' + match.group('spec'))
+        attr_names.append(match.group('attr_name'))
+    template.append(fmt[pos:])
+    return ''.join(template), attr_names
+
+
+def _parse_str_format(fmt):
+    """Return a positional '{}' template and the field names for a '{name}' style fmt, or None"""
+    template = []
+    attr_names = []
+    try:
+        parsed = list(_str_formatter.parse(fmt))
+    except ValueError:
+        return None
+
+    for literal_text, field_name, format_spec, conversion in parsed:
+        template.append(literal_text.replace('{', '{{').replace('}', '}}'))
+        if field_name is None:
+            continue
+        if not identifier_pattern.match(field_name) or '{' in format_spec:
+            return None
+        field = '{'
+        if conversion:
+            field += '!' + conversion
+        if format_spec:
+            field += ':' + format_spec
+        template.append(field + '}')
+        attr_names.append(field_name)
+    return ''.join(template), attr_names
+
+
+def _build_render(template, attr_names, style):
+    args = ''.join('%s, ' % _value_expr(attr_name) for attr_name in attr_names)
+    if style == '%':
+        body = '_template %% (%s)' % args
+    else:
+        body = '_template.format(%s)' % args
+
+    source = 'def render(ctx, rd):\n    return %s\n' % body
+    namespace = {'_template': template}
+    exec(compile(source, '<color_bucket_logger compiled format %r>' % template, 'exec'), namespace)
+    render = namespace['render']
+    render.source = source
+    return render
+
+
+def compile_format(fmt, style='%'):
+    """Return a render function for the format string fmt, or None if it can't be compiled
+
+    Parameters
+    ----------
+    fmt : str
+        A (usually colorized) format string
+    style : str, optional
+        '%' or '{'
+
+    Returns
+    -------
+    callable or None
+        A function of (record_context, record_dict) that returns the formatted str
+    """
+    key = (style, fmt)
+    render = _compiled_formats.get(key, _MISSING)
+    if render is not _MISSING:
+        return render
+
+    with _compiled_formats_lock:
+        render = _compiled_formats.get(key, _MISSING)
+        if render is not _MISSING:
+            return render
+
+        if style == '%':
+            parsed = _parse_percent_format(fmt)
+        else:
+            parsed = _parse_str_format(fmt)
+
+        render = None
+        if parsed is not None:
+            render = _build_render(parsed[0], parsed[1], style)
+
+        _compiled_formats.set(key, render)
+        return render
@@ -0,0 +1,43 @@
+"""The record context a ColorFormatter formats a LogRecord with"""
+
+
+class RecordContext(dict):
+    """A layered, read only view of a :py:class:`logging.LogRecord` for formatting
+
+    The items stored in the RecordContext itself are only the values the formatter
+    computes per record (the '_cdl_*' color slots, 'message'). Any other key is looked
+    up in the record's __dict__, and then in a dict of default values for attributes
+    the format string references but the record may not have (see
+    :py:func:`color_bucket_logger.formatter.get_default_record_attrs`).
+
+    That avoids copying the whole record __dict__ (including any 'extra' attributes)
+    for every record a formatter formats. Since it is a dict, it can be used directly
+    with '%' string formatting and :py:meth:`str.format_map`.
+
+    Parameters
+    ----------
+    record_dict : dict
+        The __dict__ of the LogRecord being formatted. It is not modified.
+    defaults : dict
+        Values to use for keys not in the record_dict.
+    """
+    __slots__ = ('record_dict', 'defaults')
+
+    def __init__(self, record_dict, defaults):
+        self.record_dict = record_dict
+        self.defaults = defaults
+
+    def __missing__(self, key):
+        record_dict = self.record_dict
+        if key in record_dict:
+            return record_dict[key]
+        return self.defaults[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.record_dict or key in self.defaults
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -2,11 +2,28 @@
 """
 
 import logging
+import os
 import re
-
+import sys
+import threading
+
+from . import cache
+from . import context
+from . import html_mapper
+from . import mapper
+from . import stats as cbl_stats
 from . import term_mapper
 from . import styles
 
+# logging.Formatter only takes a 'style' since py3.2
+LOGGING_FORMATTER_HAS_STYLE = sys.version_info >= (3, 2)
+
+# logging.Formatter validates the format itself (every time) since py3.8, unless told not to
+LOGGING_FORMATTER_VALIDATES = sys.version_info >= (3, 8)
+
+#: True when running on a free-threaded (no GIL) Python build, with the GIL disabled
+GIL_DISABLED = not getattr(sys, '_is_gil_enabled', lambda: True)()
+
 DEFAULT_FORMAT = ("""%(asctime)-15s"""
                   """ %(levelname)-0.1s"""
                   # If log records are coming from multiproceses into a single handler (say, via a multiprocess queue
@@ -66,11 +83,43 @@ def get_default_record_attrs(record_context, attr_list):
     return defaults_for_attrs
 
 
+def env_allows_color(environ=None):
+    """Return False if the environment asks for no color
+
+    That is, if NO_COLOR is set (to anything but an empty string, see https://no-color.org)
+    or TERM is 'dumb'."""
+    environ = os.environ if environ is None else environ
+    if environ.get('NO_COLOR'):
+        return False
+    if environ.get('TERM') == 'dumb':
+        return False
+    return True
+
+
+def stream_is_tty(stream):
+    """Return True if stream is a terminal"""
+    isatty = getattr(stream, 'isatty', None)
+    if isatty is None:
+        return False
+    try:
+        return bool(isatty())
+    except ValueError:
+        # closed
+        return False
+
+
 class ColorFormatter(logging.Formatter):
     """Base color bucket formatter"""
 
+    #: The class of the color mapper the formatter creates
+    color_mapper_class = term_mapper.TermColorMapper
+
     def __init__(self, fmt=None, default_color_by_attr=None,
-                 color_groups=None, auto_color=False, datefmt=None, style=None):
+                 color_groups=None, auto_color=False, datefmt=None, style=None,
+                 name_cache_size=mapper.DEFAULT_NAME_CACHE_SIZE, compile_format=None,
+                 share_exc_text=False, color_registry=None,
+                 hash_function=None, colorize=None, instrument=False, palette=None,
+                 free_threaded=None):
         fmt = fmt or DEFAULT_FORMAT
         kwargs = dict(fmt=fmt, datefmt=datefmt)
 
@@ -78,29 +127,77 @@ class ColorFormatter(logging.Formatter):
         # but it's needed for py3.
         # TODO: Unless we stop using the logging.Formatter base class at all, which
         #       may be more reasonable at this point.
-        if style:
+        if style and LOGGING_FORMATTER_HAS_STYLE:
             kwargs['style'] = style
+        if LOGGING_FORMATTER_VALIDATES:
+            # The style created below validates the format (raising ValueError), and
+            # only parses it the first time the process sees the format.
+            kwargs['validate'] = False
         logging.Formatter.__init__(self, **kwargs)
 
         # assue % style if not specified. py2 will not specifiy
         style_name = style or '%'
 
         # Override the 'style' set in logging.Formatter.__init__ (for py3)
-        self._style = styles._STYLES[style_name][0](fmt)
+        self._style = styles._STYLES[style_name][0](fmt, compiled=compile_format)
         self._base_fmt = fmt
 
+        # The values used for attributes the format references that a record may
+        # not have. 'stack_info' attr always added for py2/py3 compat
+        self._default_record_attrs = get_default_record_attrs({}, ['stack_info'] + [x[1] for x in self._style._format_attrs] +
+                                                              list(self._style.fields))
+
         self.color_groups = color_groups or []
 
+        # Per thread record contexts and color caches, so threads sharing the formatter do
+        # not contend on anything per record
+        self.free_threaded = GIL_DISABLED if free_threaded is None else free_threaded
+        self._scratch = threading.local() if self.free_threaded else None
+
+        # Share the rendered exception text of a record with the other formatters
+        # (likely on other handlers) that format the same record.
+        self.exc_text_cache = cache.EXC_TEXT_CACHE if share_exc_text else None
+
         # TODO: be able to set the default color by attr name. Ie, make a record default to the thread or processName
         # self.default_color_by_attr = default_color_by_attr or 'process'
         # the name of the record attribute to check for a default color
         # self.default_attr_string = '_cdl_%s' % self.default_color_by_attr
 
-        self.color_mapper = term_mapper.TermColorMapper(fmt=self._base_fmt,
-                                                        default_color_by_attr=default_color_by_attr,
-                                                        color_groups=self.color_groups,
-                                                        format_attrs=self._style._format_attrs,
-                                                        auto_color=auto_color)
+        self.color_mapper = self._create_color_mapper(fmt=self._base_fmt,
+                                                      default_color_by_attr=default_color_by_attr,
+                                                      color_groups=self.color_groups,
+                                                      format_attrs=self._style._format_attrs,
+                                                      auto_color=auto_color,
+                                                      name_cache_size=name_cache_size,
+                                                      color_registry=color_registry,
+                                                      hash_function=hash_function,
+                                                      palette=palette,
+                                                      free_threaded=self.free_threaded)
+
+        # The fields the format uses. The format_attrs (the fields that get colors) leave out
+        # some, like a '%(message)r' or '{message!r}' field.
+        format_attr_names = set(x[1] for x in self._style._format_attrs) | set(self._style.fields)
+        self._uses_message = 'message' in format_attr_names or '_cdl_xmessage' in format_attr_names \
+            or self.color_mapper.plan.uses_message or self.color_mapper.exc_plan.uses_message
+
+        # True, False, or None to decide based on the environment, and the stream the
+        # records are written to if a handler tells us (see set_stream())
+        self.colorize = colorize
+        self._colorize = env_allows_color() if colorize is None else colorize
+
+        # Without color, any '_cdl_*' attrs the format references are ''
+        self._plain_record_attrs = dict(self._default_record_attrs)
+        self._plain_record_attrs.update((attr, '') for attr in format_attr_names if attr.startswith('_cdl_'))
+        self._plain_uses_message = 'message' in format_attr_names
+
+        # Counters and timers, only updated while enabled
+        self._stats = cbl_stats.FormatterStats(self)
+        if instrument:
+            self.enable_stats()
+
+    def _create_color_mapper(self, **mapper_kwargs):
+        """Return the color mapper for the formatter, a color_mapper_class built with mapper_kwargs"""
+        return self.color_mapper_class(**mapper_kwargs)
 
     def __repr__(self):
         buf = '%s(fmt="%s", datefmt="%s", auto_color=%s, color_mapper.default_color_by_attr=%s)' % \
@@ -111,6 +208,10 @@ class ColorFormatter(logging.Formatter):
              self.color_mapper.default_color_by_attr)
         return buf
 
+    def usesTime(self):
+        # py2's logging.Formatter.usesTime() only looks for '%(asctime)'
+        return self._style.usesTime()
+
     def _pre_format(self, record):
         '''Render time and exception info to be a string
 
@@ -120,42 +221,140 @@ class ColorFormatter(logging.Formatter):
 
         record.exc_text_sep = '\n'
         if record.exc_info and not record.exc_text:
-            record.exc_text = self.formatException(record.exc_info)
+            record.exc_text = self._get_exc_text(record)
             record.exc_text_sep = '\n'
 
+    def _get_exc_text(self, record):
+        exc_text_cache = self.exc_text_cache
+        if exc_text_cache is None:
+            return self.formatException(record.exc_info)
+
+        exc_text = exc_text_cache.get(record)
+        if exc_text is None:
+            exc_text = self.formatException(record.exc_info)
+            exc_text_cache.set(record, exc_text)
+        return exc_text
+
     def _format_exception(self, record_context):
         exc_text_post = '%(exc_text_sep)s%(_cdl_exc_text)s%(exc_text)s%(_cdl_reset)s%(exc_text_sep)s' % record_context
 
         return exc_text_post
 
+    def enable_stats(self, histogram=True, slowest=10):
+        """Start counting and timing formatted records, see :py:mod:`color_bucket_logger.stats`
+
+        Parameters
+        ----------
+        histogram : boolean, optional
+            If true (the default), keep a histogram of format() latencies
+        slowest : int, optional
+            Keep a summary of this many of the slowest records to format. Defaults to 10
+        """
+        self._stats.install(histogram=histogram, slowest=slowest)
+
+    def disable_stats(self):
+        """Stop counting and timing formatted records"""
+        self._stats.uninstall()
+
+    def stats(self):
+        """Return a dict of the formatting counters, timers, and cache stats"""
+        return self._stats.snapshot()
+
+    def latency_percentiles(self, percentiles=cbl_stats.DEFAULT_PERCENTILES):
+        """Return a dict of format() latency percentiles in ns, like {'p50': 12000, 'p99': 40000, ...}
+
+        Also includes the 'count', 'min', 'max' and 'mean'. None if stats are not enabled with a histogram."""
+        return self._stats.latency_percentiles(percentiles)
+
+    def reset_stats(self):
+        """Zero the formatting counters and timers"""
+        self._stats.reset()
+
+    def set_stream(self, stream):
+        """Tell the formatter the stream its records are written to
+
+        With colorize=None, records are formatted with colors only if stream is a
+        terminal (and the environment allows colors). Each call replaces the decision
+        of the one before, so a handler calls it again when its stream changes.
+        :py:class:`color_bucket_logger.handlers.ColorStreamHandler` and the
+        :py:class:`color_bucket_logger.handlers.ColorQueueListener` call it, for other
+        handlers call it with the handler's stream. Does nothing if colorize is True or False.
+
+        The stdlib logging.StreamHandler and logging.FileHandler never call it, so with
+        those colorize=None uses colors whenever the environment allows them, even when
+        the records go to a file.
+        """
+        if self.colorize is None:
+            self._colorize = env_allows_color() and stream_is_tty(stream)
+
+    def _format_plain(self, record):
+        '''Format record without colors
+
+        The same as format() with the color escape sequences stripped, without
+        computing the colors.'''
+        self._pre_format(record)
+
+        record_context = context.RecordContext(record.__dict__, self._plain_record_attrs)
+        if self._plain_uses_message:
+            record_context['message'] = record.getMessage()
+        self._prepare_context(record_context)
+
+        s = self._style._format_plain(record_context)
+
+        exc_text = record_context['exc_text']
+        if exc_text:
+            s = s + record.exc_text_sep + exc_text + record.exc_text_sep
+            record.exc_text = None
+        return s
+
+    def _prepare_context(self, record_context):
+        '''Change the record context of a record before it is formatted
+
+        Called with the colors already computed from the record values, but not yet
+        added to the context. Does nothing, :py:class:`HtmlFormatter` escapes the values
+        here.'''
+
     # format is based on from stdlib python logging.LogFormatter.format()
     # It's kind of a pain to customize exception formatting, since it
     # just appends the exception string from formatException() to the formatted message.
     def format(self, record):
+        if not self._colorize:
+            return self._format_plain(record)
+
         self._pre_format(record)
 
         # Create a context dict of the log records attributes (the __dict__ of
         # the LogRecord() plus all of the color map items from the 'colors' dict.
-        # This avoids having to modify the LogRecord() instance in place.
-        record_context = {}
-        record_context.update(record.__dict__)
-
-        # 'stack_info' attr always added for py2/py3 compat
-        new_defaults_for_attrs = get_default_record_attrs(record_context, ['stack_info'] + [x[1] for x in self._style._format_attrs])
-        record_context.update(new_defaults_for_attrs)
-
-        # Need the pre color rendered message early so we can use it as a color group
-        record_context['_cdl_xmessage'] = record.getMessage()
+        # The RecordContext only stores the values computed here and looks up
+        # anything else in the record's __dict__ (and then the defaults), so the
+        # record attributes are not copied and the LogRecord() is not modified.
+        scratch = self._scratch
+        if scratch is None:
+            record_context = context.RecordContext(record.__dict__, self._default_record_attrs)
+        else:
+            # Reuse the thread's record context. It is None while in use, in case
+            # formatting the record logs (and formats) another one.
+            record_context = getattr(scratch, 'record_context', None)
+            if record_context is None:
+                record_context = context.RecordContext(record.__dict__, self._default_record_attrs)
+            else:
+                scratch.record_context = None
+                record_context.record_dict = record.__dict__
+
+        # Render the message once, and only if the format or a 'message' color group uses it.
+        # It is needed before the colors are computed so it can be used as a color group.
+        if self._uses_message:
+            message = record.getMessage()
+            record_context['_cdl_xmessage'] = message
+            record_context['message'] = message
 
         # Figure out what each log records color will be and return
         # a dict key'ed by a string of form '%_cdl_' + the log record attr name
         colors = self.color_mapper.get_colors_for_record(record_context, self._style._format_attrs)
 
+        self._prepare_context(record_context)
         record_context.update(colors)
 
-        # Re render
-        record_context['message'] = record.getMessage()
-
         # Format the main part of the log message first
         s = self._style._format(record_context)
 
@@ -166,8 +365,126 @@ class ColorFormatter(logging.Formatter):
             # 'logging' Formatter() nullifies record.exc_text after it is rendered
             # so duplicate here
             record.exc_text = None
+
+        if scratch is not None:
+            record_context.clear()
+            record_context.record_dict = None
+            scratch.record_context = record_context
         return s
 
+    def format_many(self, records, terminator='\n', join=True):
+        """Format an iterable of LogRecords
+
+        Produces the same output as calling :py:meth:`format` for each record, but
+        the per formatter setup is done once per batch, one record context is reused
+        for every record, and records whose color inputs (the
+        :py:data:`color_bucket_logger.mapper.ColorPlan` input_attrs, like the logger name
+        and process info) match an earlier record in the batch reuse its colors.
+
+        Parameters
+        ----------
+        records : iterable
+            The :py:class:`logging.LogRecord` objects to format
+        terminator : str, optional
+            Appended to each formatted record when join is True. Defaults to '\\n'
+        join : boolean, optional
+            If true (the default), return one str for the whole batch, ready to be written
+            to a stream with one write. If false, return a list of the formatted records.
+
+        Returns
+        -------
+        str or list
+        """
+        if 'format' in self.__dict__ or type(self).format is not ColorFormatter.format:
+            # format() is overridden, so it has to be used for each record.
+            formatted = [self.format(record) for record in records]
+        elif not self._colorize:
+            format_plain = self._format_plain
+            formatted = [format_plain(record) for record in records]
+        else:
+            formatted = self._format_many(records)
+
+        if not join:
+            return formatted
+        if not formatted:
+            return ''
+        return terminator.join(formatted) + terminator
+
+    def _format_many(self, records):
+        # The same steps as format(), with the lookups hoisted out of the loop
+        pre_format = self._pre_format
+        prepare_context = self._prepare_context
+        format_exception = self._format_exception
+        style_format = self._style._format
+        format_attrs = self._style._format_attrs
+        uses_message = self._uses_message
+        color_mapper = self.color_mapper
+        get_colors_for_record = color_mapper.get_colors_for_record
+        input_attrs = mapper._unique(color_mapper.plan.input_attrs + color_mapper.exc_plan.input_attrs)
+
+        # colors computed so far in this batch, by color input values
+        batch_colors = {}
+        missing = object()
+        reuse_colors = True
+        lookups = hits = 0
+
+        record_context = context.RecordContext({}, self._default_record_attrs)
+        context_get = record_context.get
+        formatted = []
+        append = formatted.append
+
+        for record in records:
+            pre_format(record)
+
+            record_context.clear()
+            record_context.record_dict = record.__dict__
+
+            if uses_message:
+                message = record.getMessage()
+                record_context['_cdl_xmessage'] = message
+                record_context['message'] = message
+
+            colors = None
+            key = None
+            if reuse_colors:
+                # The value's type is part of the key, since 1, 1.0 and True are equal but
+                # render (and so hash to a color) differently. Records with exception text
+                # are colored with a different plan.
+                key = (not context_get('exc_text', None),
+                       tuple([(value.__class__, value) for value in
+                              [context_get(attr, missing) for attr in input_attrs]]))
+                try:
+                    colors = batch_colors.get(key)
+                except TypeError:
+                    # an unhashable value, from 'extra' for ex
+                    key = None
+
+                lookups += 1
+                if colors is not None:
+                    hits += 1
+                elif lookups >= 64 and hits * 4 < lookups:
+                    # Almost every record has different color inputs (a 'lineno' with auto_color
+                    # for ex), so building the keys costs more than it saves.
+                    reuse_colors = False
+
+            if colors is None:
+                colors = get_colors_for_record(record_context, format_attrs)
+                if key is not None:
+                    batch_colors[key] = colors
+
+            prepare_context(record_context)
+            record_context.update(colors)
+
+            s = style_format(record_context)
+
+            if record_context.get('exc_text', None):
+                s = s + format_exception(record_context)
+                record.exc_text = None
+
+            append(s)
+
+        return formatted
+
 
 class TermFormatter(ColorFormatter):
     """Formatter for terminals that colorizes attributes based on their value
@@ -198,20 +515,142 @@ class TermFormatter(ColorFormatter):
         Defaults to False
     datefmt : str, optional
         Date format string as used by :py:class:`logging.Formatter`
+    name_cache_size : int, optional
+        The max number of attribute value colors to remember. The
+        cache hit/miss/eviction counts are available from
+        color_mapper.name_cache.stats(). 0 or None disables the cache.
+    compile_format : boolean, optional
+        If true, compile the format string into a specialized render
+        function (see :py:mod:`color_bucket_logger.compiler`). The default (None)
+        compiles '{' style formats, but not '%' style formats.
+    share_exc_text : boolean, optional
+        If true, the rendered traceback for a record is cached and reused by all
+        the formatters created with share_exc_text, instead of each handler's
+        formatter rendering it again. Defaults to False
+    color_registry : str or :py:class:`color_bucket_logger.registry.ColorRegistry`, optional
+        A registry (or the path of the file for one) to get distinct processName and
+        pid colors from, shared with the other processes and formatters that use it.
+        See :py:mod:`color_bucket_logger.registry`
+    hash_function : str or callable, optional
+        How values are hashed to pick their color. 'crc32' (the default), 'sum' for
+        the colors older versions used, or a callable. See :py:mod:`color_bucket_logger.hashing`
+    colorize : boolean, optional
+        If false, format records without colors (and without computing them). If true,
+        always use colors. The default (None) uses colors unless NO_COLOR is set, TERM is
+        'dumb', or the handler using the formatter writes to a stream that is not a terminal.
+        Handlers tell the formatter their stream with :py:meth:`ColorFormatter.set_stream`,
+        :py:class:`color_bucket_logger.handlers.ColorStreamHandler` and the
+        :py:class:`color_bucket_logger.handlers.ColorQueueListener` do.
+    instrument : boolean, optional
+        If true, count and time the records formatted. See :py:meth:`stats` and
+        :py:mod:`color_bucket_logger.stats`. Defaults to False
+    palette : str or :py:class:`color_bucket_logger.term_colors.Palette`, optional
+        The colors to use. 'xterm256' (the default), 'truecolor-dark' or 'truecolor-light'
+        for more, perceptually spaced, 24 bit colors, or a Palette.
+        See :py:mod:`color_bucket_logger.palettes`
+    free_threaded : boolean, optional
+        If true, each thread formatting with the formatter reuses its own record context,
+        and has its own unlocked color caches in front of the shared ones (see
+        :py:class:`color_bucket_logger.cache.ThreadLocalCache`), so threads sharing the
+        formatter do not contend on a lock per record. Worth it on a free-threaded (no GIL)
+        Python build, and the default (None) turns it on when running on one with the GIL disabled.
     """
 
     def __init__(self, fmt=None, default_color_by_attr=None,
                  color_groups=None, auto_color=False, datefmt=None,
-                 color_mapper=None):
+                 color_mapper=None, name_cache_size=mapper.DEFAULT_NAME_CACHE_SIZE,
+                 compile_format=None, share_exc_text=False, color_registry=None,
+                 hash_function=None, colorize=None, instrument=False, palette=None,
+                 free_threaded=None):
 
         super(TermFormatter, self).__init__(fmt=fmt,
                                             default_color_by_attr=default_color_by_attr,
                                             color_groups=color_groups,
                                             auto_color=auto_color,
-                                            datefmt=datefmt)
+                                            datefmt=datefmt,
+                                            name_cache_size=name_cache_size,
+                                            compile_format=compile_format,
+                                            share_exc_text=share_exc_text,
+                                            color_registry=color_registry,
+                                            hash_function=hash_function,
+                                            colorize=colorize,
+                                            instrument=instrument,
+                                            palette=palette,
+                                            free_threaded=free_threaded)
+
+
+class HtmlFormatter(ColorFormatter):
+    """Formatter for HTML pages that colorizes attributes with CSS classes
+
+    The colors are picked the same way as :py:class:`TermFormatter` picks them, but
+    rendered as ``<span class="cbl-c123">`` spans (see :py:mod:`color_bucket_logger.html_mapper`).
+    The page needs the stylesheet from :py:meth:`stylesheet`, and should show the records
+    in a ``<pre>`` (or with 'white-space: pre') to keep the spacing and line breaks.
+
+    The record values (including the message and the exception text) and the literal
+    text of the format string are HTML escaped, and every record is a complete piece of
+    HTML, so records can be streamed to a page one at a time.
+
+    Takes the same parameters as :py:class:`TermFormatter`, plus:
 
-        self.color_mapper = term_mapper.TermColorMapper(fmt=fmt,
-                                                        default_color_by_attr=default_color_by_attr,
-                                                        color_groups=color_groups,
-                                                        format_attrs=self._style._format_attrs,
-                                                        auto_color=auto_color)
+    Parameters
+    ----------
+    style : str, optional
+        The format style, '%' (the default) or '{'
+    inline_styles : boolean, optional
+        If true, the spans have a style attribute with the color instead of a CSS class,
+        so no stylesheet is needed, at the cost of bigger records. Defaults to False
+    css_prefix : str, optional
+        The prefix of the CSS class names. Defaults to 'cbl'
+
+    colorize defaults to True, since the records are not written to a terminal. Without
+    colors the records are still HTML escaped.
+    """
+
+    color_mapper_class = html_mapper.HtmlColorMapper
+
+    def __init__(self, fmt=None, default_color_by_attr=None,
+                 color_groups=None, auto_color=False, datefmt=None, style=None,
+                 name_cache_size=mapper.DEFAULT_NAME_CACHE_SIZE,
+                 compile_format=None, share_exc_text=False, color_registry=None,
+                 hash_function=None, colorize=True, instrument=False, palette=None,
+                 inline_styles=False, css_prefix=html_mapper.DEFAULT_CSS_PREFIX, free_threaded=None):
+
+        fmt = html_mapper.escape_format(fmt or DEFAULT_FORMAT, style or '%')
+
+        # For _create_color_mapper
+        self.inline_styles = inline_styles
+        self.css_prefix = css_prefix
+
+        super(HtmlFormatter, self).__init__(fmt=fmt,
+                                            default_color_by_attr=default_color_by_attr,
+                                            color_groups=color_groups,
+                                            auto_color=auto_color,
+                                            datefmt=datefmt,
+                                            style=style,
+                                            name_cache_size=name_cache_size,
+                                            compile_format=compile_format,
+                                            share_exc_text=share_exc_text,
+                                            color_registry=color_registry,
+                                            hash_function=hash_function,
+                                            colorize=colorize,
+                                            instrument=instrument,
+                                            palette=palette,
+                                            free_threaded=free_threaded)
+
+    def _create_color_mapper(self, **mapper_kwargs):
+        return super(HtmlFormatter, self)._create_color_mapper(inline_styles=self.inline_styles,
+                                                               css_prefix=self.css_prefix,
+                                                               **mapper_kwargs)
+
+    def stylesheet(self):
+        """Return the CSS for the color classes the formatted records use"""
+        return self.color_mapper.stylesheet()
+
+    def _prepare_context(self, record_context):
+        # The colors are computed from the raw values, so they match the TermFormatter
+        # colors, and the record is formatted with the escaped values
+        record_context.record_dict = html_mapper.EscapedRecordDict(record_context.record_dict)
+        message = dict.get(record_context, 'message')
+        if message is not None:
+            record_context['message'] = html_mapper.escape_value(message)
@@ -0,0 +1,306 @@
+"""Handlers that work with the color formatters
+
+ColorStreamHandler is a logging.StreamHandler that tells its formatter the
+stream it writes to, so a formatter with the default colorize=None only uses
+colors when the stream is a terminal::
+
+    handler = ColorStreamHandler(open('app.log', 'a'))
+    handler.setFormatter(TermFormatter(auto_color=True))
+
+The queue based handlers move formatting off of the logging call path.
+ColorQueueHandler puts records on a queue without formatting them, and a
+ColorQueueListener thread takes them off in batches, formats each batch with
+ColorFormatter.format_many() and writes it to its stream with a single write.
+
+For example::
+
+    log_queue = queue.Queue(maxsize=10000)
+
+    listener = ColorQueueListener(log_queue, stream=sys.stderr,
+                                  formatter=TermFormatter(auto_color=True))
+    handler = ColorQueueHandler(log_queue, policy='drop', listener=listener)
+    logging.getLogger().addHandler(handler)
+
+    listener.start()
+
+Closing the handler (logging.shutdown() does that at exit) stops the listener,
+which formats and writes every record that was queued before returning.
+
+When the queue is full, the handler's policy decides what happens:
+
+    'block'
+        Wait for room on the queue (up to 'timeout' seconds if set, then drop the record)
+    'drop'
+        Drop the record
+    'sample'
+        Drop the record, except every 'sample_rate'th one, which waits for room as
+        with 'block'. The listener still sees some of what was logged while the queue
+        was full.
+
+The handler hands the LogRecord itself to the queue, so it is meant for in
+process queues (queue.Queue). For records coming from other processes, use the
+stdlib logging.handlers.QueueHandler in the workers. The ColorQueueListener can
+read from the multiprocessing queue either way.
+"""
+
+import logging
+import logging.handlers
+import sys
+import threading
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import formatter as cbl_formatter
+
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+POLICY_SAMPLE = 'sample'
+POLICIES = (POLICY_BLOCK, POLICY_DROP, POLICY_SAMPLE)
+
+
+def _set_formatter_stream(formatter, stream):
+    # Only the color formatters care, a logging.Formatter has no set_stream()
+    set_stream = getattr(formatter, 'set_stream', None)
+    if set_stream is not None:
+        set_stream(stream)
+
+
+class ColorStreamHandler(logging.StreamHandler):
+    """A StreamHandler that tells its formatter what stream it writes to
+
+    See :py:meth:`color_bucket_logger.ColorFormatter.set_stream`
+    """
+
+    def setFormatter(self, fmt):
+        logging.StreamHandler.setFormatter(self, fmt)
+        _set_formatter_stream(fmt, self.stream)
+
+    def setStream(self, stream):
+        old_stream = self._set_stream(stream)
+        _set_formatter_stream(self.formatter, self.stream)
+        return old_stream
+
+    if hasattr(logging.StreamHandler, 'setStream'):
+        _set_stream = logging.StreamHandler.setStream
+    else:
+        def _set_stream(self, stream):
+            # What logging.StreamHandler.setStream does in py3.7+
+            if stream is self.stream:
+                return None
+            old_stream = self.stream
+            self.acquire()
+            try:
+                self.flush()
+                self.stream = stream
+            finally:
+                self.release()
+            return old_stream
+
+
+try:
+    _QueueHandler = logging.handlers.QueueHandler
+except AttributeError:
+    class _QueueHandler(logging.Handler):
+        """The parts of the py3 logging.handlers.QueueHandler that ColorQueueHandler uses, for py2"""
+
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def enqueue(self, record):
+            self.queue.put_nowait(record)
+
+        def emit(self, record):
+            try:
+                self.enqueue(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+
+class ColorQueueHandler(_QueueHandler):
+    """A QueueHandler that leaves formatting to a ColorQueueListener
+
+    Parameters
+    ----------
+    queue : :py:class:`queue.Queue`
+        The queue to put records on. Use a maxsize to bound the memory used
+        when the listener falls behind.
+    policy : str, optional
+        What to do when the queue is full, 'block', 'drop' or 'sample'. Defaults to 'block'
+    timeout : float, optional
+        The max seconds to block for room on the queue. The default (None) waits forever.
+    sample_rate : int, optional
+        With the 'sample' policy, every sample_rate'th record that finds the queue
+        full is kept. Defaults to 10
+    listener : ColorQueueListener, optional
+        A listener to stop (and flush) when the handler is closed.
+    """
+
+    def __init__(self, queue, policy=POLICY_BLOCK, timeout=None, sample_rate=10, listener=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy '%s', expected one of %s" % (policy, ', '.join(POLICIES)))
+
+        _QueueHandler.__init__(self, queue)
+        self.policy = policy
+        self.timeout = timeout
+        self.sample_rate = max(1, sample_rate)
+        self.listener = listener
+
+        #: The number of records dropped because the queue was full
+        self.dropped = 0
+        self._overflowed = 0
+
+    def prepare(self, record):
+        # Unlike logging.handlers.QueueHandler, do not format the record here. That is
+        # the listener's job.
+        return record
+
+    def enqueue(self, record):
+        if self.policy == POLICY_BLOCK:
+            self._put_blocking(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.policy == POLICY_SAMPLE:
+            self._overflowed += 1
+            if self._overflowed % self.sample_rate == 0:
+                self._put_blocking(record)
+                return
+
+        self.dropped += 1
+
+    def _put_blocking(self, record):
+        try:
+            self.queue.put(record, True, self.timeout)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        try:
+            if self.listener is not None:
+                self.listener.stop()
+        finally:
+            _QueueHandler.close(self)
+
+
+class ColorQueueListener(object):
+    """Format records from a queue in batches on a background thread
+
+    Parameters
+    ----------
+    queue : :py:class:`queue.Queue`
+        The queue to take records from. Anything with get() and get_nowait()
+        (a multiprocessing queue for ex) works.
+    stream : file like object, optional
+        Where to write the formatted records. Defaults to sys.stderr
+    formatter : :py:class:`logging.Formatter`, optional
+        Defaults to a :py:class:`color_bucket_logger.ColorFormatter`
+    batch_size : int, optional
+        The max number of records formatted and written at once. Defaults to 512
+    terminator : str, optional
+        Written after each record. Defaults to '\\n'
+    """
+    _sentinel = None
+
+    def __init__(self, queue, stream=None, formatter=None, batch_size=512, terminator='\n'):
+        self.queue = queue
+        self.stream = stream or sys.stderr
+        self.setFormatter(formatter or cbl_formatter.ColorFormatter())
+        self.batch_size = max(1, batch_size)
+        self.terminator = terminator
+        self._thread = None
+
+    def setFormatter(self, fmt):
+        """Set the formatter, and tell it the listener's stream"""
+        self.formatter = fmt
+        _set_formatter_stream(fmt, self.stream)
+
+    def start(self):
+        """Start the listener thread"""
+        self._thread = threading.Thread(target=self._monitor, name='ColorQueueListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the listener thread, after it writes out everything queued before the stop"""
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+
+    def dequeue_batch(self):
+        """Wait for a record, then return it and any others already queued, up to batch_size"""
+        batch = [self.queue.get()]
+        get_nowait = self.queue.get_nowait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def handle_batch(self, records):
+        """Format records and write them to the stream with a single write"""
+        data = None
+        format_many = getattr(self.formatter, 'format_many', None)
+        if format_many is not None:
+            try:
+                data = format_many(records, terminator=self.terminator)
+            except Exception:
+                # Format them one at a time to find (and report) the one that failed
+                data = None
+
+        if data is None:
+            chunks = []
+            for record in records:
+                try:
+                    chunks.append(self.formatter.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            data = ''.join(chunks)
+
+        if not data:
+            return
+
+        try:
+            self.stream.write(data)
+            self.stream.flush()
+        except Exception:
+            self.handleError(None)
+
+    def handleError(self, record):
+        """Like :py:meth:`logging.Handler.handleError`, report the error on stderr"""
+        if logging.raiseExceptions and sys.stderr:
+            sys.stderr.write('--- Logging error in %s ---\n' % self.__class__.__name__)
+            traceback.print_exc(file=sys.stderr)
+            if record is not None:
+                sys.stderr.write('Record: %r\n' % (record,))
+
+    def _monitor(self):
+        task_done = getattr(self.queue, 'task_done', None)
+        stopping = False
+        while not stopping:
+            batch = self.dequeue_batch()
+            records = []
+            for record in batch:
+                if record is self._sentinel:
+                    stopping = True
+                    continue
+                records.append(record)
+
+            if records:
+                self.handle_batch(records)
+
+            if task_done:
+                for _record in batch:
+                    task_done()
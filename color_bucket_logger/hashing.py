@@ -0,0 +1,62 @@
+"""Hash functions the color mappers use to pick a color for a value
+
+A mapper turns a value (a logger name, threadName, etc) into a color by hashing
+its str and taking it modulo the number of colors in the palette. The hash
+should be fast (it runs for every value not already in the mapper's name cache)
+and should spread similar strings ('Thread-1', 'Thread-2') over the whole palette.
+
+'crc32'
+    :py:func:`zlib.crc32` of the utf-8 encoded str. The default. A byte string
+    (like a python 2 str logger name) is hashed as is.
+'sum'
+    The sum of the ord() of each character. That is what older versions used, so
+    use it to keep the colors those picked. It is slower, and similar strings get
+    similar colors (and anagrams get the same color).
+
+A mapper's hash_function can also be any callable that takes a str and returns
+a non-negative int.
+"""
+
+import zlib
+
+DEFAULT_HASH_FUNCTION = 'crc32'
+
+
+def crc32_hash(value):
+    """Return the crc32 of the utf-8 encoded str value, or of the bytes value as is"""
+    if isinstance(value, bytes):
+        return zlib.crc32(value) & 0xffffffff
+    return zlib.crc32(value.encode('utf-8', 'surrogatepass')) & 0xffffffff
+
+
+def sum_hash(value):
+    """Return the sum of the ord() of each character in str value (the legacy color hash)"""
+    return sum(map(ord, value))
+
+
+#: The hash functions available by name
+HASH_FUNCTIONS = {'crc32': crc32_hash,
+                  'sum': sum_hash}
+
+
+def get_hash_function(hash_function=None):
+    """Return the hash function for a name in HASH_FUNCTIONS, or a callable as is
+
+    Parameters
+    ----------
+    hash_function : str or callable, optional
+        Defaults to DEFAULT_HASH_FUNCTION
+
+    Returns
+    -------
+    callable
+    """
+    if hash_function is None:
+        hash_function = DEFAULT_HASH_FUNCTION
+    if callable(hash_function):
+        return hash_function
+    try:
+        return HASH_FUNCTIONS[hash_function]
+    except KeyError:
+        raise ValueError("Unknown hash_function '%s', expected one of %s or a callable" %
+                         (hash_function, ', '.join(sorted(HASH_FUNCTIONS))))
@@ -0,0 +1,221 @@
+"""Color mapper that renders colors as HTML spans with CSS classes
+
+HtmlColorMapper picks colors exactly like :py:class:`color_bucket_logger.term_mapper.TermColorMapper`
+(same hashes, same palette indexes), but a color index renders as a
+``<span class="cbl-c123">`` instead of a terminal escape sequence. The colors
+themselves are in a stylesheet, from :py:meth:`HtmlColorMapper.stylesheet`, that
+the page includes once. With inline_styles=True, each span has a
+``style="color:#rrggbb"`` instead, which needs no stylesheet but makes every
+record bigger.
+
+The colorized format wraps every attribute in a span that is closed by the
+'_cdl_unset' slot, and the whole record in a span closed by '_cdl_reset', so
+each formatted record is a complete, balanced piece of HTML. Records can be
+written to a stream (or a websocket) one at a time. Format strings that
+reference '_cdl_*' attributes directly do not get balanced spans.
+
+Escaping is done by the :py:class:`color_bucket_logger.formatter.HtmlFormatter`,
+see :py:func:`escape_value` and :py:func:`escape_format`.
+"""
+
+import re
+from string import Formatter as StrFormatter
+
+try:
+    from html import escape
+except ImportError:
+    from cgi import escape as _cgi_escape
+
+    def escape(s, quote=True):
+        # cgi.escape leaves ' alone, html.escape does not
+        s = _cgi_escape(s, quote)
+        if quote:
+            s = s.replace("'", '&#x27;')
+        return s
+
+from . import compiler
+from . import palettes
+from . import term_colors
+from . import term_mapper
+
+_str_formatter = StrFormatter()
+
+#: The prefix of the CSS class names
+DEFAULT_CSS_PREFIX = 'cbl'
+
+CLOSE_TAG = '</span>'
+
+_xterm_seq_pattern = re.compile(r'^\x1b\[38;5;(\d+)m$')
+_truecolor_seq_pattern = re.compile(r'^\x1b\[38;2;(\d+);(\d+);(\d+)m$')
+
+# The rgb of the 16 basic xterm colors
+_xterm_base_rgb = [(0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+                   (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+                   (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+                   (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255)]
+_xterm_cube_levels = (0, 95, 135, 175, 215, 255)
+
+
+def xterm_rgb(color_number):
+    """Return the (r, g, b) xterm uses for xterm256 color_number"""
+    if color_number < 16:
+        return _xterm_base_rgb[color_number]
+    if color_number < 232:
+        cube = color_number - 16
+        return (_xterm_cube_levels[cube // 36], _xterm_cube_levels[cube // 6 % 6], _xterm_cube_levels[cube % 6])
+    gray = 8 + (color_number - 232) * 10
+    return (gray, gray, gray)
+
+
+def sequence_rgb(sequence):
+    """Return the (r, g, b) of a 256 color or truecolor foreground escape sequence, or None"""
+    match = _truecolor_seq_pattern.match(sequence)
+    if match:
+        return tuple(int(channel) for channel in match.groups())
+    match = _xterm_seq_pattern.match(sequence)
+    if match:
+        return xterm_rgb(int(match.group(1)))
+    return None
+
+
+def css_color(rgb):
+    return '#%02x%02x%02x' % rgb
+
+
+def escape_value(value):
+    """Return a record attribute value with HTML special characters escaped
+
+    Numbers and None are returned as is, so '%d' style fields (and checks for
+    None) still work. Anything else is converted to a str first."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return escape(value, True)
+
+
+def escape_format(fmt, style='%'):
+    """Return the format string fmt with the HTML special characters outside of its fields escaped"""
+    if style == '%':
+        escaped = []
+        pos = 0
+        for match in compiler.percent_field_pattern.finditer(fmt):
+            escaped.append(escape(fmt[pos:match.start()], True))
+            escaped.append(match.group(0))
+            pos = match.end()
+        escaped.append(escape(fmt[pos:], True))
+        return ''.join(escaped)
+
+    if style == '{':
+        escaped = []
+        for literal_text, field_name, format_spec, conversion in _str_formatter.parse(fmt):
+            escaped.append(escape(literal_text, True).replace('{', '{{').replace('}', '}}'))
+            if field_name is not None:
+                escaped.append('{%s%s%s}' % (field_name,
+                                             '!' + conversion if conversion else '',
+                                             ':' + format_spec if format_spec else ''))
+        return ''.join(escaped)
+
+    # '$' style, the literal text can not include a '$' field, so escaping the whole thing is safe
+    return escape(fmt, True)
+
+
+class EscapedRecordDict(object):
+    """A read only view of a LogRecord __dict__ that escapes the values (see :py:func:`escape_value`)
+
+    The :py:class:`color_bucket_logger.context.RecordContext` and the compiled render
+    functions only need 'in' and [] from a record dict."""
+    __slots__ = ('record_dict',)
+
+    def __init__(self, record_dict):
+        self.record_dict = record_dict
+
+    def __getitem__(self, key):
+        return escape_value(self.record_dict[key])
+
+    def __contains__(self, key):
+        return key in self.record_dict
+
+    def get(self, key, default=None):
+        if key in self.record_dict:
+            return escape_value(self.record_dict[key])
+        return default
+
+
+def html_palette(palette, inline_styles=False, css_prefix=DEFAULT_CSS_PREFIX):
+    """Return a Palette with the same color indexes as palette, that renders them as HTML spans
+
+    Parameters
+    ----------
+    palette : str or :py:class:`color_bucket_logger.term_colors.Palette`
+        The terminal palette to take the colors from, see :py:func:`color_bucket_logger.palettes.get_palette`
+    inline_styles : boolean, optional
+        If true, the spans have a style attribute with the color instead of a CSS class
+    css_prefix : str, optional
+        The prefix of the CSS class names. Defaults to 'cbl'
+
+    Returns
+    -------
+    :py:class:`color_bucket_logger.term_colors.Palette`
+    """
+    palette = palettes.get_palette(palette)
+
+    sequences = []
+    for color_idx, sequence in enumerate(palette.sequences):
+        color_rgb = sequence_rgb(sequence)
+        if color_idx == palette.reset_idx:
+            sequences.append(CLOSE_TAG)
+        elif color_idx == palette.default_idx or color_rgb is None:
+            # The page's text color
+            sequences.append('<span class="%s-default">' % css_prefix)
+        elif inline_styles:
+            sequences.append('<span style="color:%s">' % css_color(color_rgb))
+        else:
+            sequences.append('<span class="%s-c%d">' % (css_prefix, color_idx))
+
+    return term_colors.Palette(sequences=sequences,
+                               offset=palette.offset,
+                               number_of_colors=palette.number_of_colors,
+                               reset_idx=palette.reset_idx,
+                               default_idx=palette.default_idx)
+
+
+class HtmlColorMapper(term_mapper.TermColorMapper):
+    """A TermColorMapper whose colors are HTML spans
+
+    Takes the same arguments as :py:class:`color_bucket_logger.term_mapper.TermColorMapper`, plus:
+
+    Parameters
+    ----------
+    inline_styles : boolean, optional
+        If true, spans have a style attribute with the color instead of a CSS class. Defaults to False
+    css_prefix : str, optional
+        The prefix of the CSS class names. Defaults to 'cbl'
+    """
+
+    def __init__(self, palette=None, inline_styles=False, css_prefix=DEFAULT_CSS_PREFIX, **kwargs):
+        self.inline_styles = inline_styles
+        self.css_prefix = css_prefix
+        #: The terminal palette the colors are taken from
+        self.term_palette = palettes.get_palette(self.palette if palette is None else palette)
+        super(HtmlColorMapper, self).__init__(palette=html_palette(self.term_palette,
+                                                                   inline_styles=inline_styles,
+                                                                   css_prefix=css_prefix),
+                                              **kwargs)
+
+    def get_colors_for_record(self, record_context, format_attrs=None):
+        colors = super(HtmlColorMapper, self).get_colors_for_record(record_context, format_attrs=format_attrs)
+        # Each attribute's span is closed when the attribute ends
+        colors['_cdl_unset'] = CLOSE_TAG
+        return colors
+
+    def stylesheet(self):
+        """Return the CSS rules for the color classes, one per line"""
+        palette = self.term_palette
+        rules = []
+        for color_idx, sequence in enumerate(palette.sequences):
+            color_rgb = sequence_rgb(sequence)
+            if color_rgb is None or color_idx in (palette.reset_idx, palette.default_idx):
+                continue
+            rules.append('.%s-c%d { color: %s; }' % (self.css_prefix, color_idx, css_color(color_rgb)))
+        return '\n'.join(rules) + '\n'
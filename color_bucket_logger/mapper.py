@@ -1,31 +1,298 @@
+import collections
+import threading
+
+from . import cache
+from . import hashing
+from . import palettes
+from . import registry
 
 DEFAULT_COLOR_BY_ATTR = 'name'
 
+#: The default max number of (value, perturb) colors a mapper remembers
+DEFAULT_NAME_CACHE_SIZE = 1024
+
+#: The default max number of (processName, process, threadName, thread) colors a mapper remembers
+DEFAULT_PROCESS_CACHE_SIZE = 256
+
+#: A precompiled, immutable description of how a mapper fills in the
+#: color slots for a record. None of it depends on the record itself, so
+#: it is built once when the mapper is created.
+#:
+#: slots
+#:     The '_cdl_*' names that start out as the default color
+#: use_level_color, use_name_color, use_process_colors
+#:     Whether get_level_color(), get_name_color(record name) and
+#:     get_process_colors() need to be called
+#: leader_ops
+#:     (cdl_name, attr, perturb) for each color group leader that is
+#:     colored by hashing the value of record attribute 'attr'
+#: member_ops
+#:     (member_cdl_name, leader_cdl_name) copies, applied in order
+#: auto_ops
+#:     (cdl_name, attr) for the attributes auto_color hashes on its own
+#: default_key
+#:     The '_cdl_*' name whose color replaces any slot left at the default
+#: uses_message
+#:     Whether coloring needs the rendered message (record_context['_cdl_xmessage'])
+#: input_attrs
+#:     The record context keys the colors are computed from. Two records with
+#:     the same values for them get the same colors.
+ColorPlan = collections.namedtuple('ColorPlan',
+                                   ['slots', 'use_level_color', 'use_name_color', 'use_process_colors',
+                                    'leader_ops', 'member_ops', 'auto_ops', 'default_key', 'uses_message',
+                                    'input_attrs'])
+
+
+#: The max number of ColorPlans kept for formatters to share
+COMPILED_PLANS_CACHE_SIZE = 128
+
+# The ColorPlans already built, keyed by everything compile_plan() reads. Many formatters
+# (one per handler) usually share the same few configs, so they share the plans. Bounded,
+# since the key includes the format and color_groups, which can be anything.
+_compiled_plans = cache.LRUCache(maxsize=COMPILED_PLANS_CACHE_SIZE)
+_compiled_plans_lock = threading.Lock()
+
+
+def _unique(items):
+    seen = set()
+    uniq = []
+    for item in items:
+        if item in seen:
+            continue
+        seen.add(item)
+        uniq.append(item)
+    return uniq
+
 
 class BaseColorMapper(object):
+    """Maps the attributes of a record to color indexes
+
+    The configuration of a mapper (everything set in __init__) is read only once
+    it is created, so one mapper (and the formatter that owns it) can be shared by
+    any number of threads without locking. Coloring a record only writes to a dict
+    local to the call, and to the mapper's caches. Rebinding a configuration
+    attribute raises AttributeError, create a new mapper instead.
+    """
+
     # custom_attrs are attributes we have specific methods for finding instead of the
     # generic get_color_name. For ex, 'process' is found via get_process_color()
     custom_attrs = ['levelname', 'levelno', 'process', 'processName', 'thread', 'threadName', 'exc_text']
     high_cardinality = set(['asctime', 'created', 'msecs', 'relativeCreated', 'args', 'message'])
+    process_attrs = ['process', 'processName', 'thread', 'threadName']
+
+    #: The palette the color indexes refer to. Subclasses set a default.
+    palette = None
 
     def __init__(self, fmt=None, default_color_by_attr=None,
                  color_groups=None, format_attrs=None,
-                 auto_color=False):
+                 auto_color=False, name_cache_size=DEFAULT_NAME_CACHE_SIZE,
+                 process_cache_size=DEFAULT_PROCESS_CACHE_SIZE, palette=None,
+                 color_registry=None, hash_function=None, free_threaded=False):
         self._fmt = fmt
-        self.color_groups = color_groups or []
+        self.palette = self.palette if palette is None else palettes.get_palette(palette)
+
+        # The str -> int hash used to pick colors for values, see color_bucket_logger.hashing
+        self.hash_function = hashing.get_hash_function(hash_function)
 
-        self.group_by = []
+        # A ColorRegistry, or the path of its file
+        if color_registry is not None and not isinstance(color_registry, registry.ColorRegistry):
+            color_registry = registry.get_registry(color_registry)
+        self.color_registry = color_registry
+        self.color_groups = tuple((group, tuple(members)) for group, members in color_groups or [])
+        self.format_attrs = tuple(format_attrs or ())
 
-        self.default_color_by_attr = default_color_by_attr or DEFAULT_COLOR_BY_ATTR
+        default_color_by_attr = default_color_by_attr or DEFAULT_COLOR_BY_ATTR
 
         # make sure the defaut color attr is in the group_by list
-        if self.default_color_by_attr:
-            self.group_by.insert(0, (self.default_color_by_attr, [self.default_color_by_attr]))
+        group_by = [(default_color_by_attr, (default_color_by_attr,))]
+        group_by.extend(self.color_groups)
+        self.group_by = tuple(group_by)
 
-        self.group_by.extend(self.color_groups)
+        # A group that lists 'default' as a member makes its leader the attr
+        # the default color comes from.
+        for group, members in self.group_by:
+            if 'default' in members:
+                default_color_by_attr = group
+        self.default_color_by_attr = default_color_by_attr
 
         self.auto_color = auto_color
 
+        # With free_threaded, each thread has its own (unlocked) cache in front of the shared caches
+        self.free_threaded = free_threaded
+
+        # None or 0 disables the cache
+        self.name_cache = self._make_cache(name_cache_size)
+
+        # The pid is part of the key, but a forked child does not need its parent's entries
+        self.process_cache = self._make_cache(process_cache_size, clear_after_fork=True)
+
+        self.plan = self.get_plan(self.format_attrs)
+        self.exc_plan = self.get_plan(self.format_attrs, exc=True)
+
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen') and name in self.__dict__:
+            raise AttributeError("Can not set '%s', the %s configuration is read only" % (name, self.__class__.__name__))
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        if self.__dict__.get('_frozen') and name in self.__dict__:
+            raise AttributeError("Can not delete '%s', the %s configuration is read only" % (name, self.__class__.__name__))
+        object.__delattr__(self, name)
+
+    def _make_cache(self, maxsize, clear_after_fork=False):
+        if not maxsize:
+            return None
+        lru_cache = cache.LRUCache(maxsize=maxsize, clear_after_fork=clear_after_fork)
+        if self.free_threaded:
+            return cache.ThreadLocalCache(lru_cache)
+        return lru_cache
+
+    def get_plan(self, format_attrs, exc=False):
+        """Return the :py:data:`ColorPlan` for format_attrs, from compile_plan() or the plans already built"""
+        try:
+            key = (self.__class__, tuple(format_attrs), self.auto_color, self.default_color_by_attr, exc, self.group_by)
+            hash(key)
+        except TypeError:
+            # color_groups with unhashable names
+            return self.compile_plan(format_attrs, exc=exc)
+
+        plan = _compiled_plans.get(key)
+        if plan is None:
+            with _compiled_plans_lock:
+                plan = _compiled_plans.get(key)
+                if plan is None:
+                    plan = self.compile_plan(format_attrs, exc=exc)
+                    _compiled_plans.set(key, plan)
+        return plan
+
+    def compile_plan(self, format_attrs, exc=False):
+        """Build the :py:data:`ColorPlan` used to color records for format_attrs
+
+        Only the colors the formatted output uses are computed. That is the '_cdl_*' slot
+        for each attribute in the format, the slots the color format string always has
+        ('_cdl_default', '_cdl_unset', '_cdl_reset'), and for records with exception
+        text, '_cdl_exc_text'. The slots and operations that do not contribute to one of
+        those (directly or via a color group or the default color) are left out.
+
+        Parameters
+        ----------
+        format_attrs : list
+            The (full_attr, attr_name) tuples found in the format string
+        exc : boolean, optional
+            If true, build the plan for records with exception text
+
+        Returns
+        -------
+        ColorPlan
+        """
+        # populate the record with values for any _cdl_* attrs we will use
+        # could be format_attrs (actually used in format string) + any referenced as color_group keys
+        group_by_attrs = [group for group, _members in self.group_by]
+        record_format_attrs = [format_attr[1] for format_attr in format_attrs] + ['exc_text']
+        attrs_needed = _unique(group_by_attrs + record_format_attrs)
+
+        slots = _unique(['_cdl_default', '_cdl_unset'] + ['_cdl_%s' % attr for attr in attrs_needed])
+
+        use_level_color = 'levelname' in group_by_attrs or 'levelno' in group_by_attrs
+        # set a different color for each logger name. And by default, make filename, funcName, and lineno match.
+        use_name_color = 'name' in group_by_attrs or self.auto_color
+        use_process_colors = self.auto_color or any(attr in group_by_attrs for attr in self.process_attrs)
+
+        # find the color for any group keys before setting colors for group members
+        # TODO: extend group keys to let them be tuples
+        #       to allow (name, funcName) to get a color for module.function() instead of two sep
+        leader_ops = []
+        for group in group_by_attrs:
+            if group in self.custom_attrs:
+                continue
+            # record.message isnt 'rendered' until after the format
+            if group == 'message':
+                leader_ops.append(('_cdl_message', '_cdl_xmessage', None))
+            else:
+                # default to empty string for non existent record attributes ('extra', etc)
+                leader_ops.append(('_cdl_%s' % group, group, 'sdsdf'))
+
+        member_ops = []
+        # fields we don't need to calculate indiv, since they will be a different group
+        in_a_group = set()
+        for group, members in self.group_by:
+            for member in members:
+                member_ops.append(('_cdl_%s' % member, '_cdl_%s' % group))
+                in_a_group.add(member)
+
+        # for everything else, use the name/string to get a color if auto_colors is True
+        auto_ops = []
+        if self.auto_color:
+            for needed_attr in attrs_needed:
+                if needed_attr in self.custom_attrs or needed_attr in in_a_group \
+                        or needed_attr in self.high_cardinality:
+                    continue
+                auto_ops.append(('_cdl_%s' % needed_attr, needed_attr))
+
+        default_key = '_cdl_%s' % self.default_color_by_attr
+        leader_ops = _unique(leader_ops)
+
+        # The slots the formatted output reads
+        format_attr_names = [format_attr[1] for format_attr in format_attrs]
+        live = set(['_cdl_default', '_cdl_unset', '_cdl_reset', default_key])
+        live.update('_cdl_%s' % attr for attr in format_attr_names)
+        live.update(attr for attr in format_attr_names if attr.startswith('_cdl_'))
+        if exc:
+            live.add('_cdl_exc_text')
+
+        # Walk the operations backwards, keeping only the ones that write a slot that
+        # is read later. A write makes the slot dead before it, since every op overwrites
+        # its slot unconditionally. A group member copy makes its leader live.
+        ever_live = set(live)
+
+        def writes_live(cdl_name):
+            if cdl_name in live:
+                live.discard(cdl_name)
+                return True
+            return False
+
+        auto_ops = [op for op in reversed(auto_ops) if writes_live(op[0])][::-1]
+
+        live_member_ops = []
+        for member_cdl_name, group_cdl_name in reversed(member_ops):
+            if writes_live(member_cdl_name):
+                live.add(group_cdl_name)
+                ever_live.add(group_cdl_name)
+                live_member_ops.append((member_cdl_name, group_cdl_name))
+        member_ops = live_member_ops[::-1]
+
+        leader_ops = [op for op in reversed(leader_ops) if writes_live(op[0])][::-1]
+
+        process_slots = ['_cdl_process', '_cdl_processName', '_cdl_thread', '_cdl_threadName', '_cdl_exc_text']
+        use_process_colors = use_process_colors and any([writes_live(cdl_name) for cdl_name in process_slots])
+        use_name_color = use_name_color and writes_live('_cdl_name')
+        use_level_color = use_level_color and writes_live('_cdl_levelname')
+
+        slots = [slot for slot in slots if slot in ever_live]
+
+        input_attrs = []
+        if use_level_color:
+            input_attrs.extend(['levelname', 'levelno'])
+        if use_name_color:
+            input_attrs.append('name')
+        if use_process_colors:
+            input_attrs.extend(self.process_attrs)
+        input_attrs.extend(attr for _cdl_name, attr, _perturb in leader_ops)
+        input_attrs.extend(attr for _cdl_name, attr in auto_ops)
+
+        return ColorPlan(slots=tuple(slots),
+                         use_level_color=use_level_color,
+                         use_name_color=use_name_color,
+                         use_process_colors=use_process_colors,
+                         leader_ops=tuple(leader_ops),
+                         member_ops=tuple(member_ops),
+                         auto_ops=tuple(auto_ops),
+                         default_key=default_key,
+                         uses_message=any(attr == '_cdl_xmessage' for _cdl_name, attr, _perturb in leader_ops),
+                         input_attrs=tuple(_unique(input_attrs)))
+
     def get_thread_color(self, thread_id):
         '''return color idx for thread_id'''
         return 0
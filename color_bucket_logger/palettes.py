@@ -0,0 +1,197 @@
+"""Palettes of 24 bit (truecolor) colors, and picking a palette by name
+
+The default xterm256 palette (:py:data:`color_bucket_logger.term_colors.PALETTE`)
+hashes values into the 213 colors of the 6x6x6 color cube, many of which are
+hard to tell apart, or hard to read on a dark (or light) background. On a
+terminal that supports 24 bit color, a truecolor palette can have more colors,
+so fewer logger names share a color, and all of them are readable on the
+background of the theme it was made for.
+
+The colors of a truecolor palette are evenly spaced around the hue circle of
+the OKLCH color space, where equal steps look about equally different. The
+lightness and chroma are fixed by the theme, stepping through a few lightness
+levels so that neighbouring colors differ in lightness as well as in hue.
+Colors that are outside of the sRGB gamut have their chroma reduced until they
+fit.
+
+Generating a palette takes some ms, so each (number of colors, theme) is only
+generated once per process, when it is first used. The escape sequences are
+encoded then, so picking a color while formatting is still just an index into
+a tuple, for any size of palette.
+
+The palettes available by name:
+
+'xterm256'
+    The xterm 256 color palette. The default.
+'truecolor-dark'
+    DEFAULT_NUMBER_OF_COLORS truecolor colors for a terminal with a dark background
+'truecolor-light'
+    DEFAULT_NUMBER_OF_COLORS truecolor colors for a terminal with a light background
+
+For example::
+
+    formatter = TermFormatter(palette='truecolor-dark')
+
+or, for a palette with a different number of colors::
+
+    formatter = TermFormatter(palette=palettes.truecolor_palette(1024, theme='light'))
+
+Like the xterm256 palette, the first 8 indexes of a truecolor palette are the
+basic terminal colors (the level colors use those), followed by the truecolor
+colors, then the reset and default sequences.
+"""
+
+import math
+import threading
+
+from . import term_colors
+
+TRUECOLOR_SEQ = "\033[38;2;%d;%d;%dm"
+
+#: The number of colors in the named truecolor palettes
+DEFAULT_NUMBER_OF_COLORS = 512
+
+#: The OKLCH lightness levels the colors step through, and the chroma, for each theme
+THEMES = {'dark': {'lightness': (0.72, 0.80, 0.88), 'chroma': 0.15, 'default_color': term_colors.WHITE},
+          'light': {'lightness': (0.44, 0.52, 0.60), 'chroma': 0.15, 'default_color': term_colors.BLACK}}
+
+DEFAULT_PALETTE = 'xterm256'
+
+_palettes = {}
+_palettes_lock = threading.Lock()
+
+
+def oklch_to_linear_srgb(lightness, chroma, hue):
+    """Return the linear sRGB (r, g, b) floats for an OKLCH color (hue in degrees)
+
+    The floats are outside of 0.0-1.0 for colors outside of the sRGB gamut."""
+    hue_radians = math.radians(hue)
+    a = chroma * math.cos(hue_radians)
+    b = chroma * math.sin(hue_radians)
+
+    # OKLab to LMS to linear sRGB, see https://bottosson.github.io/posts/oklab/
+    l_ = (lightness + 0.3963377774 * a + 0.2158037573 * b) ** 3
+    m_ = (lightness - 0.1055613458 * a - 0.0638541728 * b) ** 3
+    s_ = (lightness - 0.0894841775 * a - 1.2914855480 * b) ** 3
+
+    return (4.0767416621 * l_ - 3.3077115913 * m_ + 0.2309699292 * s_,
+            -1.2684380046 * l_ + 2.6097574011 * m_ - 0.3413193965 * s_,
+            -0.0041960863 * l_ - 0.7034186147 * m_ + 1.7076147010 * s_)
+
+
+def _in_gamut(linear_rgb, epsilon=1e-6):
+    return all(-epsilon <= channel <= 1.0 + epsilon for channel in linear_rgb)
+
+
+def _srgb_channel(linear):
+    linear = min(1.0, max(0.0, linear))
+    if linear <= 0.0031308:
+        encoded = 12.92 * linear
+    else:
+        encoded = 1.055 * linear ** (1 / 2.4) - 0.055
+    return int(round(encoded * 255))
+
+
+def oklch_to_rgb(lightness, chroma, hue):
+    """Return the 8 bit sRGB (r, g, b) for an OKLCH color, reducing the chroma until it is in the sRGB gamut"""
+    linear_rgb = oklch_to_linear_srgb(lightness, chroma, hue)
+    if not _in_gamut(linear_rgb):
+        # binary search for the most chroma that fits
+        low, high = 0.0, chroma
+        for _step in range(16):
+            mid = (low + high) / 2
+            if _in_gamut(oklch_to_linear_srgb(lightness, mid, hue)):
+                low = mid
+            else:
+                high = mid
+        linear_rgb = oklch_to_linear_srgb(lightness, low, hue)
+    return tuple(_srgb_channel(channel) for channel in linear_rgb)
+
+
+def generate_colors(number_of_colors, theme='dark'):
+    """Return a list of number_of_colors perceptually spaced 8 bit (r, g, b) tuples for theme
+
+    Parameters
+    ----------
+    number_of_colors : int
+    theme : str, optional
+        'dark' (the default) or 'light', the background the colors need to be readable on
+
+    Returns
+    -------
+    list of tuple
+    """
+    try:
+        theme_info = THEMES[theme]
+    except KeyError:
+        raise ValueError("Unknown theme '%s', expected one of %s" % (theme, ', '.join(sorted(THEMES))))
+
+    lightness_levels = theme_info['lightness']
+    chroma = theme_info['chroma']
+    return [oklch_to_rgb(lightness_levels[index % len(lightness_levels)],
+                         chroma,
+                         360.0 * index / number_of_colors)
+            for index in range(number_of_colors)]
+
+
+def make_truecolor_palette(number_of_colors=DEFAULT_NUMBER_OF_COLORS, theme='dark'):
+    """Generate a new truecolor :py:class:`color_bucket_logger.term_colors.Palette`
+
+    Use :py:func:`truecolor_palette` to get the palette shared by everything in the process."""
+    if number_of_colors < 1:
+        raise ValueError('A palette needs at least one color, not %s' % number_of_colors)
+    rgb = generate_colors(number_of_colors, theme=theme)
+
+    base_colors = [term_colors.BASE_COLORS[color_idx] for color_idx in range(term_colors.NUMBER_OF_BASE_COLORS)]
+    offset = len(base_colors)
+    reset_idx = offset + number_of_colors
+    default_color = base_colors[THEMES[theme]['default_color']]
+
+    return term_colors.Palette(sequences=base_colors + [TRUECOLOR_SEQ % color for color in rgb] + [term_colors.RESET_SEQ, default_color],
+                               offset=offset,
+                               number_of_colors=number_of_colors,
+                               reset_idx=reset_idx,
+                               default_idx=reset_idx + 1,
+                               rgb=rgb)
+
+
+def truecolor_palette(number_of_colors=DEFAULT_NUMBER_OF_COLORS, theme='dark'):
+    """Return the truecolor palette of number_of_colors colors for theme, generating it on first use"""
+    key = (number_of_colors, theme)
+    palette = _palettes.get(key)
+    if palette is None:
+        with _palettes_lock:
+            palette = _palettes.get(key)
+            if palette is None:
+                palette = make_truecolor_palette(number_of_colors, theme=theme)
+                _palettes[key] = palette
+    return palette
+
+
+#: The palettes available by name, as functions that return the palette
+PALETTES = {'xterm256': lambda: term_colors.PALETTE,
+            'truecolor-dark': lambda: truecolor_palette(theme='dark'),
+            'truecolor-light': lambda: truecolor_palette(theme='light')}
+
+
+def get_palette(palette=None):
+    """Return the palette for a name in PALETTES, or a Palette as is
+
+    Parameters
+    ----------
+    palette : str or :py:class:`color_bucket_logger.term_colors.Palette`, optional
+        Defaults to DEFAULT_PALETTE
+
+    Returns
+    -------
+    :py:class:`color_bucket_logger.term_colors.Palette`
+    """
+    if palette is None:
+        palette = DEFAULT_PALETTE
+    if isinstance(palette, term_colors.Palette):
+        return palette
+    try:
+        return PALETTES[palette]()
+    except KeyError:
+        raise ValueError("Unknown palette '%s', expected one of %s or a Palette" %
+                         (palette, ', '.join(sorted(PALETTES))))
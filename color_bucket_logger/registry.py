@@ -0,0 +1,256 @@
+"""A color registry shared by processes and formatters via a memory mapped file
+
+By default the color of a pid is pid % number of colors, so pool workers with
+consecutive pids get neighbouring, similar looking, colors. And since each
+formatter (in each process) computes colors on its own, there is nothing to
+coordinate them with.
+
+A ColorRegistry instead numbers the keys (pids, processNames) it sees in the
+order they first show up, and a key's color is picked from that number by golden
+ratio stepping through the palette. Each new key lands as far from the colors
+already handed out as it can, and since the numbers are stored in a file,
+every process and formatter using the same file agrees on them.
+
+For example, to have the pool workers of a multiprocessing app share colors::
+
+    formatter = TermFormatter(color_registry='/tmp/myapp-colors.cbl')
+
+The file is a fixed size open addressing hash table of
+(key hash, first appearance number) slots. Looking up a known key does not
+take any lock. Each registry also keeps a dict of the keys it has already
+looked up, so after the first time it is a dict lookup. Adding a key takes an
+exclusive flock() on the file (just a thread lock on platforms without fcntl,
+where the registry is only consistent within a process).
+
+Entries are never removed, so the file should be for one app (or one run of it).
+When the table is full, new keys get None and the mapper falls back to its
+normal colors.
+"""
+
+import contextlib
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import cache
+
+MAGIC = b'CBLREG01'
+
+#: The default number of slots in a new registry file
+DEFAULT_CAPACITY = 4096
+
+#: Stop adding keys when this fraction of the slots is used, so probes stay short
+MAX_LOAD = 0.75
+
+GOLDEN_RATIO_CONJUGATE = 0.6180339887498949
+
+# magic, capacity, count
+_header = struct.Struct('<8sII')
+# key hash, first appearance number + 1 (0 until it is written)
+_slot = struct.Struct('<QI4x')
+_order = struct.Struct('<I')
+_key_hash = struct.Struct('<Q')
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(path, capacity=DEFAULT_CAPACITY):
+    """Return the ColorRegistry for path, shared by everything in the process that uses it"""
+    path = os.path.abspath(path)
+    with _registries_lock:
+        color_registry = _registries.get(path)
+        if color_registry is None:
+            color_registry = ColorRegistry(path, capacity=capacity)
+            _registries[path] = color_registry
+        return color_registry
+
+
+def hash_key(key):
+    """Return the 64 bit, never 0, hash of the str key that is stored in the registry file
+
+    A bytes key (a python 2 str) is hashed as is, so it matches the utf-8 encoded text key."""
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    digest = hashlib.sha1(key).digest()
+    return _key_hash.unpack(digest[:8])[0] or 1
+
+
+def distinct_color_index(order, palette):
+    """Return the palette color index for the order'th key
+
+    Stepping by the golden ratio spreads the first N colors close to evenly over
+    the palette, for any N."""
+    fraction = (order * GOLDEN_RATIO_CONJUGATE) % 1.0
+    return palette.offset + int(fraction * palette.number_of_colors)
+
+
+class ColorRegistry(object):
+    """Assign first appearance numbers to keys, stored in a memory mapped file
+
+    Parameters
+    ----------
+    path : str
+        The registry file. Created if it does not exist.
+    capacity : int, optional
+        The number of slots in a new file, rounded up to a power of 2.
+        An existing file keeps its capacity.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.closed = False
+        self._local = {}
+        self._lock = threading.Lock()
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fd = fd
+        self._lock_fd = fd
+        self._pid = os.getpid()
+
+        magic = MAGIC
+        with self._locked():
+            size = os.fstat(fd).st_size
+            if size == 0:
+                capacity = 1 << max(0, capacity - 1).bit_length()
+                size = _header.size + capacity * _slot.size
+                os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+                _header.pack_into(self._mm, 0, MAGIC, capacity, 0)
+            else:
+                self._mm = mmap.mmap(fd, size)
+                magic, capacity, _count = _header.unpack_from(self._mm, 0)
+
+        if magic != MAGIC or size < _header.size + capacity * _slot.size:
+            self._mm.close()
+            os.close(fd)
+            raise ValueError('%s is not a color registry file' % path)
+
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._max_count = int(capacity * MAX_LOAD)
+
+        cache._caches.add(self)
+
+    def __repr__(self):
+        return '%s(path=%r, capacity=%s)' % (self.__class__.__name__, self.path, self.capacity)
+
+    def __len__(self):
+        return _header.unpack_from(self._mm, 0)[2]
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # The thread lock for other threads in this process, the flock for other processes.
+        # Without os.register_at_fork a forked child only notices here that it
+        # still has its parent's lock.
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _reset_after_fork(self):
+        # A flock belongs to the open file, which a forked child shares with its
+        # parent, so the child needs its own to lock against the parent.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        if not self.closed:
+            self._lock_fd = os.open(self.path, os.O_RDWR)
+
+    def order(self, key):
+        """Return the first appearance number of key, adding key if it is new
+
+        The first key added to a registry file is 0, the next 1, and so on.
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        int or None
+            None if key is new and the registry is full
+        """
+        try:
+            return self._local[key]
+        except KeyError:
+            pass
+
+        key_hash = hash_key(key)
+        order = self._find(key_hash)
+        if order is None:
+            with self._locked():
+                order = self._find(key_hash)
+                if order is None:
+                    order = self._insert(key_hash)
+
+        if order is not None:
+            self._local[key] = order
+        return order
+
+    def color_index(self, key, palette):
+        """Return the index of the color for key in palette, or None if the registry is full"""
+        order = self.order(key)
+        if order is None:
+            return None
+        return distinct_color_index(order, palette)
+
+    def _find(self, key_hash):
+        mm = self._mm
+        mask = self._mask
+        index = key_hash & mask
+        for _probe in range(self.capacity):
+            slot_hash, order = _slot.unpack_from(mm, _header.size + index * _slot.size)
+            if slot_hash == key_hash:
+                # An order of 0 is a slot another process is in the middle of writing,
+                # so wait for the lock and look again.
+                return order - 1 if order else None
+            if not slot_hash:
+                return None
+            index = (index + 1) & mask
+        return None
+
+    def _insert(self, key_hash):
+        # Only called with the lock held
+        mm = self._mm
+        count = _header.unpack_from(mm, 0)[2]
+        if count >= self._max_count:
+            return None
+
+        mask = self._mask
+        index = key_hash & mask
+        offset = _header.size + index * _slot.size
+        while _key_hash.unpack_from(mm, offset)[0]:
+            index = (index + 1) & mask
+            offset = _header.size + index * _slot.size
+
+        # Write the number before the hash, so a lock free reader that finds the
+        # hash finds the number too.
+        _order.pack_into(mm, offset + _key_hash.size, count + 1)
+        _key_hash.pack_into(mm, offset, key_hash)
+        _header.pack_into(mm, 0, MAGIC, self.capacity, count + 1)
+        return count
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with _registries_lock:
+            if _registries.get(os.path.abspath(self.path)) is self:
+                del _registries[os.path.abspath(self.path)]
+        self._mm.close()
+        if self._lock_fd != self._fd:
+            os.close(self._lock_fd)
+        os.close(self._fd)
@@ -0,0 +1,434 @@
+"""Opt-in counters and timers for where a ColorFormatter spends its time
+
+Instrumentation is off by default, and then costs nothing: a ColorFormatter
+only gets timed once its stats are enabled, either with ``instrument=True``
+or by calling :py:meth:`color_bucket_logger.ColorFormatter.enable_stats`.
+
+Enabling stats does not add any checks to the formatting code. It wraps the
+formatter's format(), the steps format() calls (the formatter's _pre_format()
+and the _get_exc_text() it calls to render a traceback, the color mapper's
+get_colors_for_record(), and the style's _format()) with timed versions set as
+instance attributes. Disabling removes them again. Since _pre_format() calls
+_get_exc_text(), the 'pre_format' time includes the 'format_exception' time.
+
+For example::
+
+    formatter = TermFormatter(instrument=True)
+    ...
+    formatter.stats()
+
+returns something like::
+
+    {'enabled': True,
+     'records': 1000,
+     'exc_records': 2,
+     'bytes_emitted': 98765,
+     'time_ns': {'format': 19000000, 'pre_format': 4000000, 'colors': 7000000,
+                 'style_format': 3500000, 'format_exception': 90000},
+     'calls': {'format': 1000, 'pre_format': 1000, 'colors': 1000,
+               'style_format': 1000, 'format_exception': 2},
+     'caches': {'name_cache': {'hits': 998, 'misses': 2, 'hit_rate': 0.998, ...},
+                'process_cache': {...}}}
+
+'bytes_emitted' counts the bytes of the formatted str encoded to utf-8, which
+is what a handler writing utf-8 writes.
+
+The stats also include the distribution of format() latencies, from a
+:py:class:`LatencyHistogram`, as percentiles::
+
+     'latency': {'count': 1000, 'min': 9000, 'max': 2900000, 'mean': 19000,
+                 'p50': 15000, 'p90': 21000, 'p99': 95000, 'p99.9': 2900000},
+
+and the records that took longest to format, from a :py:class:`SlowRecords`::
+
+     'slowest': [{'elapsed_ns': 2900000, 'name': 'myapp.db', 'levelname': 'ERROR',
+                  'msg': 'Query failed: %s', 'size': 20480, 'exc': True, 'created': 1700000000.0},
+                 ...]
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+try:
+    _clock_ns = time.perf_counter_ns
+except AttributeError:
+    # py2 has no perf_counter either
+    _clock = getattr(time, 'perf_counter', time.time)
+
+    def _clock_ns():
+        return int(_clock() * 1e9)
+
+#: The steps that are timed, and the (object attribute path, method name) each wraps
+TIMED_STEPS = (('pre_format', (), '_pre_format'),
+               ('colors', ('color_mapper',), 'get_colors_for_record'),
+               ('style_format', ('_style',), '_format'),
+               ('style_format', ('_style',), '_format_plain'),
+               ('format_exception', (), '_get_exc_text'))
+
+_MISSING = object()
+
+# str, and unicode on py2
+_string_types = (str, type(u''))
+
+
+def with_hit_rate(cache_stats):
+    """Return a copy of a cache stats() dict with a 'hit_rate' (None before any lookups)"""
+    cache_stats = dict(cache_stats)
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    cache_stats['hit_rate'] = cache_stats['hits'] / float(lookups) if lookups else None
+    return cache_stats
+
+
+def utf8_len(s):
+    """Return the length of str s encoded to utf-8 (a byte str's own length on py2)"""
+    if isinstance(s, bytes):
+        return len(s)
+    return len(s.encode('utf-8', 'surrogatepass'))
+
+
+#: The percentiles reported by default
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram(object):
+    """A fixed size histogram of latencies in ns, with buckets that keep a constant relative precision
+
+    Like an HdrHistogram, values below 2**sub_bucket_bits each get a bucket, and above that
+    every power of 2 range is split into 2**sub_bucket_bits buckets. With the default 4 bits,
+    a value is off by at most 1/16th (6.25%). Recording a value is an index computation and
+    a list increment, and the memory used does not depend on the number of values.
+
+    Not thread safe on its own, FormatterStats records values with its lock held.
+
+    Parameters
+    ----------
+    sub_bucket_bits : int, optional
+        Defaults to 4
+    max_value : int, optional
+        Values higher than this (in ns) are counted in the last bucket. Defaults to 2**40 (about 18 minutes)
+    """
+
+    def __init__(self, sub_bucket_bits=4, max_value=2 ** 40):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.max_value = max_value
+        self.counts = [0] * (self.bucket_index(max_value) + 1)
+        self.reset()
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket_index(self, value):
+        """Return the index of the bucket value is counted in"""
+        sub_bucket_count = self.sub_bucket_count
+        if value < sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits - 1
+        return (shift + 1) * sub_bucket_count + (value >> shift) - sub_bucket_count
+
+    def bucket_high(self, index):
+        """Return the highest value counted in bucket index"""
+        sub_bucket_count = self.sub_bucket_count
+        if index < sub_bucket_count:
+            return index
+        shift = index // sub_bucket_count - 1
+        sub_bucket = index % sub_bucket_count + sub_bucket_count
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value):
+        """Count one value (an int, in ns)"""
+        value = min(max(0, value), self.max_value)
+        self.counts[self.bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Return the value that percentile percent of the values are at or below
+
+        The value is the highest value in its bucket (but no higher than the max
+        recorded value), or None if nothing has been recorded."""
+        if not self.count:
+            return None
+        # The rank of the value, 1 based
+        rank = max(1, int(-(-self.count * percentile // 100)))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.bucket_high(index), self.max)
+        return self.max
+
+    def export(self, percentiles=DEFAULT_PERCENTILES):
+        """Return a dict of the count, min, max, mean, and 'p<percentile>' values, for a metrics pipeline"""
+        exported = {'count': self.count,
+                    'min': self.min,
+                    'max': self.max,
+                    'mean': self.total / float(self.count) if self.count else None}
+        for percentile in percentiles:
+            exported['p%s' % ('%f' % percentile).rstrip('0').rstrip('.')] = self.percentile(percentile)
+        return exported
+
+
+class SlowRecords(object):
+    """Keep a summary of the n records that took the longest to format
+
+    Not thread safe on its own, FormatterStats adds records with its lock held.
+    It builds the summary before taking the lock, since that can call the msg's
+    __str__, which could log through the same formatter.
+
+    Parameters
+    ----------
+    n : int
+        How many records to keep
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self._heap = []
+        self._counter = itertools.count()
+
+    def reset(self):
+        self._heap = []
+
+    def wants(self, elapsed_ns):
+        """Return True if a record that took elapsed_ns would be one of the n slowest so far
+
+        Safe to call without the lock, add() checks again."""
+        heap = self._heap
+        return len(heap) < self.n or elapsed_ns > heap[0][0]
+
+    @staticmethod
+    def summary(elapsed_ns, record, formatted):
+        """Return the summary of record to add()
+
+        Only a summary, holding on to the record would keep its args and traceback alive."""
+        msg = record.msg
+        if not isinstance(msg, _string_types):
+            # getMessage() already called the msg's __str__, use what it returned
+            # when the record kept it
+            msg = getattr(record, 'message', None) or str(msg)
+        return {'elapsed_ns': elapsed_ns,
+                'name': record.name,
+                'levelname': record.levelname,
+                'msg': msg,
+                'size': len(formatted),
+                'exc': bool(record.exc_info),
+                'created': record.created}
+
+    def add(self, elapsed_ns, summary):
+        """Remember the summary of a record if it is one of the n slowest so far"""
+        heap = self._heap
+        if len(heap) >= self.n:
+            if elapsed_ns <= heap[0][0]:
+                return
+            heapq.heapreplace(heap, (elapsed_ns, next(self._counter), summary))
+        else:
+            heapq.heappush(heap, (elapsed_ns, next(self._counter), summary))
+
+    def records(self):
+        """Return the summaries of the slowest records, slowest first"""
+        return [dict(summary) for _elapsed_ns, _count, summary in sorted(self._heap, reverse=True)]
+
+
+class FormatterStats(object):
+    """The counters and timers for one formatter, and the wrappers that update them
+
+    Parameters
+    ----------
+    formatter : :py:class:`color_bucket_logger.ColorFormatter`
+    """
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.enabled = False
+        self.histogram = None
+        self.slowest = None
+        self._lock = threading.Lock()
+        # The (step, elapsed ns) of the timed steps of the record the thread is
+        # formatting, added to the totals with the rest of the record's counts
+        self._local = threading.local()
+        # (object, attr name, the instance attr it replaced or _MISSING)
+        self._installed = []
+
+        self.records = 0
+        self.exc_records = 0
+        self.bytes_emitted = 0
+        self.time_ns = dict.fromkeys(['format'] + [step[0] for step in TIMED_STEPS], 0)
+        self.calls = dict.fromkeys(self.time_ns, 0)
+
+    def reset(self):
+        """Zero the counters and timers, and the hit/miss counts of the color mapper's caches"""
+        with self._lock:
+            self.records = 0
+            self.exc_records = 0
+            self.bytes_emitted = 0
+            # zeroed in place, the timed wrappers hold on to the dicts
+            for step in self.time_ns:
+                self.time_ns[step] = 0
+                self.calls[step] = 0
+
+            if self.histogram is not None:
+                self.histogram.reset()
+            if self.slowest is not None:
+                self.slowest.reset()
+
+        color_mapper = self.formatter.color_mapper
+        for cache_name in ('name_cache', 'process_cache'):
+            lru_cache = getattr(color_mapper, cache_name, None)
+            if lru_cache is not None:
+                lru_cache.reset_stats()
+
+    def install(self, histogram=True, slowest=10):
+        """Replace the formatter's methods with timed versions
+
+        Parameters
+        ----------
+        histogram : boolean, optional
+            If true (the default), keep a LatencyHistogram of format() times
+        slowest : int, optional
+            Keep a summary of this many of the slowest records to format. Defaults to 10, 0 to not keep any.
+        """
+        if self.enabled:
+            self.uninstall()
+
+        with self._lock:
+            if histogram:
+                if self.histogram is None:
+                    self.histogram = LatencyHistogram()
+            else:
+                self.histogram = None
+            if slowest:
+                if self.slowest is None or self.slowest.n != slowest:
+                    self.slowest = SlowRecords(slowest)
+            else:
+                self.slowest = None
+
+        formatter = self.formatter
+        for step, path, method_name in TIMED_STEPS:
+            obj = formatter
+            for attr in path:
+                obj = getattr(obj, attr)
+            self._wrap(obj, method_name, self._timed(step, getattr(obj, method_name)))
+
+        self._wrap(formatter, 'format', self._counted_format(formatter.format))
+        self.enabled = True
+
+    def uninstall(self):
+        """Put back the methods install() replaced"""
+        while self._installed:
+            obj, method_name, replaced = self._installed.pop()
+            if replaced is _MISSING:
+                del obj.__dict__[method_name]
+            else:
+                setattr(obj, method_name, replaced)
+        self.enabled = False
+
+    def _wrap(self, obj, method_name, wrapper):
+        self._installed.append((obj, method_name, obj.__dict__.get(method_name, _MISSING)))
+        setattr(obj, method_name, wrapper)
+
+    def _timed(self, step, func):
+        lock = self._lock
+        local = self._local
+        time_ns = self.time_ns
+        calls = self.calls
+
+        def timed(*args, **kwargs):
+            start = _clock_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = _clock_ns() - start
+                pending = getattr(local, 'pending', None)
+                if pending is not None:
+                    # counted_format() adds it with the rest of the record, so
+                    # the lock is only taken once per record
+                    pending.append((step, elapsed))
+                else:
+                    with lock:
+                        time_ns[step] += elapsed
+                        calls[step] += 1
+        return timed
+
+    def _counted_format(self, format_func):
+        lock = self._lock
+        local = self._local
+        time_ns = self.time_ns
+        calls = self.calls
+        histogram = self.histogram
+        slowest = self.slowest
+
+        def counted_format(record):
+            # A record's str() could format another record with the same formatter
+            outer_pending = getattr(local, 'pending', None)
+            pending = local.pending = []
+            s = None
+            start = _clock_ns()
+            try:
+                s = format_func(record)
+            finally:
+                elapsed = _clock_ns() - start
+                local.pending = outer_pending
+                summary = None
+                if s is not None and slowest is not None and slowest.wants(elapsed):
+                    summary = slowest.summary(elapsed, record, s)
+                with lock:
+                    for step, step_elapsed in pending:
+                        time_ns[step] += step_elapsed
+                        calls[step] += 1
+                    if s is not None:
+                        time_ns['format'] += elapsed
+                        calls['format'] += 1
+                        self.records += 1
+                        self.bytes_emitted += utf8_len(s)
+                        if record.exc_info:
+                            self.exc_records += 1
+                        if histogram is not None:
+                            histogram.record(elapsed)
+                        if summary is not None:
+                            slowest.add(elapsed, summary)
+            return s
+        return counted_format
+
+    def latency_percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        """Return the LatencyHistogram export() dict, or None if there is no histogram"""
+        with self._lock:
+            if self.histogram is None:
+                return None
+            return self.histogram.export(percentiles)
+
+    def snapshot(self):
+        """Return the counters, timers, and cache stats as a dict"""
+        with self._lock:
+            snapshot = {'enabled': self.enabled,
+                        'records': self.records,
+                        'exc_records': self.exc_records,
+                        'bytes_emitted': self.bytes_emitted,
+                        'time_ns': dict(self.time_ns),
+                        'calls': dict(self.calls)}
+            if self.histogram is not None:
+                snapshot['latency'] = self.histogram.export()
+            if self.slowest is not None:
+                snapshot['slowest'] = self.slowest.records()
+
+        caches = {}
+        color_mapper = self.formatter.color_mapper
+        for cache_name in ('name_cache', 'process_cache'):
+            lru_cache = getattr(color_mapper, cache_name, None)
+            if lru_cache is not None:
+                caches[cache_name] = with_hit_rate(lru_cache.stats())
+        if self.formatter.exc_text_cache is not None:
+            caches['exc_text_cache'] = with_hit_rate(self.formatter.exc_text_cache.stats())
+        snapshot['caches'] = caches
+        return snapshot
@@ -11,14 +11,52 @@
 # not be used in advertising or publicity pertaining to distribution
 # of the software without specific, written prior permission.
 
+import collections
 import logging
 import re
+import threading
 from string import Formatter as StrFormatter
 
+from . import cache
+from . import compiler
+
 log = logging.getLogger(__name__)
 _str_formatter = StrFormatter()
 
 
+def _unique(items):
+    seen = set()
+    uniq = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            uniq.append(item)
+    return uniq
+
+
+#: Everything a style needs to know about a format string, see :py:meth:`PercentStyle.parse_format`
+#:
+#: format_attrs
+#:     The (full_attr, attr_name, ...) tuples of the attributes that get colors
+#: color_fmt
+#:     The format string with the '_cdl_*' color slots added
+#: fields
+#:     The names of the record attributes the format uses, in order
+#: validation_error
+#:     Why the format is not valid for the style, or None
+ParsedFormat = collections.namedtuple('ParsedFormat', ['format_attrs', 'color_fmt', 'fields', 'validation_error'])
+
+#: The max number of ParsedFormats kept for formatters to share
+PARSED_FORMATS_CACHE_SIZE = 128
+
+# The ParsedFormat of each (style class, format string). Parsing a format only depends
+# on the format, and a process usually has many formatters (one per handler) with the
+# same few formats, so each format is only parsed (and validated) once per process, as
+# long as it is one of the PARSED_FORMATS_CACHE_SIZE most recently used.
+_parsed_formats = cache.LRUCache(maxsize=PARSED_FORMATS_CACHE_SIZE)
+_parsed_formats_lock = threading.Lock()
+
+
 class PercentStyle(object):
 
     default_format = '%(message)s'
@@ -32,12 +70,64 @@ class PercentStyle(object):
     named_fields_pattern = r'''(?P<full_attr>%\((?P<attr_name>.*?)\)(?P<conversion_flag>[#0+ -]*)''' + \
         r'''(?P<field_width>\*|\d+)?(?P<precision>\.(\*|\d+))?(?P<conversion_type>[diouxefgcrsa%]))'''
 
-    def __init__(self, fmt):
+    #: The style name passed to :py:func:`color_bucket_logger.compiler.compile_format`
+    compile_style = '%'
+
+    #: Whether to use the compiled render function when compiled is None
+    compile_by_default = False
+
+    def __init__(self, fmt, compiled=None):
         self._fmt = fmt or self.default_format
 
         self._base_fmt = self._fmt
-        self._color_fmt = None
-        self._format_attrs = self.find_format_attrs(self._base_fmt)
+        parsed = self.parse_format(self._base_fmt)
+        if parsed.validation_error:
+            raise ValueError(parsed.validation_error)
+        self._format_attrs = parsed.format_attrs
+        self._color_fmt = parsed.color_fmt
+
+        #: The names of the record attributes the format uses
+        self.fields = parsed.fields
+
+        # If the color format compiles, format with the compiled render function
+        # instead of formatting the whole format string against the record context.
+        if compiled is None:
+            compiled = self.compile_by_default
+        self._render = None
+        if compiled:
+            self._render = compiler.compile_format(self.color_fmt, self.compile_style)
+        if self._render:
+            self._format = self._format_compiled
+
+        # The format without colors is always compiled if it can be. It is only used
+        # when not colorizing, where the point is to be as cheap as possible.
+        self._plain_render = compiler.compile_format(self._base_fmt, self.compile_style)
+        if self._plain_render:
+            self._format_plain = self._format_plain_compiled
+
+    def parse_format(self, format_string):
+        """Return the :py:data:`ParsedFormat` for format_string
+
+        The results are cached per (style, format_string) for the whole process, so only the
+        first formatter with a given format pays for parsing and validating it.
+        """
+        key = (self.__class__, format_string)
+        parsed = _parsed_formats.get(key)
+        if parsed is None:
+            with _parsed_formats_lock:
+                parsed = _parsed_formats.get(key)
+                if parsed is None:
+                    validation_error = self.check_format(format_string)
+                    if validation_error:
+                        parsed = ParsedFormat(format_attrs=(), color_fmt=None, fields=(), validation_error=validation_error)
+                    else:
+                        format_attrs = self.find_format_attrs(format_string)
+                        parsed = ParsedFormat(format_attrs=tuple(format_attrs),
+                                              color_fmt=self.context_color_format_string(format_string, format_attrs),
+                                              fields=tuple(_unique(self.find_fields(format_string))),
+                                              validation_error=None)
+                    _parsed_formats.set(key, parsed)
+        return parsed
 
     def context_color_format_string(self, format_string, format_attrs):
         """For extending a format string for :py:class:`logging.Formatter` to include attributes with color info.
@@ -52,6 +142,9 @@ class PercentStyle(object):
         """
 
         format_attrs = self.find_format_attrs(format_string)
+        if not format_attrs:
+            # Nothing to color ('%(message)r' for ex), and an empty alternation is not a valid regex
+            return r"%(_cdl_default)s" + format_string + r"%(_cdl_reset)s"
 
         color_attrs_string = '|'.join([x[1] for x in format_attrs])
 
@@ -107,13 +200,32 @@ class PercentStyle(object):
         return self._fmt.find(self.asctime_search) >= 0
 
     def validate(self):
-        """Validate the input format, ensure it matches the correct style"""
-        if not self.validation_pattern.search(self._fmt):
-            raise ValueError("Invalid format '%s' for '%s' style" % (self._fmt, self.default_format[0]))
+        """Validate the input format, ensure it matches the correct style
+
+        An invalid format already raised ValueError when the style was created, so this is a
+        no-op kept for compatibility with the :py:mod:`logging` styles. The format is checked
+        (once per process) by :py:meth:`parse_format`."""
+
+    def check_format(self, format_string):
+        """Return why format_string is not a valid format for the style, or None if it is"""
+        if not self.validation_pattern.search(format_string):
+            return "Invalid format '%s' for '%s' style" % (format_string, self.default_format[0])
+        return None
 
     def _format(self, record_context):
         return self.color_fmt % record_context
 
+    def _format_compiled(self, record_context):
+        # A RecordContext lets the render function skip straight to the record attrs
+        return self._render(record_context, getattr(record_context, 'record_dict', record_context))
+
+    def _format_plain(self, record_context):
+        # The format without any colors
+        return self._base_fmt % record_context
+
+    def _format_plain_compiled(self, record_context):
+        return self._plain_render(record_context, record_context.record_dict)
+
     def format(self, record):
         try:
             return self._format(record)
@@ -125,26 +237,33 @@ class PercentStyle(object):
 
         return format_attrs
 
+    def find_fields(self, format_string):
+        """Return the names of the record attributes format_string uses"""
+        return [match.group('attr_name') for match in compiler.percent_field_pattern.finditer(format_string)
+                if match.group('attr_name') is not None]
+
 
 # TODO: rename, and/or subclass the py3 classes
 class StrFormatStyle(PercentStyle):
     default_format = '{message}'
     asctime_format = '{asctime}'
     asctime_search = '{asctime'
+    compile_style = '{'
+
+    # str.format() parses the whole format string again for every record, and looks up
+    # every field through the RecordContext. The compiled render function looks the
+    # fields up directly, so '{' style formats are compiled unless asked not to be.
+    compile_by_default = True
 
     fmt_spec = re.compile(r'^(.?[<>=^])?[+ -]?#?0?(\d+|{\w+})?[,_]?(\.(\d+|{\w+}))?[bcdefgnosx%]?$', re.I)
     field_spec = re.compile(r'^(\d+|\w+)(\.\w+|\[[^]]+\])*$')
+    field_name_pattern = re.compile(r'[^.[]*')
 
     uber_format_pattern = r'(?P<full_attr>{(?P<attr_name>\d+|\w+)[:]?' + \
         r'(?P<modifiers>(?P<align>.?[<>=^]?)(?P<sign>[+ -]?)' + \
         r'#?0?(?P<width>\d+|{\w+})?[,_]?(\.(\d+|{\w+}))?' + \
         r'(?P<conversion_type>[bcdefgnosx%])?)})'
-
-    def find_format_attrs(self, format_string):
-        attrs_pattern = re.compile(self.uber_format_pattern)
-
-        format_attrs = attrs_pattern.findall(format_string)
-        return format_attrs
+    attrs_pattern = re.compile(uber_format_pattern)
 
     def context_color_format_string(self, format_string, format_attrs):
         format_attrs = self.find_format_attrs(format_string)
@@ -165,14 +284,28 @@ class StrFormatStyle(PercentStyle):
 
         return format_string
 
-    def _format(self, record_context):
-        return self.color_fmt.format(**record_context)
-
-    def validate(self):
-        """Validate the input format, ensure it is the correct string formatting style"""
+    if hasattr(str, 'format_map'):
+        def _format(self, record_context):
+            # format_map instead of format(**record_context) so a RecordContext does
+            # not get copied into kwargs
+            return self.color_fmt.format_map(record_context)
+
+        def _format_plain(self, record_context):
+            return self._base_fmt.format_map(record_context)
+    else:
+        # py2 str has no format_map, but Formatter.vformat() looks the fields up
+        # in the mapping it is given the same way.
+        def _format(self, record_context):
+            return _str_formatter.vformat(self.color_fmt, (), record_context)
+
+        def _format_plain(self, record_context):
+            return _str_formatter.vformat(self._base_fmt, (), record_context)
+
+    def check_format(self, format_string):
+        """Return why format_string is not a valid format for the style, or None if it is"""
         fields = set()
         try:
-            for _, fieldname, spec, conversion in _str_formatter.parse(self._fmt):
+            for _, fieldname, spec, conversion in _str_formatter.parse(format_string):
                 if fieldname:
                     if not self.field_spec.match(fieldname):
                         raise ValueError('invalid field name/expression: %r' % fieldname)
@@ -182,9 +315,28 @@ class StrFormatStyle(PercentStyle):
                 if spec and not self.fmt_spec.match(spec):
                     raise ValueError('bad specifier: %r' % spec)
         except ValueError as e:
-            raise ValueError('invalid format: %s' % e)
+            return 'invalid format: %s' % e
         if not fields:
-            raise ValueError('invalid format: no fields')
+            return 'invalid format: no fields'
+        return None
+
+    def find_fields(self, format_string):
+        """Return the names of the record attributes format_string uses
+
+        For fields like '{args[0]}' or '{exc_info.__class__}', that is just the attribute name."""
+        try:
+            parsed = list(_str_formatter.parse(format_string))
+        except ValueError:
+            return []
+
+        fields = []
+        for _, fieldname, spec, _conversion in parsed:
+            if fieldname:
+                fields.append(self.field_name_pattern.match(fieldname).group(0))
+            if spec and '{' in spec:
+                # nested fields, like '{message:{width}}'
+                fields.extend(self.find_fields(spec))
+        return fields
 
 
 BASIC_FORMAT = "%(levelname)s:%(name)s:%(message)s"
@@ -1,12 +1,13 @@
 '''256 color terminal handling
 
-ALL_COLORS is a dict mapping color indexes to the ANSI escape code.
-ALL_COLORS is essentially a "palette".
+PALETTE is the :py:class:`Palette` of ANSI escape codes the term mapper
+uses. A Palette is essentially a tuple of escape code strings indexed by
+color index, plus a couple of reserved indexes for the 'reset' and 'default'
+sequences.
 
-Note that ALL_COLORS is a dict that (mostly) uses integers as the keys.
-Yeah, that is weird. In theory, the keys could also be other identifiers,
-although that isn't used much at the moment. So, yeah, could/should just
-be a list/array.
+ALL_COLORS is the older dict view of the same palette, mapping color indexes
+to the ANSI escape code. It only has the indexes that are actually used. It
+is a read only :py:class:`PaletteView` of PALETTE, so the two can not differ.
 
 Also note that the ordering of the color indexes is fairly arbitrary.
 It mostly follows the order of the ANSI escape codes. But it is
@@ -26,6 +27,85 @@ The default color index:
     DEFAULT_COLOR_IDX
 '''
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class Palette(object):
+    """An indexable palette of pre-encoded color sequences
+
+    Parameters
+    ----------
+    sequences : iterable of str
+        The escape sequence for each color index, including the reserved reset and
+        default indexes.
+    offset : int
+        The first color index the mappers hash values into.
+    number_of_colors : int
+        The number of color indexes (starting at offset) the mappers hash values into.
+    reset_idx : int
+        The index of the sequence that resets all colors.
+    default_idx : int
+        The index of the default color sequence. The mappers use it as the placeholder
+        for 'use the default_color_by_attr color'.
+    rgb : iterable of tuple, optional
+        The 8 bit (r, g, b) of each of the number_of_colors colors, if known.
+        See :py:mod:`color_bucket_logger.palettes`
+    """
+    __slots__ = ('sequences', 'offset', 'number_of_colors', 'reset_idx', 'default_idx', 'rgb')
+
+    def __init__(self, sequences, offset, number_of_colors, reset_idx, default_idx, rgb=None):
+        self.sequences = tuple(sequences)
+        self.offset = offset
+        self.number_of_colors = number_of_colors
+        self.reset_idx = reset_idx
+        self.default_idx = default_idx
+        self.rgb = tuple(rgb) if rgb is not None else None
+
+    def __repr__(self):
+        return '%s(len=%s, offset=%s, number_of_colors=%s)' % \
+            (self.__class__.__name__, len(self.sequences), self.offset, self.number_of_colors)
+
+    def __getitem__(self, idx):
+        return self.sequences[idx]
+
+    def __len__(self):
+        return len(self.sequences)
+
+
+class PaletteView(Mapping):
+    """A read only dict of some of the color indexes of a :py:class:`Palette` to their sequences
+
+    Parameters
+    ----------
+    palette : :py:class:`Palette`
+        The palette the sequences come from.
+    color_idxs : iterable of int
+        The color indexes in the view, in order.
+    """
+
+    def __init__(self, palette, color_idxs):
+        self._palette = palette
+        self._color_idxs = tuple(color_idxs)
+        self._color_idx_set = frozenset(self._color_idxs)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+
+    def __getitem__(self, idx):
+        if idx not in self._color_idx_set:
+            raise KeyError(idx)
+        return self._palette.sequences[idx]
+
+    def __iter__(self):
+        return iter(self._color_idxs)
+
+    def __len__(self):
+        return len(self._color_idxs)
+
+
 # hacky ansi color stuff
 RESET_SEQ = "\033[0m"
 COLOR_SEQ = "\033[1;%dm"
@@ -33,8 +113,6 @@ BOLD_SEQ = "\033[1m"
 
 NUMBER_OF_BASE_COLORS = 8
 
-ALL_COLORS = {}
-
 # See https://en.wikipedia.org/wiki/ANSI_escape_code#8-bit
 
 #: Used to determine what color index we start from.
@@ -52,26 +130,12 @@ ALL_COLORS = {}
 #:   232-255 are the grays (white to gray to black) and are skipped and why END_OF_THREAD_COLORS is 231.
 RGB_COLOR_OFFSET = 16 + 2
 
-# FIXME: needs to learn to support dark/light themes
+# For dark/light themes, see the truecolor palettes in color_bucket_logger.palettes
 START_OF_THREAD_COLORS = RGB_COLOR_OFFSET
 END_OF_THREAD_COLORS = 231
 NUMBER_OF_THREAD_COLORS = END_OF_THREAD_COLORS - RGB_COLOR_OFFSET
 
-BASE_COLORS = dict((color_number, color_seq) for
-                   (color_number, color_seq) in [(x, "\033[38;5;%dm" % x) for x in range(NUMBER_OF_BASE_COLORS)])
-# \ x 1 b [ 38 ; 5; 231m
-THREAD_COLORS = dict((color_number, color_seq) for
-                     (color_number, color_seq) in [(x, "\033[38;5;%dm" % x) for x in range(START_OF_THREAD_COLORS, END_OF_THREAD_COLORS)])
-
-ALL_COLORS.update(BASE_COLORS)
-ALL_COLORS.update(THREAD_COLORS)
-
-#: The number of total colors when excluded and skipped colors
-#: are considered. The color mappers use this to know what
-#: number to modulus (%) by to figure out the color bucket.
-NUMBER_OF_ALL_COLORS = len(ALL_COLORS) - RGB_COLOR_OFFSET
-
-BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = BASE_COLORS.keys()
+BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(NUMBER_OF_BASE_COLORS)
 
 #: Some named colors that map to the first 8 terminal colors
 NAMED_COLOR_IDXS = {'BLACK': BLACK,
@@ -86,11 +150,32 @@ NAMED_COLOR_IDXS = {'BLACK': BLACK,
 
 #: The index for a 'reset'
 RESET_SEQ_IDX = 256
-ALL_COLORS[RESET_SEQ_IDX] = RESET_SEQ
 
 #: The index for the default 'default' color
 DEFAULT_COLOR_IDX = 257
 
 #: The default color (white)
 DEFAULT_COLOR = NAMED_COLOR_IDXS['WHITE']
-ALL_COLORS[DEFAULT_COLOR_IDX] = ALL_COLORS[DEFAULT_COLOR]
+
+_BASE_COLOR_IDXS = tuple(range(NUMBER_OF_BASE_COLORS))
+# \ x 1 b [ 38 ; 5; 231m
+_THREAD_COLOR_IDXS = tuple(range(START_OF_THREAD_COLORS, END_OF_THREAD_COLORS))
+_ALL_COLOR_IDXS = _BASE_COLOR_IDXS + _THREAD_COLOR_IDXS + (RESET_SEQ_IDX, DEFAULT_COLOR_IDX)
+
+#: The number of total colors when excluded and skipped colors
+#: are considered. This is the number_of_colors of PALETTE, the
+#: color mappers use their palette's number_of_colors to know what
+#: number to modulus (%) by to figure out the color bucket.
+NUMBER_OF_ALL_COLORS = len(_BASE_COLOR_IDXS) + len(_THREAD_COLOR_IDXS) - RGB_COLOR_OFFSET
+
+#: The xterm256 palette. Indexes 0-255 are the xterm color numbers (including the
+#: skipped ones), followed by the reset and default sequences.
+PALETTE = Palette(sequences=["\033[38;5;%dm" % x for x in range(RESET_SEQ_IDX)] + [RESET_SEQ, "\033[38;5;%dm" % DEFAULT_COLOR],
+                  offset=RGB_COLOR_OFFSET,
+                  number_of_colors=NUMBER_OF_ALL_COLORS,
+                  reset_idx=RESET_SEQ_IDX,
+                  default_idx=DEFAULT_COLOR_IDX)
+
+BASE_COLORS = PaletteView(PALETTE, _BASE_COLOR_IDXS)
+THREAD_COLORS = PaletteView(PALETTE, _THREAD_COLOR_IDXS)
+ALL_COLORS = PaletteView(PALETTE, _ALL_COLOR_IDXS)
@@ -15,8 +15,13 @@ class TermColorMapper(mapper.BaseColorMapper):
                     # bold red?
                     'CRITICAL': term_colors.RED}
 
+    #: The number of colors of the default palette. Kept for compatibility, the
+    #: color buckets come from palette.number_of_colors
     NUMBER_OF_COLORS = term_colors.NUMBER_OF_ALL_COLORS
 
+    #: The :py:class:`color_bucket_logger.term_colors.Palette` color indexes refer to
+    palette = term_colors.PALETTE
+
     # TODO: tie tid/threadName and process/processName together so they start same color
     #       so MainProcess, the first pid/processName are same, and maybe MainThread//first tid
     # DOWNSIDE: requires tracking all seen pid/process/tid/threadName ? that could be odd with multi-processes with multi instances
@@ -43,19 +48,63 @@ class TermColorMapper(mapper.BaseColorMapper):
         """
 
         # 220 is useable 256 color term color (forget where that comes from? some min delta-e division of 8x8x8 rgb colorspace?)
-        thread_mod = threadid % self.NUMBER_OF_COLORS
-        return thread_mod + term_colors.RGB_COLOR_OFFSET
+        thread_mod = threadid % self.palette.number_of_colors
+        return thread_mod + self.palette.offset
 
-    # TODO: This could special case 'MainThread'/'MainProcess' to pick a good predictable color
     def get_name_color(self, name, perturb=None):
+        """Calculate the color index for a value, usually a string like a logger name
+
+        Results are memoized in the mapper's name_cache.
+
+        Parameters
+        ----------
+        name : object
+            The value to find a color for. Usually a str, but any record attribute
+            value works.
+        perturb : str, optional
+            Extra string hashed along with name, to shift the color a value lands on.
+
+        Returns
+        -------
+        int
+        The color index to use
+        """
+        name_cache = self.name_cache
+        if name_cache is None:
+            return self._get_name_color(name, perturb)
+
+        # The value's type is part of the key since 1, 1.0 and True are
+        # equal as keys, but render to different strings.
+        key = (name.__class__, name, perturb)
+        try:
+            color = name_cache.get(key)
+        except TypeError:
+            # unhashable values (a dict passed in via 'extra' for ex) are not cached
+            return self._get_name_color(name, perturb)
+
+        if color is None:
+            color = self._get_name_color(name, perturb)
+            name_cache.set(key, color)
+        return color
+
+    # TODO: This could special case 'MainThread'/'MainProcess' to pick a good predictable color
+    def _get_name_color(self, name, perturb=None):
         perturb = perturb or ''
         # perturb = 'dsfadddddd'
 
         name = '%s%s' % (name, perturb)
 
-        name_hash = sum([ord(x) for x in name])
-        name_mod = name_hash % self.NUMBER_OF_COLORS
-        return name_mod + term_colors.RGB_COLOR_OFFSET
+        name_hash = self.hash_function(name)
+        name_mod = name_hash % self.palette.number_of_colors
+        return name_mod + self.palette.offset
+
+    def get_registry_color(self, key):
+        """Return the color index the mapper's color_registry has for key
+
+        Returns None if there is no color_registry (or it is full)."""
+        if self.color_registry is None:
+            return None
+        return self.color_registry.color_index(key, self.palette)
 
     def get_level_color(self, levelname, levelno):
         level_color = self.LEVEL_COLORS.get(levelname, None)
@@ -79,6 +128,13 @@ class TermColorMapper(mapper.BaseColorMapper):
         -----
             This doesn't track any state so there is no ordering or prefence to the colors given out.
 
+            The colors only depend on the (processName, process, threadName, thread) values,
+            so they are memoized in the mapper's process_cache.
+
+            With a color_registry, the processName and pid colors come from the registry
+            instead, so they are distinct (in order of first appearance) and consistent across
+            the processes and formatters sharing it.
+
         Parameters
         ----------
         record_context : :py:class:`dict`
@@ -95,18 +151,34 @@ class TermColorMapper(mapper.BaseColorMapper):
         tname = record_context['threadName']
         tid = record_context['thread']
 
+        process_cache = self.process_cache
+        if process_cache is None:
+            return self._get_process_colors(pname, pid, tname, tid)
+
+        key = (pname, pid, tname, tid)
+        process_colors = process_cache.get(key)
+        if process_colors is None:
+            process_colors = self._get_process_colors(pname, pid, tname, tid)
+            process_cache.set(key, process_colors)
+        return process_colors
+
+    def _get_process_colors(self, pname, pid, tname, tid):
         # 'pname' is almost always 'MainProcess' which ends up a ugly yellow. perturb is here to change the color
         # that 'MainProcess' ends up to a nicer light green
         perturb = 'pseudoenthusiastically'
 
         # combine pid+pname otherwise, all MainProcess will get the same pname
         pid_label = '%s%s' % (pname, pid)
-        pname_color = self.get_name_color(pid_label, perturb=perturb)
+        pname_color = self.get_registry_color('processName:%s' % pid_label)
+        if pname_color is None:
+            pname_color = self.get_name_color(pid_label, perturb=perturb)
 
         if pname == 'MainProcess':
             pid_color = pname_color
         else:
-            pid_color = self.get_thread_color(pid)
+            pid_color = self.get_registry_color('process:%s' % pid)
+            if pid_color is None:
+                pid_color = self.get_thread_color(pid)
 
         if tname == 'MainThread':
             # tname_color = pname_color
@@ -123,48 +195,37 @@ class TermColorMapper(mapper.BaseColorMapper):
     #       so that the entire blurb about process info matches instead of just the attribute
     #       - also allows format to just expand a '%(threadName)s' in fmt string to '%(theadNameColor)s%(threadName)s%(reset)s' before regular formatter
     # DOWNSIDE: Filter would need to be attach to the Logger not the Handler
-    def get_colors_for_record(self, record_context, format_attrs):
-        """For a  record_context dict, compute color for each field and return a color dict"""
+    def get_colors_for_record(self, record_context, format_attrs=None):
+        """For a  record_context dict, compute color for each field and return a color dict
+
+        The work that does not depend on the record is done once, in
+        :py:meth:`compile_plan`. Passing a format_attrs other than the one the mapper
+        was created with uses the (shared) plan for it."""
 
-        _default_color_index = term_colors.DEFAULT_COLOR_IDX
-        _color_by_attr_index = _default_color_index
+        # Records with exception text also need the '_cdl_exc_text' color
+        exc = bool(record_context.get('exc_text', None))
+        plan = self.exc_plan if exc else self.plan
+        if format_attrs is not None and format_attrs is not self.format_attrs \
+                and tuple(format_attrs) != self.format_attrs:
+            plan = self.get_plan(format_attrs, exc=exc)
+
+        palette = self.palette
+        _default_color_index = palette.default_idx
 
         # 'cdl' is 'context debug logger'. Mostly just an unlikely record name to avod name collisions.
-        colors = {'_cdl_default': _default_color_index,
-                  '_cdl_unset': _default_color_index,
-                  '_cdl_reset': term_colors.RESET_SEQ_IDX}
-
-        # populate the record with values for any _cdl_* attrs we will use
-        # could be format_attrs (actually used in format string) + any referenced as color_group keys
-        group_by_attrs = [y[0] for y in self.group_by]
-
-        record_format_attrs = [z[1] for z in format_attrs] + ['exc_text']
-
-        attrs_needed = group_by_attrs + record_format_attrs
-        for attr_needed in attrs_needed:
-            cdl_name = '_cdl_%s' % attr_needed
-            colors[cdl_name] = _default_color_index
-
-        use_level_color = 'levelname' in group_by_attrs or 'levelno' in group_by_attrs
-        # NOTE: the impl here is based on info from just the LogRecord and should be okay across threads
-        #       If this wants to use more global data, beware...
-        if use_level_color:
-            level_color = self.get_level_color(record_context['levelname'], record_context['levelno'])
-            colors['_cdl_levelname'] = level_color
-
-        # set a different color for each logger name. And by default, make filename, funcName, and lineno match.
-        use_name_color = 'name' in group_by_attrs or self.auto_color
-        if use_name_color:
-            module_and_method_color = self.get_name_color(record_context['name'])
-            colors['_cdl_name'] = module_and_method_color
-            # group mapping should take care of the rest of these once _cdl_name is set
+        colors = dict.fromkeys(plan.slots, _default_color_index)
+        colors['_cdl_reset'] = palette.reset_idx
 
-        use_thread_color = False
-        for attr in ['process', 'processName', 'thread', 'threadName']:
-            if attr in group_by_attrs:
-                use_thread_color = True
+        # NOTE: Only colors (local to this call) and the caches are written to here, the mapper
+        #       configuration is read only. Keep it that way, the mapper is shared by threads.
+        if plan.use_level_color:
+            colors['_cdl_levelname'] = self.get_level_color(record_context['levelname'], record_context['levelno'])
+
+        if plan.use_name_color:
+            # group mapping should take care of the rest of these once _cdl_name is set
+            colors['_cdl_name'] = self.get_name_color(record_context['name'])
 
-        if use_thread_color or self.auto_color:
+        if plan.use_process_colors:
             pname_color, pid_color, tname_color, tid_color = self.get_process_colors(record_context)
 
             colors['_cdl_process'] = pid_color
@@ -173,53 +234,21 @@ class TermColorMapper(mapper.BaseColorMapper):
             colors['_cdl_threadName'] = tname_color
             colors['_cdl_exc_text'] = tid_color
 
-        # fields we don't need to calculate indiv, since they will be a different group
-        in_a_group = set()
-
-        # find the color for any group keys before setting colors for group members
-        # TODO: extend group keys to let them be tuples
-        #       to allow (name, funcName) to get a color for module.function() instead of two sep
-        #       sim to module_and_method_color above
-        for group in group_by_attrs:
-            group_color = colors.get('_cdl_%s' % group, _default_color_index)
-            if group in self.custom_attrs or group in in_a_group:
-                continue
-
-            # record.message isnt 'rendered' until after the format
-            if group == 'message':
-                color_idx = self.get_name_color(record_context['_cdl_xmessage'])
-            else:
-                # default to empty string for non existent record attributes ('extra', etc)
-                color_idx = self.get_name_color(record_context.get(group, ''), 'sdsdf')
-            colors['_cdl_%s' % group] = color_idx
-
-        for group, members in self.group_by:
-            group_color = colors.get('_cdl_%s' % group, _default_color_index)
-
-            for member in members:
-                colors['_cdl_%s' % member] = group_color
-                if member == 'default':
-                    self.default_color_by_attr = group
-                in_a_group.add(member)
-
-        # for everything else, use the name/string to get a color if auto_colors is True
-        for needed_attr in attrs_needed:
-            if needed_attr in self.custom_attrs or needed_attr in in_a_group \
-                    or needed_attr in self.high_cardinality or not self.auto_color:
-                continue
-            color_idx = self.get_name_color(record_context.get(needed_attr, ''))
-            colors['_cdl_%s' % needed_attr] = color_idx
+        for cdl_name, attr, perturb in plan.leader_ops:
+            colors[cdl_name] = self.get_name_color(record_context.get(attr, ''), perturb)
+
+        for member_cdl_name, group_cdl_name in plan.member_ops:
+            colors[member_cdl_name] = colors[group_cdl_name]
+
+        for cdl_name, attr in plan.auto_ops:
+            colors[cdl_name] = self.get_name_color(record_context.get(attr, ''))
 
         # set the default color based on computed values, lookup the color
         # mapped to the attr default_color_by_attr  (ie, if 'process', lookup
         # record._cdl_process and set self.default_color to that value
-        default_attr_string = '_cdl_%s' % self.default_color_by_attr
-        _color_by_attr_index = colors[default_attr_string]
-
-        name_to_color_map = {}
-        for cdl_name, cdl_idx in colors.items():
-            # FIXME: revisit setting default idx to a color based on string
-            if cdl_idx == term_colors.DEFAULT_COLOR_IDX:
-                cdl_idx = _color_by_attr_index
-            name_to_color_map[cdl_name] = term_colors.ALL_COLORS[cdl_idx]
-        return name_to_color_map
+        sequences = palette.sequences
+        _color_by_attr_sequence = sequences[colors[plan.default_key]]
+
+        # FIXME: revisit setting default idx to a color based on string
+        return {cdl_name: _color_by_attr_sequence if cdl_idx == _default_color_index else sequences[cdl_idx]
+                for cdl_name, cdl_idx in colors.items()}
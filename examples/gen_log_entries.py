@@ -127,7 +127,7 @@ def run(throw_exc=False):
     gen_log_events(thread_msg='Just the main thread', throw_exc=throw_exc)
 
 
-def run_threaded(thread_count=2, throw_exc=False):
+def run_threaded(thread_count=2, throw_exc=False, iterations=1):
     threads = []
     timers = []
     thread_time_increment = 0.001  # seconds
@@ -143,11 +143,16 @@ def run_threaded(thread_count=2, throw_exc=False):
 
     signal.signal(signal.SIGINT, fire_event)
 
+    def gen_log_events_repeatedly(*args):
+        # More log events per thread, for benchmarks
+        for _iteration in range(iterations):
+            gen_log_events(*args)
+
     for i in range(thread_count):
         interval = thread_time_increment * i
         # interval = 0
         t = threading.Timer(interval=interval,
-                            function=gen_log_events,
+                            function=gen_log_events_repeatedly,
                             # Timers use auto created threadname 'Thread-$count', where count starts at 1,
                             # hence the +1 here.
                             args=('msg from thread #%s' % (i + 1,),
@@ -155,8 +160,8 @@ def run_threaded(thread_count=2, throw_exc=False):
                                   stop_event))
         # An example of threads where they have a vague unuseful threadName
         # For ex, when there are 10 threads all named 'helper'
-        named_thread = threading.Thread(target=gen_log_events, name='VagueThreadName',
-                             args=('msg from vague thread #%s' % i, stop_event))
+        named_thread = threading.Thread(target=gen_log_events_repeatedly, name='VagueThreadName',
+                                        args=('msg from vague thread #%s' % i, stop_event))
         timers.append(t)
         threads.append(named_thread)
         t.daemon = True
@@ -2,14 +2,23 @@
 # -*- coding: utf-8 -*-
 
 """Tests for `color_bucket_logger` package."""
+import io
 import logging
 import logging.config
+import os
+import re
+import string
 import sys
 import threading
 
 import logging_tree
 import pytest
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     from logging import NullHandler
 except ImportError:
@@ -54,9 +63,17 @@ def teardown_config():
     logging.config.dictConfig(min_log_config)
 
 
+@pytest.fixture(autouse=True)
+def color_environ(monkeypatch):
+    # The tests check the colors, so don't let the environment turn them off
+    monkeypatch.delenv('NO_COLOR', raising=False)
+    if os.environ.get('TERM') == 'dumb':
+        monkeypatch.delenv('TERM')
+
+
 def setup_logger(color_groups=None, fmt=None,
                  formatter_class=None, auto_color=False,
-                 default_color_by_attr=None):
+                 default_color_by_attr=None, **formatter_kwargs):
     formatter_class = formatter_class or color_bucket_logger.ColorFormatter
     color_groups = color_groups or [('name', ['name', 'levelname'])]
 
@@ -64,7 +81,8 @@ def setup_logger(color_groups=None, fmt=None,
     formatter = formatter_class(fmt=fmt,
                                 default_color_by_attr=default_color_by_attr or 'name',
                                 color_groups=color_groups,
-                                auto_color=auto_color)
+                                auto_color=auto_color,
+                                **formatter_kwargs)
 
     logger = logging.getLogger(__name__ + '.test_logger')
     logger.disabled = False
@@ -144,8 +162,8 @@ def test_term_formatter_no_args():
 
     # The default is to colorize by logger name, so setup two
     # loggers, and assert they got expected color therefore different
-    other_exp = '\x1b[38;5;53m'
-    too_loudly_exp = '\x1b[38;5;70m'
+    other_exp = '\x1b[38;5;49m'
+    too_loudly_exp = '\x1b[38;5;179m'
 
     for logged_item in handler.buf:
         testlog.debug('logged_item: %s', logged_item)
@@ -166,13 +184,40 @@ def test_get_name_color():
 
     for logged_item in handler.buf:
         # the expected rendered output include term escape codes
-        expected_levelname = 'levelname=\x1b[38;5;70mDEBUG\x1b[38;5;70m'
-        expected_message = 'message=\x1b[38;5;70mfooblip\x1b[38;5;70m\x1b[0m'
+        expected_levelname = 'levelname=\x1b[38;5;179mDEBUG\x1b[38;5;179m'
+        expected_message = 'message=\x1b[38;5;179mfooblip\x1b[38;5;179m\x1b[0m'
         testlog.debug('logged_item: %s', logged_item)
         assert expected_levelname in logged_item
         assert expected_message in logged_item
 
 
+def test_legacy_sum_hash():
+    # The colors picked before crc32 was the default
+    logger, handler, formatter = setup_logger(color_groups=[('name', ['name', 'levelname'])],
+                                              fmt='levelname=%(levelname)s name=%(name)s message=%(message)s',
+                                              hash_function='sum')
+    logger.debug('foo%s', 'blip')
+
+    assert 'levelname=\x1b[38;5;70mDEBUG\x1b[38;5;70m' in handler.buf[0]
+    assert 'message=\x1b[38;5;70mfooblip\x1b[38;5;70m\x1b[0m' in handler.buf[0]
+
+
+def test_hash_functions():
+    from color_bucket_logger import hashing
+
+    assert hashing.get_hash_function() is hashing.crc32_hash
+    assert hashing.get_hash_function('sum')('ab') == ord('a') + ord('b')
+    assert hashing.crc32_hash('Thread-1') != hashing.crc32_hash('Thread-2')
+    assert hashing.crc32_hash(u'\u2603 \ud800') >= 0
+    assert hashing.crc32_hash(b'caf\xc3\xa9') == hashing.crc32_hash(u'caf\xe9')
+
+    mapper = color_bucket_logger.term_mapper.TermColorMapper(hash_function=len)
+    assert mapper.get_name_color('abc') == mapper.palette.offset + 3
+
+    with pytest.raises(ValueError):
+        hashing.get_hash_function('md5')
+
+
 def test_default_color_by_just_message():
     logger, handler, formatter = setup_logger(color_groups=[],
                                               default_color_by_attr='message',
@@ -186,8 +231,8 @@ def test_default_color_by_just_message():
 
     for logged_item in handler.buf:
         testlog.debug('logged_item: %s', logged_item)
-        expected_default = '\x1b[38;5;113m'
-        other_expected_default = '\x1b[38;5;52m'
+        expected_default = '\x1b[38;5;108m'
+        other_expected_default = '\x1b[38;5;161m'
         if 'some_msg1' in logged_item:
             assert expected_default in logged_item
         if 'some other msg 2' in logged_item:
@@ -199,7 +244,8 @@ def test_get_thread_color():
                                                             ('thread', ['thread']),
                                                             ('levelname', ['levelname', 'levelno'])],
                                               auto_color=True,
-                                              fmt='levelname=%(levelname)s tid=%(thread)d tname=%(threadName)s pid=%(process)d proccess=%(processName)s name=%(name)s message=%(message)s')
+                                              fmt='levelname=%(levelname)s tid=%(thread)d tname=%(threadName)s pid=%(process)d '
+                                                  'proccess=%(processName)s name=%(name)s message=%(message)s')
 
     logger.debug('foo%s', 'blip')
 
@@ -231,7 +277,7 @@ def test_get_thread_color():
         testlog.debug('logged_item: %s', logged_item)
         # assert expected_levelname in logged_item
         # assert 'name=tests.test_color_bucket_logger.test_logger' in logged_item
-        assert '=\x1b[38;5;70mtests.test_color_bucket_logger.test_logger' in logged_item
+        assert '=\x1b[38;5;179mtests.test_color_bucket_logger.test_logger' in logged_item
         # assert expected_message in logged_item
 
 
@@ -244,7 +290,8 @@ def test_exception_formatter():
                                                             ('thread', ['thread']),
                                                             ('levelname', ['levelname', 'levelno'])],
                                               auto_color=True,
-                                              fmt='levelname=%(levelname)s tid=%(thread)d tname=%(threadName)s pid=%(process)d proccess=%(processName)s name=%(name)s message=%(message)s')
+                                              fmt='levelname=%(levelname)s tid=%(thread)d tname=%(threadName)s pid=%(process)d '
+                                                  'proccess=%(processName)s name=%(name)s message=%(message)s')
 
     logger.debug('test_exception_formatter')
 
@@ -260,7 +307,7 @@ def test_exception_formatter():
 
     for logged_item in handler.buf:
         testlog.debug('logged_item: %s', logged_item)
-        assert '=\x1b[38;5;70mtests.test_color_bucket_logger.test_logger' in logged_item
+        assert '=\x1b[38;5;179mtests.test_color_bucket_logger.test_logger' in logged_item
 
 
 def test_created_time():
@@ -356,3 +403,1236 @@ def test_null_handler(response):
     nh = NullHandler()
     formatter = color_bucket_logger.ColorFormatter()
     nh.setFormatter(formatter)
+
+
+def test_color_plan():
+    format_attrs = color_bucket_logger.formatter.find_format_attrs('%(levelname)s %(tsx_id)s %(message)s')
+    mapper = color_bucket_logger.term_mapper.TermColorMapper(color_groups=[('tsx_id', ['message', 'default'])],
+                                                             format_attrs=format_attrs)
+    plan = mapper.plan
+
+    # A 'default' group member makes the group leader the default color attr
+    assert mapper.default_color_by_attr == 'tsx_id'
+    assert plan.default_key == '_cdl_tsx_id'
+    assert ('_cdl_tsx_id', 'tsx_id', 'sdsdf') in plan.leader_ops
+    assert ('_cdl_message', '_cdl_tsx_id') in plan.member_ops
+    assert not plan.use_level_color
+    assert not plan.use_process_colors
+    assert plan.auto_ops == ()
+
+    record_context = {'name': 'foo', 'levelname': 'INFO', 'levelno': logging.INFO,
+                      'tsx_id': 1234, '_cdl_xmessage': 'blip'}
+    colors = mapper.get_colors_for_record(record_context, format_attrs)
+    assert colors == mapper.get_colors_for_record(record_context)
+    assert colors['_cdl_message'] == colors['_cdl_tsx_id'] == colors['_cdl_levelname']
+    # The plan is not rebuilt or modified by coloring records
+    assert mapper.plan is plan
+
+
+def test_color_plan_pruned():
+    format_attrs = color_bucket_logger.formatter.find_format_attrs('%(levelname)s %(message)s')
+    mapper = color_bucket_logger.term_mapper.TermColorMapper(color_groups=[('thread', ['processName'])],
+                                                             format_attrs=format_attrs,
+                                                             auto_color=True)
+    plan = mapper.plan
+
+    # Nothing in the format uses the process or thread colors
+    assert not plan.use_process_colors
+    assert ('_cdl_processName', '_cdl_thread') not in plan.member_ops
+    # The default color comes from the 'name' group leader, which overwrites get_name_color(name)
+    assert not plan.use_name_color
+    assert plan.leader_ops == (('_cdl_name', 'name', 'sdsdf'),)
+    assert plan.input_attrs == ('name',)
+    assert '_cdl_exc_text' not in plan.slots
+
+    # exception text is colored like the thread
+    assert mapper.exc_plan.use_process_colors
+
+    record_context = {'name': 'foo', 'levelname': 'INFO', 'levelno': logging.INFO, 'exc_text': None}
+    colors = mapper.get_colors_for_record(record_context)
+    assert set(['_cdl_default', '_cdl_unset', '_cdl_reset', '_cdl_levelname', '_cdl_message']) <= set(colors)
+    assert '_cdl_process' not in colors
+
+    record_context.update({'exc_text': 'Traceback', 'process': 1, 'processName': 'MainProcess',
+                           'thread': 2, 'threadName': 'MainThread'})
+    assert '_cdl_exc_text' in mapper.get_colors_for_record(record_context)
+
+
+def test_mapper_read_only():
+    mapper = color_bucket_logger.term_mapper.TermColorMapper(color_groups=[('tsx_id', ['message', 'default'])])
+    assert mapper.color_groups == (('tsx_id', ('message', 'default')),)
+    assert mapper.group_by == (('name', ('name',)), ('tsx_id', ('message', 'default')))
+
+    for attr in ('default_color_by_attr', 'auto_color', 'plan', 'palette', 'name_cache', '_frozen'):
+        with pytest.raises(AttributeError):
+            setattr(mapper, attr, None)
+    with pytest.raises(AttributeError):
+        del mapper.plan
+    assert mapper.default_color_by_attr == 'tsx_id'
+
+    record_context = {'name': 'foo', 'levelname': 'INFO', 'levelno': logging.INFO, 'tsx_id': 1234, '_cdl_xmessage': 'blip'}
+    mapper.get_colors_for_record(record_context)
+    assert mapper.default_color_by_attr == 'tsx_id'
+
+
+@pytest.mark.parametrize("free_threaded", [False, True])
+def test_formatter_threads_deterministic(free_threaded):
+    import random
+
+    fmt = '%(asctime)s %(levelname)s %(processName)s %(threadName)s %(thread)d %(name)s %(tsx_id)s - %(message)s'
+    # A small name cache, so the threads keep evicting each other's entries
+    formatter_kwargs = dict(fmt=fmt, auto_color=True, name_cache_size=16, free_threaded=free_threaded,
+                            color_groups=[('tsx_id', ['message', 'default']), ('thread', ['levelname'])])
+    shared_formatter = color_bucket_logger.TermFormatter(**formatter_kwargs)
+
+    records = []
+    for index in range(300):
+        record = logging.LogRecord('app.module%d' % (index % 37), logging.INFO + 10 * (index % 3), __file__, index,
+                                   'request %s', (index,), None)
+        record.threadName = 'Thread-%d' % (index % 11)
+        record.thread = 1000 + index % 11
+        record.tsx_id = 'tsx-%d' % (index % 23)
+        records.append(record)
+
+    # What a formatter that is not shared produces
+    expected = [color_bucket_logger.TermFormatter(**formatter_kwargs).format(record) for record in records]
+
+    number_of_threads = 8
+    barrier = threading.Barrier(number_of_threads) if hasattr(threading, 'Barrier') else None
+    results = {}
+    errors = []
+
+    def format_records(thread_number):
+        try:
+            rand = random.Random(thread_number)
+            if barrier:
+                barrier.wait()
+            formatted = {}
+            for _round in range(5):
+                order = list(range(len(records)))
+                rand.shuffle(order)
+                for index in order:
+                    line = shared_formatter.format(records[index])
+                    if formatted.setdefault(index, line) != line:
+                        errors.append((thread_number, index, line))
+            results[thread_number] = formatted
+        except Exception as e:
+            errors.append((thread_number, e))
+
+    if hasattr(sys, 'setswitchinterval'):
+        get_interval, set_interval, interval = sys.getswitchinterval, sys.setswitchinterval, 1e-6
+    else:
+        # py2 switches threads every N bytecodes instead
+        get_interval, set_interval, interval = sys.getcheckinterval, sys.setcheckinterval, 1
+    switch_interval = get_interval()
+    set_interval(interval)
+    try:
+        threads = [threading.Thread(target=format_records, args=(thread_number,)) for thread_number in range(number_of_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        set_interval(switch_interval)
+
+    assert errors == []
+    assert len(results) == number_of_threads
+    for formatted in results.values():
+        assert [formatted[index] for index in range(len(records))] == expected
+
+    if free_threaded:
+        name_cache_stats = shared_formatter.color_mapper.name_cache.stats()
+        assert name_cache_stats['thread_hits'] > 0
+        assert name_cache_stats['thread_clears'] > 0
+
+
+def test_thread_local_cache():
+    from color_bucket_logger import cache
+
+    shared = cache.LRUCache(maxsize=4)
+    thread_cache = cache.ThreadLocalCache(shared, maxsize=2)
+
+    thread_cache.set('a', 1)
+    assert thread_cache.get('a') == 1
+    assert thread_cache.get('b') is None
+    assert thread_cache.get('b', 2) == 2
+    with pytest.raises(TypeError):
+        thread_cache.get({})
+
+    # Another thread finds the value in the shared cache, and then in its own
+    found = []
+
+    def lookup():
+        found.append(thread_cache.get('a'))
+        found.append(thread_cache.get('a'))
+        thread_cache.set('c', 3)
+        thread_cache.set('d', 4)
+        thread_cache.set('e', 5)
+
+    thread = threading.Thread(target=lookup)
+    thread.start()
+    thread.join()
+    assert found == [1, 1]
+    assert thread_cache.get('e') == 5
+
+    stats = thread_cache.stats()
+    assert stats['size'] == len(thread_cache) == 4
+    assert stats['evictions'] == 0
+    assert stats['misses'] == 2
+    # Including the hits of the thread that is gone
+    assert stats['thread_hits'] == 2
+    assert stats['hits'] == 4
+
+    thread_cache.clear()
+    assert len(thread_cache) == 0
+    assert thread_cache.get('a') is None
+
+
+def test_free_threaded_formatter_reentrant():
+    formatter = color_bucket_logger.ColorFormatter(fmt='%(name)s %(message)s', free_threaded=True, colorize=True)
+    assert formatter.color_mapper.free_threaded
+    assert isinstance(formatter.color_mapper.name_cache, color_bucket_logger.cache.ThreadLocalCache)
+
+    inner_record = logging.LogRecord('inner', logging.INFO, __file__, 1, 'inner message', (), None)
+    inner = []
+
+    class FormatsWhenRendered(object):
+        def __str__(self):
+            # Like a __str__ that logs, formatting another record with the same formatter
+            inner.append(formatter.format(inner_record))
+            return 'outer message'
+
+    record = logging.LogRecord('outer', logging.INFO, __file__, 1, '%s', (FormatsWhenRendered(),), None)
+    again = logging.LogRecord('again', logging.INFO, __file__, 1, 'again', (), None)
+
+    def strip(line):
+        return re.sub(r'\x1b\[[\d;]*m', '', line)
+
+    assert strip(formatter.format(record)) == 'outer outer message'
+    assert [strip(line) for line in inner] == ['inner inner message']
+    assert strip(formatter.format(again)) == 'again again'
+    assert formatter.format(again) == color_bucket_logger.ColorFormatter(fmt='%(name)s %(message)s', colorize=True).format(again)
+
+
+def test_name_cache_stats():
+    logger, handler, formatter = setup_logger(color_groups=[('name', ['name', 'levelname'])],
+                                              formatter_class=color_bucket_logger.TermFormatter)
+    name_cache = formatter.color_mapper.name_cache
+
+    logger.debug('first')
+    misses = name_cache.stats()['misses']
+    logger.debug('second')
+    logger.info('third')
+
+    stats = name_cache.stats()
+    assert stats['misses'] == misses
+    assert stats['hits'] > 0
+    assert stats['evictions'] == 0
+
+
+def test_name_cache_bounded():
+    logger, handler, formatter = setup_logger(color_groups=[('tsx_id', ['message'])],
+                                              fmt='%(tsx_id)s %(message)s')
+    formatter.color_mapper.name_cache.maxsize = 4
+
+    for tsx_id in range(20):
+        logger.debug('tsx', extra={'tsx_id': tsx_id})
+    # unhashable values are colored, just not cached
+    logger.debug('unhashable', extra={'tsx_id': {'some': 'dict'}})
+
+    stats = formatter.color_mapper.name_cache.stats()
+    assert stats['size'] == 4
+    assert stats['evictions'] > 0
+    assert "{'some': 'dict'}" in handler.buf[-1]
+
+
+def test_name_cache_disabled():
+    formatter = color_bucket_logger.ColorFormatter(name_cache_size=0)
+    assert formatter.color_mapper.name_cache is None
+    assert formatter.color_mapper.get_name_color('foo') == formatter.color_mapper.get_name_color('foo')
+
+
+def test_name_cache_value_type():
+    mapper = color_bucket_logger.term_mapper.TermColorMapper()
+    uncached = color_bucket_logger.term_mapper.TermColorMapper(name_cache_size=0)
+    for value in (1, True, 1.0, '1'):
+        assert mapper.get_name_color(value) == uncached.get_name_color(value)
+
+
+def test_record_context():
+    record = logging.LogRecord('foo', logging.INFO, '/some/path.py', 37, 'some msg', (), None)
+    record.message = 'stale message'
+    record_context = color_bucket_logger.context.RecordContext(record.__dict__, {'tsx_id': None, 'name': 'not used'})
+    record_context['_cdl_name'] = '<color>'
+    record_context['message'] = 'some msg'
+
+    assert record_context['name'] == 'foo'
+    assert record_context['message'] == 'some msg'
+    assert record_context['tsx_id'] is None
+    assert 'tsx_id' in record_context
+    assert 'levelno' in record_context
+    assert 'not_an_attr' not in record_context
+    assert record_context.get('not_an_attr', 'blip') == 'blip'
+    with pytest.raises(KeyError):
+        record_context['not_an_attr']
+
+    # Only the values set on the context are stored in it, the record is not copied or modified
+    assert len(record_context) == 2
+    assert not hasattr(record, '_cdl_name')
+    assert record.message == 'stale message'
+
+    assert '%(_cdl_name)s%(name)s %(tsx_id)s %(message)s' % record_context == '<color>foo None some msg'
+    assert string.Formatter().vformat('{_cdl_name}{name} {tsx_id} {message}', (), record_context) == '<color>foo None some msg'
+
+
+def test_str_format_style():
+    logger, handler, formatter = setup_logger()
+    formatter = color_bucket_logger.ColorFormatter(fmt='{levelname} {name} {an_extra} {message}', style='{')
+    handler.setFormatter(formatter)
+
+    logger.debug('test str format %s', 'style', extra={'an_extra': 'eggggstra'})
+    logger.debug('no extra')
+
+    assert 'eggggstra' in handler.buf[0]
+    assert 'test str format style' in handler.buf[0]
+    assert 'None' in handler.buf[1]
+
+
+def test_str_format_style_fields():
+    formatter = color_bucket_logger.ColorFormatter(fmt='{levelname:<8} {name!r} {args[0]} {message:>{width}} {name}',
+                                                   style='{', colorize=True)
+    assert formatter._style.fields == ('levelname', 'name', 'args', 'message', 'width')
+    # '{' style formats are compiled by default, if they can be
+    assert formatter._style._render is None
+    assert color_bucket_logger.ColorFormatter(fmt='{name!r:>6}', style='{')._style._render is not None
+    assert color_bucket_logger.ColorFormatter(fmt='{name!r:>6}', style='{', compile_format=False)._style._render is None
+
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', ('arg',), None)
+    record.width = 10
+    assert re.sub(r'\x1b\[[\d;]*m', '', formatter.format(record)) == "INFO     'foo' arg   blip arg foo"
+
+    assert color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(name)r %(message)s')._style.fields == \
+        ('levelname', 'name', 'message')
+
+
+@pytest.mark.parametrize("fmt, style, expected", [('%(message)r', '%', "'blip arg'"),
+                                                  ('%(levelname)s %(message)r', '%', "INFO 'blip arg'"),
+                                                  ('{message!r}', '{', "'blip arg'"),
+                                                  ('{message:>20}', '{', '            blip arg')])
+@pytest.mark.parametrize("compile_format", [False, True])
+def test_message_field_conversions(fmt, style, expected, compile_format):
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', ('arg',), None)
+    for colorize in (False, True):
+        formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, compile_format=compile_format, colorize=colorize)
+        assert re.sub(r'\x1b\[[\d;]*m', '', formatter.format(record)) == expected
+        assert re.sub(r'\x1b\[[\d;]*m', '', formatter.format_many([record], join=False)[0]) == expected
+
+
+@pytest.mark.parametrize("fmt, style", [('{name!x}', '{'), ('{name:bad spec}', '{'), ('no fields', '{'), ('no fields', '%')])
+def test_invalid_format(fmt, style):
+    for _attempt in range(2):
+        with pytest.raises(ValueError):
+            color_bucket_logger.ColorFormatter(fmt=fmt, style=style)
+
+
+class CountingLogRecord(logging.LogRecord):
+    get_message_calls = 0
+
+    def getMessage(self):
+        self.get_message_calls += 1
+        return logging.LogRecord.getMessage(self)
+
+
+@pytest.mark.parametrize('fmt,color_groups,expected_calls', [
+    ('%(levelname)s %(name)s %(message)s', [], 1),
+    ('%(levelname)s %(name)s %(message)s', [('message', ['levelname'])], 1),
+    ('%(levelname)s %(name)s', [('message', ['levelname'])], 1),
+    ('%(levelname)s %(name)s', [('name', ['levelname'])], 0),
+])
+def test_message_rendered_once(fmt, color_groups, expected_calls):
+    formatter = color_bucket_logger.ColorFormatter(fmt=fmt, color_groups=color_groups)
+    record = CountingLogRecord('foo', logging.INFO, '/some/path.py', 37, 'some msg %s', ('blip',), None)
+
+    res = formatter.format(record)
+
+    assert record.get_message_calls == expected_calls
+    assert ('some msg blip' in res) == ('%(message)s' in fmt)
+
+
+@pytest.mark.parametrize('fmt,style', [
+    ('%(levelname)-8s %(name)s %(process)05d %(an_extra)s 100%% %(message)s', '%'),
+    ('{levelname:<8} {name} {process:05d} {an_extra!r} {message}', '{'),
+])
+def test_compile_format(fmt, style):
+    formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, auto_color=True)
+    compiled_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, auto_color=True, compile_format=True)
+    assert compiled_formatter._style._render is not None
+
+    record = logging.LogRecord('foo', logging.INFO, '/some/path.py', 37, 'some msg %s', ('blip',), None)
+    record.an_extra = {'some': 'extra'}
+    assert compiled_formatter.format(record) == formatter.format(record)
+
+
+@pytest.mark.parametrize('fmt,style', [
+    ('%(levelname)s %d', '%'),
+    ('%(levelname)*d', '%'),
+    ('{levelname} {0}', '{'),
+    ('{levelname.upper}', '{'),
+    ('{levelname:{width}}', '{'),
+])
+def test_compile_format_fallback(fmt, style):
+    assert color_bucket_logger.compiler.compile_format(fmt, style) is None
+
+
+def test_compile_format_cached():
+    render = color_bucket_logger.compiler.compile_format('%(name)s: %(message)s')
+    assert render({'message': 'blip'}, {'name': 'foo'}) == 'foo: blip'
+    assert color_bucket_logger.compiler.compile_format('%(name)s: %(message)s') is render
+
+    render = color_bucket_logger.compiler.compile_format('{name!r:>6} {{{message}}} 100%', style='{')
+    assert render({'message': 'blip'}, {'name': 'foo'}) == " 'foo' {blip} 100%"
+
+
+@pytest.mark.parametrize("style, fmt", [('%', '%(levelname)-8s %(threadName)s %(name)s - %(message)s'),
+                                        ('{', '{levelname:<8} {threadName} {name} - {message}')])
+def test_parsed_format_shared(style, fmt):
+    formatter1 = color_bucket_logger.TermFormatter(fmt=fmt, auto_color=True) if style == '%' else \
+        color_bucket_logger.ColorFormatter(fmt=fmt, style=style, auto_color=True)
+    formatter2 = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, auto_color=True)
+
+    # Parsed once per process
+    assert formatter1._style.color_fmt is formatter2._style.color_fmt
+    assert formatter1._style._format_attrs is formatter2._style._format_attrs
+    assert isinstance(formatter1._style._format_attrs, tuple)
+    assert formatter1.color_mapper.plan is formatter2.color_mapper.plan
+    assert formatter1.color_mapper.exc_plan is formatter2.color_mapper.exc_plan
+
+    # but the mappers (and their caches) are not shared
+    assert formatter1.color_mapper is not formatter2.color_mapper
+    assert formatter1.color_mapper.name_cache is not formatter2.color_mapper.name_cache
+
+    # A different config gets its own plan
+    formatter3 = color_bucket_logger.ColorFormatter(fmt=fmt, style=style)
+    assert formatter3.color_mapper.plan is not formatter1.color_mapper.plan
+
+    record = logging.LogRecord('foo.bar', logging.INFO, __file__, 1, 'blip', (), None)
+    assert formatter1.format(record) == formatter2.format(record)
+
+
+def test_parsed_format_cache_bounded():
+    from color_bucket_logger import compiler, mapper, styles
+
+    for i in range(styles.PARSED_FORMATS_CACHE_SIZE + 10):
+        formatter = color_bucket_logger.ColorFormatter(fmt='%(name)s ' + 'x' * i + ' %(message)s',
+                                                       color_groups=[('name', ['message', 'attr%d' % i])],
+                                                       compile_format=True)
+    assert len(styles._parsed_formats) == styles.PARSED_FORMATS_CACHE_SIZE
+    assert len(mapper._compiled_plans) == mapper.COMPILED_PLANS_CACHE_SIZE
+    assert len(compiler._compiled_formats) == compiler.COMPILED_FORMATS_CACHE_SIZE
+
+    # still shared while in the cache
+    again = color_bucket_logger.ColorFormatter(fmt=formatter._fmt, color_groups=[('name', ['message', 'attr%d' % i])])
+    assert again._style.color_fmt is formatter._style.color_fmt
+    assert again.color_mapper.plan is formatter.color_mapper.plan
+
+
+def test_process_cache():
+    logger, handler, formatter = setup_logger(auto_color=True,
+                                              fmt='%(processName)s %(process)d %(threadName)s %(thread)d %(message)s')
+    process_cache = formatter.color_mapper.process_cache
+
+    logger.debug('first')
+    logger.debug('second')
+
+    def log_from_thread():
+        logger.debug('from a thread')
+
+    some_thread = threading.Thread(target=log_from_thread)
+    some_thread.start()
+    some_thread.join()
+
+    stats = process_cache.stats()
+    assert stats['size'] == 2
+    assert stats['hits'] == 1
+    assert handler.buf[0].split('first')[0] == handler.buf[1].split('second')[0]
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='requires os.register_at_fork')
+def test_process_cache_after_fork():
+    formatter = color_bucket_logger.ColorFormatter(auto_color=True)
+    mapper = formatter.color_mapper
+    record = logging.LogRecord('foo', logging.INFO, '/some/path.py', 37, 'some msg', (), None)
+    formatter.format(record)
+    assert len(mapper.process_cache) == 1
+    assert len(mapper.name_cache) > 0
+
+    pid = os.fork()
+    if pid == 0:
+        # The child starts with an empty process cache, but keeps the name colors
+        ok = len(mapper.process_cache) == 0 and len(mapper.name_cache) > 0
+        os._exit(0 if ok else 1)
+
+    _pid, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert len(mapper.process_cache) == 1
+
+
+def test_palette():
+    term_colors = color_bucket_logger.term_colors
+    palette = term_colors.PALETTE
+
+    # ALL_COLORS is a view of the same colors
+    for color_idx, color_seq in term_colors.ALL_COLORS.items():
+        assert palette[color_idx] == color_seq
+    assert palette[palette.reset_idx] == term_colors.RESET_SEQ
+    assert palette.number_of_colors == term_colors.NUMBER_OF_ALL_COLORS
+
+    # and a read only one, so they can not diverge
+    with pytest.raises(TypeError):
+        term_colors.ALL_COLORS[term_colors.WHITE] = term_colors.RESET_SEQ
+    with pytest.raises(KeyError):
+        term_colors.ALL_COLORS[17]
+
+
+def test_mapper_palette():
+    palette = color_bucket_logger.term_colors.Palette(sequences=['<%d>' % x for x in range(8)] + ['<reset>', '<default>'],
+                                                      offset=2, number_of_colors=6, reset_idx=8, default_idx=9)
+    mapper = color_bucket_logger.term_mapper.TermColorMapper(palette=palette)
+
+    for name in ('foo', 'bar', 'some.logger.name'):
+        assert 2 <= mapper.get_name_color(name) < 8
+
+    colors = mapper.get_colors_for_record({'name': 'foo', 'exc_text': None})
+    assert colors['_cdl_reset'] == '<reset>'
+    assert colors['_cdl_name'] == '<%d>' % mapper.get_name_color('foo', 'sdsdf')
+    assert colors['_cdl_default'] == colors['_cdl_name']
+
+
+def test_truecolor_palette():
+    from color_bucket_logger import palettes, term_colors
+
+    palette = palettes.truecolor_palette(64, theme='dark')
+    assert palettes.truecolor_palette(64, theme='dark') is palette
+    assert palette.number_of_colors == 64
+    assert len(palette) == palette.offset + 64 + 2
+    assert palette[palette.reset_idx] == term_colors.RESET_SEQ
+    # the level colors are still the basic terminal colors
+    assert palette[term_colors.RED] == term_colors.ALL_COLORS[term_colors.RED]
+
+    assert len(set(palette.rgb)) == 64
+    for color_idx, rgb in enumerate(palette.rgb):
+        assert palette[palette.offset + color_idx] == '\x1b[38;2;%d;%d;%dm' % rgb
+
+    light = palettes.truecolor_palette(64, theme='light')
+    assert sum(map(sum, light.rgb)) < sum(map(sum, palette.rgb))
+    assert light[light.default_idx] == term_colors.ALL_COLORS[term_colors.BLACK]
+
+    assert palettes.oklch_to_rgb(1.0, 0.0, 0) == (255, 255, 255)
+    assert palettes.oklch_to_rgb(0.0, 0.0, 0) == (0, 0, 0)
+
+    with pytest.raises(ValueError):
+        palettes.truecolor_palette(64, theme='beige')
+
+
+def test_get_palette():
+    from color_bucket_logger import palettes, term_colors
+
+    assert palettes.get_palette() is term_colors.PALETTE
+    assert palettes.get_palette('truecolor-dark').number_of_colors == palettes.DEFAULT_NUMBER_OF_COLORS
+    assert palettes.get_palette(term_colors.PALETTE) is term_colors.PALETTE
+    with pytest.raises(ValueError):
+        palettes.get_palette('cga')
+
+
+def test_formatter_palette():
+    logger, handler, formatter = setup_logger(formatter_class=color_bucket_logger.TermFormatter,
+                                              palette='truecolor-light')
+    palette = formatter.color_mapper.palette
+    assert palette is color_bucket_logger.palettes.get_palette('truecolor-light')
+
+    logger.info('some info')
+    assert '\x1b[38;2;' in handler.buf[0]
+    assert any(palette[color_idx] in handler.buf[0] for color_idx in range(palette.offset, palette.reset_idx))
+
+
+class CountingFormatter(color_bucket_logger.ColorFormatter):
+    format_exception_calls = 0
+
+    def formatException(self, ei):
+        CountingFormatter.format_exception_calls += 1
+        return super(CountingFormatter, self).formatException(ei)
+
+
+@pytest.mark.parametrize('share_exc_text,expected_calls', [(False, 3), (True, 1)])
+def test_share_exc_text(share_exc_text, expected_calls):
+    logger = logging.getLogger(__name__ + '.test_share_exc_text.%s' % share_exc_text)
+    logger.setLevel(logging.DEBUG)
+    handlers = []
+    for _i in range(3):
+        handler = BufHandler(level=logging.DEBUG)
+        handler.setFormatter(CountingFormatter(fmt='%(levelname)s %(message)s', share_exc_text=share_exc_text))
+        logger.addHandler(handler)
+        handlers.append(handler)
+
+    CountingFormatter.format_exception_calls = 0
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        logger.exception('Hit an exception')
+
+    assert CountingFormatter.format_exception_calls == expected_calls
+    for handler in handlers:
+        assert 'ZeroDivisionError' in handler.buf[0]
+        assert handler.buf[0] == handlers[0].buf[0]
+
+
+class WriteCountingStream(object):
+    def __init__(self, tty=True):
+        self.tty = tty
+        self.writes = []
+        self.flushes = 0
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        self.flushes += 1
+
+
+def queue_logger(name, handler):
+    logger = logging.getLogger(__name__ + '.' + name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+def test_color_queue_handler():
+    from color_bucket_logger import handlers
+
+    log_queue = queue.Queue()
+    stream = WriteCountingStream()
+    listener = handlers.ColorQueueListener(log_queue, stream=stream,
+                                           formatter=color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(message)s'))
+    handler = handlers.ColorQueueHandler(log_queue, listener=listener)
+    logger = queue_logger('test_color_queue_handler', handler)
+
+    # queued before the listener starts, so they are all written as one batch
+    for i in range(10):
+        logger.info('message %s', i)
+    listener.start()
+    handler.close()
+    logger.removeHandler(handler)
+
+    assert len(stream.writes) == 1
+    lines = stream.writes[0].splitlines()
+    assert len(lines) == 10
+    assert 'message 9' in lines[-1]
+    assert '\x1b[' in lines[0]
+    assert handler.dropped == 0
+
+
+def test_color_queue_listener_colorize():
+    from color_bucket_logger import handlers
+
+    log_queue = queue.Queue()
+    stream = WriteCountingStream(tty=False)
+    # the listener tells the formatter its stream is not a terminal
+    listener = handlers.ColorQueueListener(log_queue, stream=stream,
+                                           formatter=color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(message)s'))
+    handler = handlers.ColorQueueHandler(log_queue, listener=listener)
+    logger = queue_logger('test_color_queue_listener_colorize', handler)
+
+    logger.info('message')
+    listener.start()
+    handler.close()
+    logger.removeHandler(handler)
+
+    assert stream.writes == ['INFO message\n']
+
+    # and so does setFormatter
+    stream.tty = True
+    listener.setFormatter(color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(message)s'))
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'message', (), None)
+    assert '\x1b[' in listener.formatter.format(record)
+
+
+@pytest.mark.parametrize("policy, queued, dropped", [('drop', 4, 6), ('sample', 4, 6)])
+def test_color_queue_handler_policy(policy, queued, dropped):
+    from color_bucket_logger import handlers
+
+    log_queue = queue.Queue(maxsize=4)
+    handler = handlers.ColorQueueHandler(log_queue, policy=policy, timeout=0.01)
+    logger = queue_logger('test_color_queue_handler_policy.%s' % policy, handler)
+
+    for i in range(10):
+        logger.info('message %s', i)
+    logger.removeHandler(handler)
+
+    assert log_queue.qsize() == queued
+    assert handler.dropped == dropped
+    # records are queued as is, the listener formats them
+    assert log_queue.get().msg == 'message %s'
+
+
+def test_color_queue_handler_bad_policy():
+    from color_bucket_logger import handlers
+
+    with pytest.raises(ValueError):
+        handlers.ColorQueueHandler(None, policy='explode')
+
+
+@pytest.mark.parametrize("formatter_class", [color_bucket_logger.ColorFormatter, color_bucket_logger.TermFormatter])
+@pytest.mark.parametrize("auto_color", [False, True])
+def test_format_many(formatter_class, auto_color):
+    formatter = formatter_class(fmt='%(levelname)s %(name)s %(an_extra)s %(lineno)d %(message)s',
+                                color_groups=[('an_extra', ['message'])], auto_color=auto_color)
+    records = []
+    for i in range(200):
+        record = logging.LogRecord('foo.%s' % (i % 3), logging.INFO, __file__, i % 7, 'message %s', (i,), None)
+        # 1 and True are equal, but do not have the same color
+        record.an_extra = [1, True, {'un': 'hashable'}, 'blip'][i % 4]
+        records.append(record)
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        records.append(logging.LogRecord('foo', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info()))
+
+    expected = [formatter.format(record) for record in records]
+
+    assert formatter.format_many(records, join=False) == expected
+    assert formatter.format_many(records) == '\n'.join(expected) + '\n'
+    assert formatter.format_many(iter(records), terminator='\r\n') == '\r\n'.join(expected) + '\r\n'
+    assert formatter.format_many([]) == ''
+
+
+def test_format_many_overridden_format():
+    class PrefixFormatter(color_bucket_logger.ColorFormatter):
+        def format(self, record):
+            return 'prefix ' + super(PrefixFormatter, self).format(record)
+
+    formatter = PrefixFormatter(fmt='%(message)s')
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None)
+    assert formatter.format_many([record], join=False) == [formatter.format(record)]
+    assert formatter.format_many([record]).startswith('prefix ')
+
+
+def test_color_registry(tmp_path):
+    from color_bucket_logger import registry, term_colors
+
+    path = str(tmp_path / 'colors.cbl')
+    color_registry = registry.ColorRegistry(path, capacity=8)
+    assert color_registry.capacity == 8
+
+    assert [color_registry.order(key) for key in ['pid:10', 'pid:11', 'pid:10', 'pid:12']] == [0, 1, 0, 2]
+    assert len(color_registry) == 3
+
+    # Another registry on the same file, (like in another process) sees the same numbers
+    other_registry = registry.ColorRegistry(path)
+    assert other_registry.capacity == 8
+    assert other_registry.order('pid:12') == 2
+    assert other_registry.order('pid:13') == 3
+    assert color_registry.order('pid:13') == 3
+
+    # Consecutive keys get colors far apart
+    colors = [color_registry.color_index('pid:%s' % pid, term_colors.PALETTE) for pid in (10, 11, 12)]
+    assert len(set(colors)) == 3
+    assert abs(colors[0] - colors[1]) > 20
+
+    # Full at MAX_LOAD
+    for key in range(10):
+        color_registry.order('key%s' % key)
+    assert len(color_registry) == 6
+    assert color_registry.order('one too many') is None
+
+    other_registry.close()
+    color_registry.close()
+
+    with open(path, 'wb') as not_a_registry:
+        not_a_registry.write(b'blip' * 100)
+    with pytest.raises(ValueError):
+        registry.ColorRegistry(path)
+
+
+def register_keys(path, keys):
+    from color_bucket_logger import registry
+    color_registry = registry.get_registry(path)
+    for key in keys:
+        color_registry.order(key)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+@pytest.mark.skipif(sys.version_info[0] >= 3, reason='python 2 str logger names')
+def test_byte_string_logger_name(tmp_path):
+    from color_bucket_logger import registry
+
+    name = b'caf\xc3\xa9'
+    assert registry.hash_key(name) == registry.hash_key(u'caf\xe9')
+
+    color_registry = registry.ColorRegistry(str(tmp_path / 'colors.cbl'))
+    for kwargs in ({}, {'color_registry': color_registry}):
+        formatter = color_bucket_logger.ColorFormatter(fmt='%(name)s %(message)s', **kwargs)
+        record = logging.LogRecord(name, logging.INFO, __file__, 1, 'some msg', (), None)
+        assert name in formatter.format(record)
+
+
+def test_color_registry_processes(tmp_path):
+    import multiprocessing
+    from color_bucket_logger import registry
+
+    path = str(tmp_path / 'colors.cbl')
+    color_registry = registry.get_registry(path)
+    color_registry.order('parent')
+
+    processes = [multiprocessing.Process(target=register_keys, args=(path, ['shared'] + ['child%s:%s' % (i, j) for j in range(20)]))
+                 for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    # every key got its own number
+    assert len(color_registry) == 1 + 1 + 4 * 20
+    orders = set(color_registry.order('child%s:%s' % (i, j)) for i in range(4) for j in range(20))
+    assert len(orders) == 80
+    assert color_registry.order('parent') == 0
+    color_registry.close()
+
+
+def test_mapper_color_registry(tmp_path):
+    path = str(tmp_path / 'colors.cbl')
+    formatters = [color_bucket_logger.TermFormatter(color_groups=[('process', ['processName'])], color_registry=path)
+                  for _i in range(2)]
+    assert formatters[0].color_mapper.color_registry is formatters[1].color_mapper.color_registry
+
+    pid_colors = []
+    for pid in (1000, 1001, 1002):
+        record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None)
+        record.process = pid
+        record.processName = 'Worker-%s' % pid
+        pid_colors.append(formatters[0].color_mapper.get_process_colors(record.__dict__)[1])
+        # Both formatters agree
+        assert formatters[1].color_mapper.get_process_colors(record.__dict__) == \
+            formatters[0].color_mapper.get_process_colors(record.__dict__)
+
+    assert len(set(pid_colors)) == 3
+    formatters[0].color_mapper.color_registry.close()
+
+
+class TtyStream(object):
+    def __init__(self, tty):
+        self.tty = tty
+        self.buf = []
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, data):
+        self.buf.append(data)
+
+    def flush(self):
+        pass
+
+
+@pytest.mark.parametrize("formatter_class", [color_bucket_logger.ColorFormatter, color_bucket_logger.TermFormatter])
+def test_colorize_false(formatter_class):
+    fmt = '%(levelname)s %(_cdl_name)s%(name)s %(an_extra)s %(message)s'
+    formatter = formatter_class(fmt=fmt, colorize=False, auto_color=True)
+    color_formatter = formatter_class(fmt=fmt, colorize=True, auto_color=True)
+    formatter.color_mapper.get_colors_for_record = None
+
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', ('blap',), None)
+    assert formatter.format(record) == 'INFO foo None blip blap'
+    assert formatter.format_many([record, record]) == 'INFO foo None blip blap\nINFO foo None blip blap\n'
+    assert '\x1b[' in color_formatter.format(record)
+    assert not hasattr(record, 'message')
+
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        record = logging.LogRecord('foo', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info())
+    formatted = formatter.format(record)
+    assert formatted.startswith('ERROR foo None failed\nTraceback')
+    # 'division by zero' on py3, 'integer division or modulo by zero' on py2
+    assert formatted.endswith('ZeroDivisionError: %s\n' % record.exc_info[1])
+    assert '\x1b[' not in formatted
+
+
+@pytest.mark.parametrize("environ, colorized", [({}, True),
+                                                ({'NO_COLOR': '1'}, False),
+                                                ({'NO_COLOR': ''}, True),
+                                                ({'TERM': 'dumb'}, False),
+                                                ({'TERM': 'xterm-256color'}, True)])
+def test_colorize_environ(monkeypatch, environ, colorized):
+    monkeypatch.delenv('TERM', raising=False)
+    for key, value in environ.items():
+        monkeypatch.setenv(key, value)
+
+    formatter = color_bucket_logger.TermFormatter(fmt='%(levelname)s %(message)s')
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None)
+    assert ('\x1b[' in formatter.format(record)) is colorized
+
+    # explicit colorize wins
+    formatter = color_bucket_logger.TermFormatter(fmt='%(levelname)s %(message)s', colorize=True)
+    assert '\x1b[' in formatter.format(record)
+
+
+@pytest.mark.parametrize("tty", [True, False])
+def test_colorize_handler_stream(tty):
+    from color_bucket_logger import handlers
+
+    formatter = color_bucket_logger.TermFormatter(fmt='%(levelname)s %(message)s')
+    logger = logging.getLogger(__name__ + '.test_colorize_handler_stream')
+    logger.propagate = False
+    stream = TtyStream(tty)
+    handler = handlers.ColorStreamHandler(stream)
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    logger.warning('blip')
+    assert ('\x1b[' in stream.buf[0]) is tty
+
+    # Changing the stream changes the decision
+    new_stream = TtyStream(not tty)
+    handler.setStream(new_stream)
+    logger.warning('blip')
+    logger.removeHandler(handler)
+    assert ('\x1b[' in new_stream.buf[0]) is not tty
+
+    # an explicit colorize wins
+    formatter = color_bucket_logger.TermFormatter(fmt='%(levelname)s %(message)s', colorize=True)
+    formatter.set_stream(TtyStream(False))
+    assert '\x1b[' in formatter.format(logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None))
+
+
+@pytest.mark.parametrize("formatter_class", [color_bucket_logger.ColorFormatter, color_bucket_logger.TermFormatter])
+def test_formatter_stats(formatter_class):
+    formatter = formatter_class(fmt='%(levelname)s %(name)s %(message)s', instrument=True)
+    records = [logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', (i,), None) for i in range(4)]
+    records.append(logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', (u'caf\xe9',), None))
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        records.append(logging.LogRecord('foo', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info()))
+
+    formatted = [formatter.format(record) for record in records]
+    formatter.format_many(records[:2])
+
+    stats = formatter.stats()
+    assert stats['enabled']
+    assert stats['records'] == 8
+    assert stats['exc_records'] == 1
+    assert stats['bytes_emitted'] == sum(len(s.encode('utf-8')) for s in formatted + formatted[:2])
+    assert stats['calls']['colors'] == 8
+    assert stats['calls']['format_exception'] == 1
+    assert stats['time_ns']['pre_format'] >= stats['time_ns']['format_exception'] > 0
+    assert stats['time_ns']['format'] >= stats['time_ns']['colors'] > 0
+    assert stats['caches']['name_cache']['hit_rate'] > 0.5
+
+    formatter.reset_stats()
+    stats = formatter.stats()
+    assert stats['records'] == 0
+    assert stats['time_ns']['colors'] == 0
+    assert stats['caches']['name_cache']['hit_rate'] is None
+
+    # disabled, formatting is not wrapped
+    formatter.disable_stats()
+    assert 'format' not in formatter.__dict__
+    assert 'get_colors_for_record' not in formatter.color_mapper.__dict__
+    formatter.format(records[0])
+    assert formatter.stats()['records'] == 0
+    assert not formatter.stats()['enabled']
+
+
+def test_formatter_stats_compiled_plain():
+    formatter = color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(message)s', compile_format=True, colorize=False)
+    style_format = formatter._style._format
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None)
+
+    formatter.enable_stats()
+    assert formatter.format(record) == 'INFO blip'
+    stats = formatter.stats()
+    assert stats['calls']['style_format'] == 1
+    assert stats['calls']['colors'] == 0
+
+    formatter.disable_stats()
+    # the compiled _format instance attribute is put back
+    assert formatter._style._format == style_format
+
+
+class CountingLock(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquires = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquires += 1
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+def test_formatter_stats_lock_per_record():
+    formatter = color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(name)s %(message)s', colorize=True)
+    counting_lock = CountingLock()
+    formatter._stats._lock = counting_lock
+    formatter.enable_stats()
+    counting_lock.acquires = 0
+
+    for i in range(5):
+        formatter.format(logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip %s', (i,), None))
+
+    # the step timings of a record are added with the record's counts
+    assert counting_lock.acquires == 5
+    stats = formatter.stats()
+    assert stats['calls']['format'] == stats['calls']['colors'] == stats['calls']['pre_format'] == 5
+
+    # steps run outside of format() still count
+    formatter._pre_format(logging.LogRecord('foo', logging.INFO, __file__, 1, 'blip', (), None))
+    assert formatter.stats()['calls']['pre_format'] == 6
+
+
+def test_latency_histogram():
+    from color_bucket_logger import stats
+
+    histogram = stats.LatencyHistogram()
+    assert histogram.percentile(50) is None
+
+    # the buckets are contiguous and keep the value within 1/16th
+    indexes = [histogram.bucket_index(value) for value in range(100000)]
+    assert indexes == sorted(indexes)
+    assert set(indexes) == set(range(indexes[-1] + 1))
+    for value in (0, 15, 16, 17, 1000, 123456, 10 ** 9):
+        high = histogram.bucket_high(histogram.bucket_index(value))
+        assert value <= high <= value * 17 / 16.0
+
+    for value in range(1, 1001):
+        histogram.record(value * 1000)
+    histogram.record(10 ** 15)
+
+    exported = histogram.export()
+    assert exported['count'] == 1001
+    assert exported['max'] == histogram.max_value
+    assert 500000 <= exported['p50'] <= 500000 * 17 / 16.0
+    assert 990000 <= exported['p99'] <= 990000 * 17 / 16.0
+    assert 1000000 <= exported['p99.9'] <= 1000000 * 17 / 16.0
+
+    expected = {'count': 0, 'min': None, 'max': None, 'mean': None, 'p50': None, 'p99.99': None}
+    assert stats.LatencyHistogram().export((50, 99.99)) == expected
+
+
+def test_slowest_records():
+    formatter = color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(name)s %(message)s')
+    assert formatter.latency_percentiles() is None
+    formatter.enable_stats(slowest=2)
+
+    records = [logging.LogRecord('foo', logging.INFO, __file__, 1, 'small %s', ('blip',), None),
+               logging.LogRecord('foo.big', logging.INFO, __file__, 1, 'big %s', ('x' * 10 ** 6,), None)]
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        records.append(logging.LogRecord('foo.exc', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info()))
+
+    for _i in range(20):
+        formatter.format(records[0])
+    formatter.format(records[1])
+    formatter.format(records[2])
+
+    slowest = formatter.stats()['slowest']
+    assert len(slowest) == 2
+    assert slowest[0]['elapsed_ns'] >= slowest[1]['elapsed_ns']
+    # Which record comes second depends on timing, the big one is always slow
+    slowest_by_name = dict((summary['name'], summary) for summary in slowest)
+    assert slowest_by_name['foo.big']['msg'] == 'big %s'
+    assert slowest_by_name['foo.big']['size'] > 10 ** 6
+    assert not slowest_by_name['foo.big']['exc']
+
+    exc_formatter = color_bucket_logger.ColorFormatter(fmt='%(levelname)s %(name)s %(message)s')
+    exc_formatter.enable_stats(slowest=1)
+    exc_formatter.format(records[2])
+    assert exc_formatter.stats()['slowest'][0]['exc']
+
+    percentiles = formatter.latency_percentiles((50, 100))
+    assert percentiles['count'] == 22
+    assert percentiles['p50'] <= percentiles['p100'] == percentiles['max']
+
+    formatter.reset_stats()
+    assert formatter.stats()['slowest'] == []
+    assert formatter.latency_percentiles()['count'] == 0
+
+
+def test_slowest_records_msg_logs():
+    # A msg whose __str__ formats another record with the same formatter
+    formatter = color_bucket_logger.ColorFormatter(fmt='%(name)s %(message)s', colorize=False)
+    formatter.enable_stats(slowest=2)
+
+    class LoggingMsg(object):
+        def __str__(self):
+            formatter.format(logging.LogRecord('inner', logging.INFO, __file__, 1, 'inner msg', (), None))
+            return 'outer msg'
+
+    record = logging.LogRecord('outer', logging.INFO, __file__, 1, LoggingMsg(), (), None)
+    formatted = []
+    thread = threading.Thread(target=lambda: formatted.append(formatter.format(record)))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive(), 'deadlocked'
+    assert formatted == ['outer outer msg']
+
+    slowest = formatter.stats()['slowest']
+    assert sorted(summary['msg'] for summary in slowest) == ['inner msg', 'outer msg']
+    # The inner record is formatted by getMessage() and again by the slowest summary's str()
+    assert formatter.stats()['records'] == 3
+
+
+@pytest.mark.parametrize("style, fmt", [('%', '<%(levelname)-8s> %(name)s [%(threadName)s] %(message)s'),
+                                        ('{', '<{levelname:<8}> {name} [{threadName}] {message}')])
+@pytest.mark.parametrize("compile_format", [False, True])
+def test_html_formatter(style, fmt, compile_format):
+    try:
+        from html import unescape as html_unescape
+    except ImportError:
+        from HTMLParser import HTMLParser
+        html_unescape = HTMLParser().unescape
+
+    html_formatter = color_bucket_logger.HtmlFormatter(fmt=fmt, style=style, auto_color=True,
+                                                       compile_format=compile_format)
+    term_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, auto_color=True, colorize=True)
+
+    record = logging.LogRecord('some<logger>', logging.INFO, __file__, 1, '<script>%s</script>', ('a & b',), None)
+    html = html_formatter.format(record)
+    term = term_formatter.format(record)
+
+    assert html.startswith('<span class="cbl-c')
+    assert re.search(r'&lt;<span class="cbl-c\d+">INFO    </span>&gt;', html)
+    assert 'some&lt;logger&gt;' in html
+    assert '&lt;script&gt;a &amp; b&lt;/script&gt;' in html
+    assert '<script>' not in html
+    assert html.count('<span') == html.count('</span>')
+
+    # The same colors as the term formatter
+    html_colored = re.findall(r'<span class="cbl-c(\d+)">([^<]*)</span>', html)
+    term_colored = re.findall(r'\x1b\[38;5;(\d+)m([^\x1b]*)(?=\x1b)', term)
+    assert len(html_colored) == 4
+    for color_idx, text in html_colored:
+        assert (color_idx, html_unescape(text)) in term_colored
+
+    css = html_formatter.stylesheet()
+    for color_idx in set(re.findall(r'class="cbl-c(\d+)"', html)):
+        assert '.cbl-c%s { color: #' % color_idx in css
+
+    try:
+        break_stuff()
+    except ZeroDivisionError:
+        exc_record = logging.LogRecord('foo', logging.ERROR, __file__, 1, 'failed', (), sys.exc_info())
+    html = html_formatter.format(exc_record)
+    assert 'ZeroDivisionError' in html
+    assert html.count('<span') == html.count('</span>')
+
+
+def test_html_formatter_inline_styles():
+    formatter = color_bucket_logger.HtmlFormatter(fmt='%(name)s: %(message)s', inline_styles=True,
+                                                  palette='truecolor-dark')
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, 'x > y', (), None)
+    html = formatter.format(record)
+    assert 'class="cbl-c' not in html
+    assert re.search(r'<span style="color:#[0-9a-f]{6}">foo</span>', html)
+    assert 'x &gt; y' in html
+
+
+def test_html_formatter_colorize_false():
+    formatter = color_bucket_logger.HtmlFormatter(fmt='%(name)s & %(message)s', colorize=False)
+    record = logging.LogRecord('foo', logging.INFO, __file__, 1, '"quoted" <b>', (), None)
+    assert formatter.format(record) == 'foo &amp; &quot;quoted&quot; &lt;b&gt;'
+
+
+def test_escape_format():
+    from color_bucket_logger import html_mapper
+
+    assert html_mapper.escape_format('<%(name)-10s> 100%% & %(message)s') == '&lt;%(name)-10s&gt; 100%% &amp; %(message)s'
+    assert html_mapper.escape_format('{{<{name:>10}>}} {lineno!r}', '{') == '{{&lt;{name:>10}&gt;}} {lineno!r}'
+    assert html_mapper.escape_value(12) == 12
+    assert html_mapper.escape_value(None) is None
+    assert html_mapper.escape_value(['<a>']) == '[&#x27;&lt;a&gt;&#x27;]'
+
+
+@pytest.mark.parametrize("fmt, style, formatter_kwargs",
+                         [(None, '%', {}),
+                          ('%(asctime)s %(levelname)-8s [%(threadName)s %(thread)d %(process)5d] %(name)s 100%% %(message)s', '%',
+                           {'auto_color': True}),
+                          ('%(asctime)s %(levelname)s %(name)s %(message)s', '%', {'datefmt': '%H:%M:%S',
+                                                                                   'color_groups': [('levelname', ['message'])]}),
+                          ('{asctime} {levelname:<8} [{threadName}] {name} {process:d} - {message}', '{', {'auto_color': True})])
+def test_colorize_line(fmt, style, formatter_kwargs):
+    from color_bucket_logger import colorize
+
+    plain_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, colorize=False, **formatter_kwargs)
+    color_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, style=style, colorize=True, **formatter_kwargs)
+    colorizer = colorize.LineColorizer(fmt=fmt, style=style, **formatter_kwargs)
+
+    for i in range(20):
+        record = logging.LogRecord('app.mod%d' % (i % 3), (logging.DEBUG, logging.INFO, logging.ERROR)[i % 3],
+                                   __file__, i, 'message %s  with spaces', (i,), None, func='some_func')
+        assert colorizer.colorize_line(plain_formatter.format(record) + '\n') == color_formatter.format(record) + '\n'
+
+    assert colorizer.colorize_line('Traceback (most recent call last):\n') == 'Traceback (most recent call last):\n'
+
+
+def test_colorize_cli(tmp_path, capfd):
+    from color_bucket_logger import __main__ as cli
+
+    fmt = '%(levelname)s %(name)s: %(message)s'
+    plain_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, colorize=False)
+    color_formatter = color_bucket_logger.ColorFormatter(fmt=fmt, colorize=True)
+    records = [logging.LogRecord('foo.bar', logging.INFO, __file__, 1, 'some info', (), None),
+               logging.LogRecord('foo.baz', logging.WARNING, __file__, 1, 'a warning\nsecond line', (), None)]
+
+    log_path = tmp_path / 'app.log'
+    log_path.write_text(u''.join(plain_formatter.format(record) + '\n' for record in records))
+
+    assert cli.main(['colorize', '--fmt', fmt, str(log_path)]) == 0
+    out, _err = capfd.readouterr()
+    # The second line of the message does not match the format, so it is passed through
+    records[1].msg = 'a warning'
+    assert out == color_formatter.format(records[0]) + '\n' + color_formatter.format(records[1]) + '\nsecond line\n'
+
+
+def test_colorize_parallel(tmp_path):
+    from color_bucket_logger import colorize
+
+    fmt = '%(asctime)s %(levelname)-8s %(threadName)s %(name)s - %(message)s'
+    formatter = color_bucket_logger.ColorFormatter(fmt=fmt, colorize=False)
+    lines = []
+    for i in range(300):
+        record = logging.LogRecord('app.mod%d' % (i % 7), logging.INFO, __file__, i, u'message %s \xe9', (i,), None)
+        lines.append(formatter.format(record) + '\n')
+        if i % 50 == 0:
+            lines.append('a line that does not match\r\n')
+    log_path = tmp_path / 'app.log'
+    log_path.write_bytes(u''.join(lines).encode('utf-8') + b'invalid utf-8 \xff\n')
+
+    colorizer = colorize.LineColorizer(fmt=fmt)
+    with colorize.open_text(str(log_path)) as in_stream:
+        expected = colorizer.colorize_text(in_stream.read())
+    if not isinstance(expected, bytes):
+        # py2 reads the lines as byte strs
+        expected = expected.encode('utf-8', 'surrogateescape')
+
+    chunks = list(colorize.file_chunks(str(log_path), chunk_size=1000))
+    assert len(chunks) > 10
+    assert chunks[0][1] == 0 and chunks[-1][2] == len(log_path.read_bytes())
+
+    out_stream = io.BytesIO()
+    colorize.colorize_parallel(chunks, out_stream, 3, {'fmt': fmt})
+    assert out_stream.getvalue() == expected
+
+    out_stream = io.BytesIO()
+    with open(str(log_path), 'rb') as log_fd:
+        colorize.colorize_parallel(colorize.stream_chunks(log_fd, chunk_size=1000), out_stream, 2, {'fmt': fmt})
+    assert out_stream.getvalue() == expected